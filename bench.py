@@ -0,0 +1,444 @@
+"""Benchmarks for the parsers, filters and outputs, on synthetic data.
+
+    python bench.py run [--sizes=10k,1m] [--only=<prefix>,...] [--repeat=<n>] [--data-dir=<dir>] > results.json
+    python bench.py compare <old results.json> <new results.json> [--threshold=<percent>]
+
+The inputs (GPX tracks and routes with point names, Columbus V-900 CSV with NUL padding,
+KML LineStrings and WKT polygons, and the GPX gzipped) are generated from a fixed seed, so every tree and machine
+benchmarks the same data. They are written once per size into the data directory and reused.
+Sizes are 10k, 1m and 10m points; 10m files take a few GB.
+
+Every benchmark runs in a process of its own, which reports how long the measured part took
+and the peak memory of the process, both after loading its input ("base") and at the end.
+"run" writes the results as JSON; "compare" prints the change between two results files and
+exits with status 1 if any benchmark got slower by more than the threshold (10% by default)
+and by more than NOISE_SECONDS."""
+
+from getopt import getopt
+import gzip
+from itertools import izip
+import json
+import mmap
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+import track
+
+SIZES = {'10k': 10 ** 4, '1m': 10 ** 6, '10m': 10 ** 7}
+DEFAULT_SIZES = ['10k', '1m']
+
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "glot-bench")
+
+# part of the data file names, to be changed whenever the generated data changes
+DATA_VERSION = 1
+
+SEED = 1
+BLOCK_SIZE = track.CHUNK_SIZE
+PATH_LENGTH = 10000
+STEP_SECONDS = 5
+START_TIME = 1335859200 # 2012-05-01 08:00:00
+ORIGIN_LAT, ORIGIN_LON = 48.85, 2.35
+# degrees the walk is folded into, so it stays in one city
+SPAN = 0.25
+# one in every NAME_EVERY points has a name, out of STATION_COUNT names
+NAME_EVERY = 97
+STATION_COUNT = 500
+# the logger pads its files with runs of NULs
+NUL_EVERY = 4096
+NUL_COUNT = 512
+
+METRES_PER_DEGREE = 111320.0
+
+# compare doesn't mark changes smaller than this, which are mostly noise
+NOISE_SECONDS = 0.02
+
+def fold(v, span):
+    # a triangle wave: an endless walk stays within [0, span] without jumping
+    v = numpy.mod(v, 2 * span)
+    return numpy.where(v > span, 2 * span - v, v)
+
+def synthetic_blocks(n, seed=SEED):
+    """Yield the points of the synthetic data in blocks of up to BLOCK_SIZE, as dicts of columns.
+    It is a random walk at city speeds that stands still one fifth of the time, with a new path
+    every PATH_LENGTH points and a station name on every NAME_EVERY-th point."""
+
+    rng = numpy.random.RandomState(seed)
+    x = y = heading = 0.0
+    for start in xrange(0, n, BLOCK_SIZE):
+        count = min(BLOCK_SIZE, n - start)
+        index = numpy.arange(start, start + count)
+
+        stopped = numpy.repeat(rng.rand(count // 50 + 1) < 0.2, 50)[:count]
+        headings = heading + numpy.cumsum(rng.normal(0, 0.2, count))
+        speed = numpy.where(stopped, 0, rng.uniform(5, 15, count)) # m/s
+        xs = x + numpy.cumsum(speed * STEP_SECONDS * numpy.cos(headings))
+        ys = y + numpy.cumsum(speed * STEP_SECONDS * numpy.sin(headings))
+        x, y, heading = xs[-1], ys[-1], headings[-1]
+
+        lat = numpy.round(ORIGIN_LAT + fold(ys / METRES_PER_DEGREE, SPAN), 6)
+        lon = numpy.round(ORIGIN_LON + fold(xs / (METRES_PER_DEGREE * numpy.cos(numpy.radians(ORIGIN_LAT))), SPAN), 6)
+        # from the position, so a vehicle standing still keeps its elevation
+        ele = numpy.round(100 + 30 * numpy.sin(lat * 200) + 20 * numpy.cos(lon * 150))
+
+        named = index % NAME_EVERY == 0
+        names = [None] * count
+        for i in numpy.flatnonzero(named).tolist():
+            names[i] = "Station %d" % ((start + i) // NAME_EVERY % STATION_COUNT)
+
+        yield {'lat': lat, 'lon': lon, 'ele': ele, 'time': START_TIME + index * STEP_SECONDS,
+               'speed': numpy.round(speed * 3.6).astype(numpy.int64), 'names': names,
+               'path_starts': index % PATH_LENGTH == 0}
+
+def time_strings(times):
+    return numpy.datetime_as_string(times.astype('datetime64[s]')).tolist()
+
+def write_gpx(f, n):
+    # even paths are tracks and odd ones routes
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="glot bench">\n')
+    end = ""
+    path = 0
+    for block in synthetic_blocks(n):
+        lines = []
+        for lat, lon, ele, t, name, path_start in izip(block['lat'].tolist(), block['lon'].tolist(), block['ele'].tolist(),
+                                                       time_strings(block['time']), block['names'], block['path_starts'].tolist()):
+            if path_start:
+                lines.append(end)
+                if path % 2 == 0:
+                    lines.append("<trk><name>Path %d</name><trkseg>\n" % path)
+                    end, tag = "</trkseg></trk>\n", "trkpt"
+                else:
+                    lines.append("<rte><name>Path %d</name>\n" % path)
+                    end, tag = "</rte>\n", "rtept"
+                path += 1
+            lines.append('<%s lat="%.6f" lon="%.6f"><ele>%.1f</ele><time>%sZ</time>%s</%s>\n'
+                         % (tag, lat, lon, ele, t, "<name>%s</name>" % name if name is not None else "", tag))
+        f.write("".join(lines))
+    f.write(end + "</gpx>\n")
+
+def write_columbus(f, n):
+    f.write("INDEX,TAG,DATE,TIME,LATITUDE N/S,LONGITUDE E/W,HEIGHT,SPEED,HEADING,VOX\n")
+    i = 0
+    for block in synthetic_blocks(n):
+        lines = []
+        for lat, lon, ele, t, speed in izip(block['lat'].tolist(), block['lon'].tolist(), block['ele'].tolist(),
+                                           time_strings(block['time']), block['speed'].tolist()):
+            i += 1
+            lines.append("%-4d,T,%s%s%s,%s%s%s,%.6f%s,%.6f%s,%-4d,%-3d,0  ,    \n"
+                         % (i, t[2:4], t[5:7], t[8:10], t[11:13], t[14:16], t[17:19],
+                            abs(lat), "N" if lat >= 0 else "S", abs(lon), "E" if lon >= 0 else "W", ele, speed))
+            if i % NUL_EVERY == 0:
+                lines.append("\x00" * NUL_COUNT)
+        f.write("".join(lines))
+    f.write("\x00" * NUL_COUNT)
+
+def write_kml(f, n):
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n')
+    end = ""
+    path = 0
+    for block in synthetic_blocks(n):
+        lines = []
+        for lat, lon, ele, path_start in izip(block['lat'].tolist(), block['lon'].tolist(), block['ele'].tolist(), block['path_starts'].tolist()):
+            if path_start:
+                lines.append(end)
+                lines.append("<Placemark><name>Path %d</name><LineString><coordinates>\n" % path)
+                end = "</coordinates></LineString></Placemark>\n"
+                path += 1
+            lines.append("%.6f,%.6f,%.1f\n" % (lon, lat, ele))
+        f.write("".join(lines))
+    f.write(end + "</Document></kml>\n")
+
+def write_wkt(f, n):
+    # every path is the exterior of a polygon, closed by going back to its first point
+    f.write("MULTIPOLYGON (")
+    first = None
+    for block in synthetic_blocks(n):
+        parts = []
+        for lat, lon, path_start in izip(block['lat'].tolist(), block['lon'].tolist(), block['path_starts'].tolist()):
+            if path_start:
+                if first is not None:
+                    parts.append(", %.6f %.6f)), " % first)
+                parts.append("((")
+                first = (lon, lat)
+            else:
+                parts.append(", ")
+            parts.append("%.6f %.6f" % (lon, lat))
+        f.write("".join(parts))
+    f.write(", %.6f %.6f)))\n" % first)
+
+def write_tracks(f, n):
+    # the tracks of the other formats, packed, for the benchmarks that don't parse
+    path = -1
+    for block in synthetic_blocks(n):
+        starts = numpy.flatnonzero(block['path_starts']).tolist()
+        bounds = sorted(set([0] + starts + [len(block['lat'])]))
+        for start, end in zip(bounds, bounds[1:]):
+            continues = start not in starts
+            if not continues:
+                path += 1
+            names = sorted(set(name for name in block['names'][start:end] if name is not None))
+            codes = dict((name, i) for i, name in enumerate(names))
+            name_codes = [codes[name] if name is not None else track.NO_NAME for name in block['names'][start:end]]
+            f.write(track.pack(track.Track(block['lat'][start:end], block['lon'][start:end], block['ele'][start:end],
+                                           block['time'][start:end] * track.SECOND, name_codes, names, name="Path %d" % path, continues=continues)))
+
+def gzipped(write):
+    def write_gzipped(f, n):
+        g = gzip.GzipFile(filename="", mode='wb', fileobj=f)
+        write(g, n)
+        g.close()
+    return write_gzipped
+
+DATA_WRITERS = {'gpx': write_gpx, 'gpx.gz': gzipped(write_gpx), 'CSV': write_columbus, 'kml': write_kml, 'wkt': write_wkt, 'glt': write_tracks}
+
+def data_file(data_dir, extension, size):
+    """The generated input of a format and size, written if it isn't there yet."""
+
+    filename = os.path.join(data_dir, "bench-v%s-%s.%s" % (DATA_VERSION, size, extension))
+    if not os.path.exists(filename):
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        sys.stderr.write("generating %s...\n" % filename)
+        with file(filename + ".tmp", 'wb') as f:
+            DATA_WRITERS[extension](f, SIZES[size])
+        os.rename(filename + ".tmp", filename)
+    return filename
+
+def read_tracks(filename):
+    with file(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return track.unpack(data)
+
+def track_stream(filename):
+    # like the stream glot hands to outputs, reading the tracks again for every pass
+    return track.TrackStream(lambda sources=None: read_tracks(filename))
+
+def point_count(paths):
+    return sum(len(path) for path in paths)
+
+# every benchmark takes the data directory and size, loads what it needs and returns
+# a function doing the measured work and returning the number of points it went through
+
+def parse_benchmark(module_name, extension):
+    def setup(data_dir, size):
+        filename = data_file(data_dir, extension, size)
+        module = __import__(module_name)
+        import compressed
+        def run():
+            with compressed.open_file(filename) as f:
+                return point_count(module.parse(f, None))
+        return run
+    return setup
+
+def filter_benchmark(make_filter):
+    def setup(data_dir, size):
+        import filters
+        filename = data_file(data_dir, 'glt', size)
+        return lambda: point_count(filters.chain([make_filter(filters)], read_tracks(filename)))
+    return setup
+
+def output_benchmark(module_name, func_name, writes_files=False, compression=None, **options):
+    # outputs write to /dev/null, or to a temporary directory that is removed afterwards
+    def setup(data_dir, size):
+        import output
+        func = getattr(__import__(module_name), func_name)
+        paths = track_stream(data_file(data_dir, 'glt', size))
+        points = point_count(paths)
+        def run():
+            output_dir = tempfile.mkdtemp()
+            stdout = sys.stdout
+            sys.stdout = file(os.devnull, 'w')
+            try:
+                if writes_files:
+                    func(paths, output_path=output_dir, **options)
+                elif compression is not None:
+                    out = output.Sink(sys.stdout, compression)
+                    func(paths, out=out, **options)
+                    out.close()
+                else:
+                    func(paths, **options)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+                shutil.rmtree(output_dir)
+            return points
+        return run
+    return setup
+
+def points_benchmark(measure):
+    # for the functions in utils: all points as one line
+    def setup(data_dir, size):
+        import utils
+        paths = list(read_tracks(data_file(data_dir, 'glt', size)))
+        lat = numpy.concatenate([path.lat for path in paths])
+        lon = numpy.concatenate([path.lon for path in paths])
+        def run():
+            measure(utils, lat, lon)
+            return len(lat)
+        return run
+    return setup
+
+def simplify(method):
+    def measure(utils, lat, lon):
+        x, y = utils.latlng_to_xy(lat, lon)
+        # paths are simplified the way the tiles of zoom 12 are
+        for start in xrange(0, len(x), PATH_LENGTH):
+            utils.simplify(x[start:start + PATH_LENGTH], y[start:start + PATH_LENGTH], 20.0, method)
+    return measure
+
+BENCHMARKS = [
+    ('parse/gpx', parse_benchmark('in_gpx', 'gpx')),
+    ('parse/gpx-gz', parse_benchmark('in_gpx', 'gpx.gz')),
+    ('parse/columbus', parse_benchmark('in_columbus', 'CSV')),
+    ('parse/kml', parse_benchmark('in_kml', 'kml')),
+    ('parse/wkt', parse_benchmark('in_wkt', 'wkt')),
+    ('filter/discard-stopped', filter_benchmark(lambda filters: filters.DiscardStopped())),
+    ('filter/skip', filter_benchmark(lambda filters: filters.Skip(10))),
+    ('filter/name-match', filter_benchmark(lambda filters: filters.name_match_filter(300))),
+    ('output/stats', output_benchmark('out_stats', 'gen')),
+    ('output/stats-json', output_benchmark('out_stats', 'gen', output_format='json')),
+    ('output/kml', output_benchmark('out_kml', 'gen', output_path=True, output_points=True)),
+    ('output/kmz', output_benchmark('out_kml', 'gen', compression='kmz', output_path=True, output_points=True)),
+    ('output/wkt', output_benchmark('out_wkt', 'gen', output_path=True, output_points=True)),
+    ('output/wkt-gzip', output_benchmark('out_wkt', 'gen', compression='gzip', output_path=True, output_points=True)),
+    ('output/svg-map', output_benchmark('out_svg', 'gen_map', output_path=True, output_points=True)),
+    ('output/svg-weighted', output_benchmark('out_svg', 'gen_weighted', output_path=True, output_points=True)),
+    ('output/heatmap', output_benchmark('out_heatmap', 'gen')),
+    ('output/plot', output_benchmark('out_plot', 'gen', xaxis='distance', yaxis=['speed', 'elevation'], avg_window=10)),
+    ('output/geojson-tiles', output_benchmark('out_geojson_tiles', 'gen', writes_files=True, min_zoom=8, max_zoom=14)),
+    ('utils/distances-vincenty', points_benchmark(lambda utils, lat, lon: utils.distances(lat, lon, 'vincenty'))),
+    ('utils/distances-haversine', points_benchmark(lambda utils, lat, lon: utils.distances(lat, lon, 'haversine'))),
+    ('utils/distances-equirectangular', points_benchmark(lambda utils, lat, lon: utils.distances(lat, lon, 'equirectangular'))),
+    ('utils/simplify-rdp', points_benchmark(simplify('rdp'))),
+    ('utils/simplify-vw', points_benchmark(simplify('vw'))),
+]
+
+def max_rss_mb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run_stage(name, size, data_dir):
+    """Run one benchmark in this process and print its result as JSON."""
+
+    setup = dict(BENCHMARKS)[name]
+    run = setup(data_dir, size)
+    base_rss = max_rss_mb()
+    start = time.time()
+    points = run()
+    seconds = time.time() - start
+    json.dump({'seconds': seconds, 'points': points, 'base_rss_mb': base_rss, 'max_rss_mb': max_rss_mb()}, sys.stdout)
+
+def run_benchmarks(names, sizes, repeat, data_dir):
+    results = {}
+    for size in sizes:
+        for name in names:
+            sys.stderr.write("%s@%s..." % (name, size))
+            best = None
+            for i in xrange(repeat):
+                process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "stage", name, size, data_dir],
+                                           stdout=subprocess.PIPE)
+                output = process.communicate()[0]
+                if process.returncode != 0:
+                    best = {'error': "exit status %s" % process.returncode}
+                    break
+                result = json.loads(output)
+                if best is None or result['seconds'] < best['seconds']:
+                    best = dict(result, max_rss_mb=max(result['max_rss_mb'], best['max_rss_mb'] if best else 0))
+            if 'error' in best:
+                sys.stderr.write(" failed\n")
+            else:
+                best['points_per_second'] = best['points'] / max(best['seconds'], 1e-9)
+                sys.stderr.write(" %.3fs, %.0f MB\n" % (best['seconds'], best['max_rss_mb']))
+            results["%s@%s" % (name, size)] = best
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new, threshold):
+    """Print the change of every benchmark in both results; return whether any got slower by more than <threshold> percent."""
+
+    slower = False
+    print "%-42s%10s%10s%9s%10s%10s" % ("", "old s", "new s", "change", "old MB", "new MB")
+    for key in sorted(set(old['results']) & set(new['results'])):
+        a, b = old['results'][key], new['results'][key]
+        if 'error' in a or 'error' in b:
+            print "%-42sfailed in %s" % (key, " and ".join(name for name, result in [("old", a), ("new", b)] if 'error' in result))
+            continue
+        change = (b['seconds'] - a['seconds']) / max(a['seconds'], 1e-9) * 100
+        mark = ""
+        if abs(b['seconds'] - a['seconds']) < NOISE_SECONDS:
+            pass
+        elif change > threshold:
+            mark = "  SLOWER"
+            slower = True
+        elif change < -threshold:
+            mark = "  faster"
+        print "%-42s%10.3f%10.3f%8.1f%%%10.0f%10.0f%s" % (key, a['seconds'], b['seconds'], change, a['max_rss_mb'], b['max_rss_mb'], mark)
+    for key in sorted(set(old['results']) ^ set(new['results'])):
+        print "%-42sonly in %s" % (key, "old" if key in old['results'] else "new")
+    return slower
+
+def usage():
+    sys.stderr.write(__doc__.split("\n\n")[1] + "\n")
+    sys.exit(2)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        usage()
+    command = sys.argv[1]
+
+    if command == "stage":
+        run_stage(*sys.argv[2:5])
+    elif command == "run":
+        optlist, args = getopt(sys.argv[2:], "", ["sizes=", "only=", "repeat=", "data-dir="])
+        sizes = DEFAULT_SIZES
+        only = None
+        repeat = 1
+        data_dir = DEFAULT_DATA_DIR
+        for opt, val in optlist:
+            if opt == "--sizes":
+                sizes = val.split(",")
+                for size in sizes:
+                    if size not in SIZES:
+                        sys.stderr.write("sizes must be some of %s.\n" % ", ".join(sorted(SIZES, key=SIZES.get)))
+                        sys.exit(2)
+            elif opt == "--only":
+                only = val.split(",")
+            elif opt == "--repeat":
+                repeat = int(val)
+            elif opt == "--data-dir":
+                data_dir = val
+        names = [name for name, setup in BENCHMARKS if only is None or any(name.startswith(prefix) for prefix in only)]
+        results = run_benchmarks(names, sizes, repeat, os.path.abspath(data_dir))
+        json.dump({'version': 1, 'commit': git_commit(), 'time': int(time.time()),
+                   'machine': {'python': platform.python_version(), 'numpy': numpy.__version__,
+                               'platform': platform.platform(), 'processor': platform.processor()},
+                   'results': results}, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    elif command == "compare":
+        optlist, args = getopt(sys.argv[2:], "", ["threshold="])
+        threshold = 10.0
+        for opt, val in optlist:
+            if opt == "--threshold":
+                threshold = float(val)
+        if len(args) != 2:
+            usage()
+        with file(args[0]) as f:
+            old = json.load(f)
+        with file(args[1]) as f:
+            new = json.load(f)
+        sys.exit(1 if compare(old, new, threshold) else 0)
+    else:
+        usage()
@@ -0,0 +1,164 @@
+import glob
+import hashlib
+import json
+import mmap
+import os
+
+import track
+import utils
+
+DEFAULT_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser("~/.cache")), "glot")
+DEFAULT_SIZE = 1 << 30
+
+# part of every key, so entries written by a parser that has changed since aren't used
+VERSION = "4"
+
+INDEX_NAME = "index.json"
+ENTRY_EXTENSION = ".glt"
+
+def evict(pattern, max_size):
+    """Remove the least recently used (modified) files matching <pattern> until the rest fit in <max_size> bytes."""
+
+    entries = []
+    for path in glob.glob(pattern):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+class Cache(object):
+    """Tracks parsed from input files, kept on disk in the track.pack format.
+
+    An entry is keyed by the SHA-1 of the file contents, the parser and the transportation
+    (which comes from the file name). The index remembers the SHA-1 of every file seen along
+    with its size and mtime, so a file that hasn't been touched isn't read at all, and the
+    entries made from the file, so the file is forgotten once they are all evicted.
+    Entries are memory-mapped when loaded. Once the cache grows over max_size bytes, the
+    least recently used entries are removed."""
+
+    def __init__(self, directory=DEFAULT_DIR, max_size=DEFAULT_SIZE, rebuild=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.rebuild = rebuild
+        # entries written by this run, which are used even when rebuilding
+        self.written = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            with file(os.path.join(directory, INDEX_NAME)) as f:
+                self.index = json.load(f)
+        except (IOError, ValueError):
+            self.index = {}
+        self.index_changed = False
+
+    def content_digest(self, filename):
+        path = os.path.abspath(filename)
+        known = self.index.get(path)
+        info = utils.file_info(path, known)
+        if info is not known:
+            self.index[path] = info
+            self.index_changed = True
+        return info['sha1']
+
+    def entry_path(self, filename, input_func, transportation):
+        key = "|".join([VERSION, self.content_digest(filename), input_func.__module__, transportation or ""])
+        name = hashlib.sha1(key).hexdigest() + ENTRY_EXTENSION
+        entries = self.index[os.path.abspath(filename)].setdefault('entries', [])
+        if name not in entries:
+            entries.append(name)
+            self.index_changed = True
+        return os.path.join(self.directory, name)
+
+    def prepare(self, inputs):
+        """Bring the index up to date for <inputs> (filename, input_func, transportation),
+        hashing the files that changed. Processes started afterwards get a copy of the index
+        that already has what they need, as their own changes to it are lost."""
+
+        for filename, input_func, transportation in inputs:
+            self.entry_path(filename, input_func, transportation)
+
+    def read(self, filename, input_func, transportation):
+        """Return the tracks cached for a file, or None if there aren't any."""
+
+        path = self.entry_path(filename, input_func, transportation)
+        if self.rebuild and path not in self.written:
+            return None
+        try:
+            with file(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    tracks = []
+                else:
+                    tracks = list(track.unpack(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)))
+        except EnvironmentError:
+            return None
+        except (ValueError, KeyError):
+            # not a complete entry; it gets replaced
+            return None
+        # mark the entry as recently used
+        os.utime(path, None)
+        return tracks
+
+    def writer(self, filename, input_func, transportation):
+        path = self.entry_path(filename, input_func, transportation)
+        return CacheWriter(path, self.written)
+
+    def store(self, filename, input_func, transportation, packed):
+        writer = self.writer(filename, input_func, transportation)
+        writer.write(packed)
+        writer.commit()
+
+    def close(self):
+        """Evict entries over the size limit and save the index, without the files
+        that are gone or have no entries left."""
+
+        pattern = os.path.join(self.directory, "*" + ENTRY_EXTENSION)
+        evict(pattern, self.max_size)
+
+        entries = set(os.path.basename(path) for path in glob.glob(pattern))
+        for path, info in self.index.items():
+            kept = [name for name in info.get('entries', []) if name in entries]
+            if not kept or not os.path.exists(path):
+                del self.index[path]
+                self.index_changed = True
+            elif len(kept) < len(info['entries']):
+                info['entries'] = kept
+                self.index_changed = True
+
+        if self.index_changed:
+            utils.replace_file(os.path.join(self.directory, INDEX_NAME), json.dumps(self.index))
+            self.index_changed = False
+
+class CacheWriter(object):
+    """Writes an entry to a temporary file, which only replaces the entry on commit,
+    so an interrupted parse leaves nothing behind."""
+
+    def __init__(self, path, written):
+        self.path = path
+        self.written = written
+        self.tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        self.f = file(self.tmp_path, 'wb')
+
+    def write(self, packed):
+        self.f.write(packed)
+
+    def commit(self):
+        self.f.close()
+        os.rename(self.tmp_path, self.path)
+        self.written.add(self.path)
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
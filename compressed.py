@@ -0,0 +1,148 @@
+import bz2
+import subprocess
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # xz files are read through the xz command then
+        lzma = None
+
+# taken off a file name to find the type of the file in it
+EXTENSIONS = [".gz", ".bz2", ".xz"]
+
+# the compression of a file is told by how it starts, whatever its name
+MAGIC = [("\x1f\x8b", 'gzip'), ("BZh", 'bzip2'), ("\xfd7zXZ\x00", 'xz')]
+MAGIC_SIZE = max(len(magic) for magic, compression in MAGIC)
+
+# compressed data is read this many bytes at a time, so what one read expands to stays small
+COMPRESSED_READ_SIZE = 1 << 16
+
+def base_name(filename):
+    """The name of a file without its compression extension: "track.gpx.gz" -> "track.gpx"."""
+
+    for extension in EXTENSIONS:
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+    return filename
+
+def detect(head):
+    for magic, compression in MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+def stream_ended(decompressor):
+    # the decompressors of Python 2 don't say whether they got to the end of their stream,
+    # but data after the end is refused (bz2, lzma) or set aside (zlib)
+    try:
+        decompressor.decompress("\0")
+    except EOFError:
+        return True
+    except Exception:
+        return False
+    return decompressor.unused_data == "\0"
+
+class DecompressingReader(object):
+    """A file-like object reading the decompressed data of <fileobj>, which may hold several
+    compressed streams one after another (as concatenated gzip files or pbzip2 output do)."""
+
+    def __init__(self, fileobj, make_decompressor):
+        self.fileobj = fileobj
+        self.make_decompressor = make_decompressor
+        self.decompressor = make_decompressor()
+        self.pending = []
+        self.pending_size = 0
+        self.done = False
+
+    def decompress(self, data):
+        while data:
+            try:
+                self.pending.append(self.decompressor.decompress(data))
+            except EOFError:
+                # bz2 raises this for data after the end of its stream, when the stream ended right at the end of a read
+                self.decompressor = self.make_decompressor()
+                continue
+            self.pending_size += len(self.pending[-1])
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = self.make_decompressor()
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or self.pending_size < size):
+            data = self.fileobj.read(COMPRESSED_READ_SIZE)
+            if data:
+                self.decompress(data)
+            else:
+                self.done = True
+                if not stream_ended(self.decompressor):
+                    raise IOError("compressed data ends in the middle of a stream")
+        data = "".join(self.pending)
+        if 0 <= size < len(data):
+            data, rest = data[:size], data[size:]
+            self.pending, self.pending_size = [rest], len(rest)
+        else:
+            self.pending, self.pending_size = [], 0
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class PipeReader(object):
+    """A file-like object reading what a command writes when given <fileobj> as input."""
+
+    def __init__(self, fileobj, command):
+        self.fileobj = fileobj
+        self.command = command
+        try:
+            self.process = subprocess.Popen(command, stdin=fileobj, stdout=subprocess.PIPE)
+        except OSError, e:
+            raise IOError("can't run %s: %s" % (command[0], e))
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        # the command is done once its output ended, which a read of everything gets to too
+        if (size < 0 or not data and size != 0) and self.process.wait() != 0:
+            raise IOError("%s failed with exit status %s" % (" ".join(self.command), self.process.returncode))
+        return data
+
+    def close(self):
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            # stopped before the end
+            self.process.terminate()
+        self.process.wait()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_file(filename):
+    """Open an input file for reading, decompressing it on the fly if it is compressed
+    with gzip, bzip2 or xz. Uncompressed files are returned as they are."""
+
+    f = file(filename, 'rb')
+    head = f.read(MAGIC_SIZE)
+    f.seek(0)
+    compression = detect(head)
+    if compression == 'gzip':
+        return DecompressingReader(f, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    elif compression == 'bzip2':
+        return DecompressingReader(f, bz2.BZ2Decompressor)
+    elif compression == 'xz':
+        if lzma is not None:
+            return DecompressingReader(f, lzma.LZMADecompressor)
+        return PipeReader(f, ["xz", "-dc"])
+    return f
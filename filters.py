@@ -1,89 +1,183 @@
-from collections import defaultdict
-
-from utils import distance, Point
-
-def avg(l):
-    return sum(l) / len(l)
-
-def find_nearby_point(points, point, radius):
-    for p in points:
-        if distance(p, point) <= radius:
-            return p
-    return None
-
-def find_closest_point(points, point):
-    closest_point = None
-    min_distance = None
-    for p in points:
-        d = distance(p, point)
-        if min_distance is None or d < min_distance:
-            min_distance = d
-            closest_point = p
-    return closest_point
-
-def discard_stopped_filter(paths):
+import numpy
+
+import track
+from utils import distances_to, CHORD_RATIO, PointGrid
+
+def find_nearby_point(grid, key, lat, lon, candidates_lat, candidates_lon, radius):
+    """Ids of the points in <grid> within <radius> meters of (lat, lon), in increasing order."""
+
+    ids = numpy.array(sorted(grid.around(key)), dtype=numpy.int64)
+    if not len(ids):
+        return ids
+    d = distances_to(candidates_lat[ids], candidates_lon[ids], lat, lon)
+    return ids[d <= radius]
+
+def find_closest_point(grid, key, lat, lon, candidates_lat, candidates_lon):
+    """Id of the point in <grid> closest to (lat, lon), the lowest one on ties."""
+
+    k = 1
+    while True:
+        # once the search cube is as large as the number of occupied cells, just look at everything
+        exhaustive = (2 * k + 1) ** 3 >= len(grid.cells)
+        if exhaustive:
+            ids = numpy.arange(len(candidates_lat))
+        else:
+            ids = numpy.array(sorted(grid.around(key, k)), dtype=numpy.int64)
+        if len(ids):
+            d = distances_to(candidates_lat[ids], candidates_lon[ids], lat, lon)
+            closest = numpy.argmin(d)
+            # anything outside the searched cells is further than this
+            if exhaustive or d[closest] <= k * grid.cell_size / CHORD_RATIO:
+                return ids[closest]
+        k *= 2
+
+def same_ele(ele1, ele2):
+    return (ele1 == ele2) | (numpy.isnan(ele1) & numpy.isnan(ele2))
+
+class MaskStage(object):
+    """A filter that only drops points. Stages are run together by mask_filter, each on the points
+    the stages before it kept: start_path() is called before the first chunk of every path and
+    keep() gets the indices of the points of a chunk that are left, returning the ones to keep."""
+
+    name = None
+
+    def start_path(self):
+        pass
+
+    def keep(self, path, indices, ends_path):
+        raise NotImplementedError
+
+class DiscardStopped(MaskStage):
     """Discard all consecutive points with the same coordinates (which means the vechicle was stopped) and that have the same name.
     Should not have any effect on the output, except of slightly reducing the size."""
 
-    for path in paths:
-        i = 1
-        while i < len(path['points']) - 1:
-            p1, p2 = path['points'][i-1:i+1]
-            if p1.lat == p2.lat and p1.lon == p2.lon and p1.ele == p2.ele and p1.name == p2.name:
-                path['points'].pop(i)
-            else:
-                i += 1
-
-def skip_filter(skip):
+    name = "discard-stopped"
+
+    def start_path(self):
+        self.last = None # (lat, lon, ele, name) of the last point of the previous chunk of the same path
+
+    def keep(self, path, indices, ends_path):
+        if not len(indices):
+            return indices
+        lat, lon, ele, name_codes = path.lat[indices], path.lon[indices], path.ele[indices], path.name_codes[indices]
+        same = (lat[1:] == lat[:-1]) & (lon[1:] == lon[:-1]) & same_ele(ele[1:], ele[:-1]) & (name_codes[1:] == name_codes[:-1])
+        keep = numpy.ones(len(indices), dtype=bool)
+        # a point equal to its predecessor is also equal to the last point kept before it
+        keep[1:] = ~same
+        if self.last is not None:
+            last_lat, last_lon, last_ele, last_name = self.last
+            keep[0] = not (last_lat == lat[0] and last_lon == lon[0] and same_ele(last_ele, ele[0])
+                           and last_name == path.point_name(indices[0]))
+        # the first and last points of a path always stay
+        if ends_path:
+            keep[-1] = True
+        self.last = lat[-1], lon[-1], ele[-1], path.point_name(indices[-1])
+        return indices[keep]
+
+class Skip(MaskStage):
     """Only keep one in every <skip> points.
     Useful to considerably reduce the size of output, but with loss of accuracy.
     """
 
+    def __init__(self, skip):
+        self.skip = skip
+        self.name = "skip=%s" % skip
+
+    def start_path(self):
+        self.offset = 0 # index of the chunk's first point within its path
+
+    def keep(self, path, indices, ends_path):
+        keep = numpy.zeros(len(indices), dtype=bool)
+        keep[-self.offset % self.skip::self.skip] = True
+        if ends_path:
+            keep[-1:] = True
+        self.offset += len(indices)
+        return indices[keep]
+
+def mask_filter(stages):
+    """Run MaskStages in a single pass, copying each chunk at most once, after all of them."""
+
     def _filter(paths):
-        for path in paths:
-            keep = lambda i: i == 0 or i % skip == 0 or i == len(path['points']) - 1
-            path['points'] = [p for i, p in enumerate(path['points']) if keep(i)]
+        for path, ends_path in track.mark_path_ends(paths):
+            if not path.continues:
+                for stage in stages:
+                    stage.start_path()
+            indices = numpy.arange(len(path))
+            for stage in stages:
+                indices = stage.keep(path, indices, ends_path)
+            yield path if len(indices) == len(path) else path.take(indices)
     return _filter
 
+def chain(filter_list, paths, wrap=None):
+    """Apply filters in order. A filter is either a MaskStage or a function from paths to paths;
+    consecutive MaskStages are fused by mask_filter. wrap(name, paths), if given, is applied to
+    what each filter (or group of fused stages) produces."""
+
+    def apply(name, f, paths):
+        paths = f(paths)
+        return wrap(name, paths) if wrap is not None else paths
+
+    stages = []
+    for f in filter_list:
+        if isinstance(f, MaskStage):
+            stages.append(f)
+            continue
+        if stages:
+            paths = apply("filter " + "+".join(stage.name for stage in stages), mask_filter(stages), paths)
+            stages = []
+        paths = apply("filter " + f.name, f, paths)
+    if stages:
+        paths = apply("filter " + "+".join(stage.name for stage in stages), mask_filter(stages), paths)
+    return paths
+
 def name_match_filter(radius):
     """Considers all points within <radius> meters distance from each other and that have the same name to be the same point.
     It will modify the coordinates of all such points to their average.
     """
 
-    def find_group(groups, point):
-        for group in groups:
-            if find_nearby_point(group, point, radius) is not None:
-                return group
-        return None
-
-    def group_points(points):
-        groups = []
-        for point in points:
-            group = find_group(groups, point)
-            if group is None:
-                group = []
-                groups.append(group)
-            group.append(point)
-        return groups
+    def group_points(lat, lon):
+        """Assigns each point to the first group having a member within <radius>, or to a new group."""
 
-    def _filter(paths):
-        all_points = defaultdict(list)
-
-        for path in paths:
-            for point in path['points']:
-                all_points[point.name].append(point)
-
-        all_points_grouped = dict((name, group_points(points)) for name, points in all_points.iteritems())
-
-        all_group_coords = {}
-        for name, groups in all_points_grouped.iteritems():
-            all_group_coords[name] = [Point(lat=avg([p.lat for p in group]), lon=avg([p.lon for p in group]), ele=None, time=None, name=None) for group in groups]
+        grid = PointGrid(radius)
+        groups = numpy.empty(len(lat), dtype=numpy.int64)
+        group_count = 0
+        for i, key in enumerate(grid.keys(lat, lon)):
+            nearby = find_nearby_point(grid, key, lat[i], lon[i], lat, lon, radius)
+            if len(nearby):
+                groups[i] = groups[nearby].min()
+            else:
+                groups[i] = group_count
+                group_count += 1
+            grid.add(key, i)
+        return groups, group_count
 
+    def _filter(paths):
+        paths = list(track.join_chunks(paths))
+        points = track.concatenate(paths)
+        new_lat = numpy.empty(len(points))
+        new_lon = numpy.empty(len(points))
+
+        for code in numpy.unique(points.name_codes):
+            indices = numpy.flatnonzero(points.name_codes == code)
+            lat, lon = points.lat[indices], points.lon[indices]
+
+            groups, group_count = group_points(lat, lon)
+            sizes = numpy.bincount(groups, minlength=group_count)
+            group_lat = numpy.bincount(groups, weights=lat, minlength=group_count) / sizes
+            group_lon = numpy.bincount(groups, weights=lon, minlength=group_count) / sizes
+
+            grid = PointGrid(radius)
+            for i, key in enumerate(grid.keys(group_lat, group_lon)):
+                grid.add(key, i)
+            for i, key in zip(indices, grid.keys(lat, lon)):
+                closest = find_closest_point(grid, key, points.lat[i], points.lon[i], group_lat, group_lon)
+                new_lat[i], new_lon[i] = group_lat[closest], group_lon[closest]
+
+        start = 0
         for path in paths:
-            for i in range(len(path['points'])):
-                point = path['points'][i]
-                group_coords = find_closest_point(all_group_coords[point.name], point)
-                new_point = Point(group_coords.lat, group_coords.lon, point.ele, point.time, point.name)
-                path['points'][i] = new_point
+            end = start + len(path)
+            yield path.copy_with(lat=new_lat[start:end], lon=new_lon[start:end])
+            start = end
 
+    _filter.name = "name-match-radius=%s" % radius
     return _filter
@@ -1,28 +1,195 @@
 #!/usr/bin/python
 
+from collections import deque
 from getopt import getopt
+import itertools
+import multiprocessing
 import os
 import re
 import sys
 
+import cache
+import compressed
 import filters
+import instrument
+import output
+import tiles
+import track
+import utils
+
+def get_transportation(filename):
+    m = re.match(r".*(plane|train|bus|car|motorcycle|boat|bike|walk).*", os.path.basename(filename))
+    return m.group(1) if m else None
+
+def parse_file(filename, input_func):
+    with compressed.open_file(filename) as f:
+        sys.stderr.write("parsing %s...\n" % filename)
+        source = os.path.abspath(filename)
+        for path in input_func(f, transportation=get_transportation(filename)):
+            path.source = source
+            yield path
+
+def read_cached(filename, input_func, parse_cache):
+    """Return the paths cached for a file, or None if it has to be parsed."""
+
+    paths = parse_cache.read(filename, input_func, get_transportation(filename))
+    if paths is not None:
+        sys.stderr.write("reading %s from cache...\n" % filename)
+        source = os.path.abspath(filename)
+        for path in paths:
+            path.source = source
+    return paths
+
+def parse_file_cached(filename, input_func, parse_cache):
+    if parse_cache is None:
+        for path in parse_file(filename, input_func):
+            yield path
+        return
+
+    paths = read_cached(filename, input_func, parse_cache)
+    if paths is not None:
+        for path in paths:
+            yield path
+        return
+
+    writer = parse_cache.writer(filename, input_func, get_transportation(filename))
+    try:
+        for path in parse_file(filename, input_func):
+            writer.write(track.pack(path))
+            yield path
+    except:
+        # failed, or the consumer stopped early
+        writer.abort()
+        raise
+    writer.commit()
+
+def pack_file(filename, input_func):
+    paths = parse_file(filename, input_func)
+    if instrument.current is not None:
+        paths = instrument.current.wrap("parse " + filename, paths)
+    return "".join(track.pack(path) for path in paths)
+
+def parse_file_packed(job):
+    # runs in a worker process; packed tracks are much cheaper to send back than pickled objects
+    filename, input_func = job
+    try:
+        packed, measured = instrument.in_worker(pack_file, filename, input_func)
+        return packed, measured, None
+    except Exception, e:
+        return None, None, "%s: %s" % (e.__class__.__name__, e)
+
+def parse_parallel(inputs, processes, parse_cache=None):
+    """Parse files in a pool of <processes> workers, yielding their paths in argument order.
+    A file that fails to parse is reported and skipped."""
+
+    pool = multiprocessing.Pool(processes)
+
+    def submit(job):
+        filename, input_func = job
+        cached = read_cached(filename, input_func, parse_cache) if parse_cache is not None else None
+        if cached is not None:
+            return job, cached, None
+        return job, None, pool.apply_async(parse_file_packed, (job,))
+
+    jobs = iter(inputs)
+    # only keep a few files ahead of the consumer, so results don't pile up in memory
+    pending = deque(submit(job) for job in itertools.islice(jobs, processes * 2))
+    try:
+        while pending:
+            (filename, input_func), cached, result = pending.popleft()
+            for job in itertools.islice(jobs, 1):
+                pending.append(submit(job))
+            if cached is not None:
+                for path in cached:
+                    yield path
+                continue
+            packed, measured, error = result.get()
+            instrument.merge(measured)
+            if error is not None:
+                sys.stderr.write("Error parsing %s: %s\n" % (filename, error))
+                continue
+            if parse_cache is not None:
+                parse_cache.store(filename, input_func, get_transportation(filename), packed)
+            for path in track.unpack(packed):
+                yield path
+    finally:
+        pool.terminate()
+        pool.join()
 
 if __name__ == '__main__':
-    filter_funcs = [filters.discard_stopped_filter]
+    filter_list = [filters.DiscardStopped()]
+    processes = 1
+    sources_independent = True
+    # set for outputs that read each input file in a worker process themselves when they can
+    output_parses = False
 
     output_func = None
     output_options = {}
 
-    optlist, args = getopt(sys.argv[1:], "f:o:")
+    use_cache = True
+    rebuild_cache = False
+    cache_dir = cache.DEFAULT_DIR
+    cache_size = cache.DEFAULT_SIZE
+    tile_url = tiles.DEFAULT_URL
+    tile_cache_size = tiles.DEFAULT_SIZE
+
+    profile_format = None
+    profile_stage = None
+
+    compression = None
+    precision = None
+
+    # getopt has no options with an optional value
+    argv = ["--profile=text" if arg == "--profile" else arg for arg in sys.argv[1:]]
+    optlist, args = getopt(argv, "f:o:j:", ["distance-model=", "no-cache", "rebuild-cache", "cache-dir=", "cache-size=", "profile=", "profile-stage=", "tile-url=", "tile-cache-size=", "compress=", "precision="])
+    # read first, since outputs that use several processes are told when they are set up
+    for opt, val in optlist:
+        if opt == "-j":
+            processes = int(val)
+
     for opt, val in optlist:
-        if opt == "-f":
+        if opt == "--no-cache":
+            use_cache = False
+        elif opt == "--rebuild-cache":
+            rebuild_cache = True
+        elif opt == "--cache-dir":
+            cache_dir = val
+        elif opt == "--cache-size":
+            cache_size = int(val) << 20
+        elif opt == "--tile-cache-size":
+            tile_cache_size = int(val) << 20
+        elif opt == "--tile-url":
+            tile_url = val
+        elif opt == "--compress":
+            if val not in output.COMPRESSIONS:
+                sys.stderr.write("compression must be one of %s.\n" % ", ".join(output.COMPRESSIONS))
+                sys.exit(1)
+            compression = val
+        elif opt == "--precision":
+            precision = int(val)
+        elif opt == "--profile":
+            if val not in ['text', 'json']:
+                sys.stderr.write("profile format must be text or json.\n")
+                sys.exit(1)
+            profile_format = val
+        elif opt == "--profile-stage":
+            profile_stage = val
+        elif opt == "--distance-model":
+            if val not in utils.DISTANCE_MODELS:
+                sys.stderr.write("distance model must be one of %s.\n" % ", ".join(sorted(utils.DISTANCE_MODELS)))
+                sys.exit(1)
+            utils.distance_model = val
+        elif opt == "-f":
             if val.startswith("skip="):
                 skip = int(val[len("skip="):])
-                filter_funcs.append(filters.skip_filter(skip))
+                filter_list.append(filters.Skip(skip))
             elif val.startswith("name-match-radius="):
                 radius = int(val[len("name-match-radius="):])
-                filter_funcs.append(filters.name_match_filter(radius))
+                filter_list.append(filters.name_match_filter(radius))
+                # points are moved according to other paths, possibly from other files
+                sources_independent = False
         elif opt == "-o":
+            output_name = val.split(":")[0]
             if val.startswith("svg-map"):
                 import out_svg
                 output_func = out_svg.gen_map
@@ -30,6 +197,13 @@ if __name__ == '__main__':
                     output_objects = val[val.index(":") + 1:].split(",")
                     output_options['output_path'] = "path" in output_objects
                     output_options['output_points'] = "points" in output_objects
+                    output_options['embed_tiles'] = "embed-tiles" in output_objects
+                    for o in output_objects:
+                        if o.startswith("simplify="):
+                            if o[len("simplify="):] not in utils.SIMPLIFY_METHODS:
+                                sys.stderr.write("simplification must be one of %s.\n" % ", ".join(sorted(utils.SIMPLIFY_METHODS)))
+                                sys.exit(1)
+                            output_options['simplify'] = o[len("simplify="):]
             elif val.startswith("svg-weighted"):
                 import out_svg
                 output_func = out_svg.gen_weighted
@@ -37,6 +211,19 @@ if __name__ == '__main__':
                     output_objects = val[val.index(":") + 1:].split(",")
                     output_options['output_path'] = "path" in output_objects
                     output_options['output_points'] = "points" in output_objects
+            elif val.startswith("heatmap"):
+                import out_heatmap
+                output_func = out_heatmap.gen
+                if ":" in val:
+                    for o in val[val.index(":") + 1:].split(","):
+                        size = re.match(r"^(\d+)x(\d+)$", o)
+                        if size:
+                            output_options['width'], output_options['height'] = int(size.group(1)), int(size.group(2))
+                        elif o == "log":
+                            output_options['log'] = True
+                        else:
+                            sys.stderr.write("please pass heatmap:<width>x<height>[,log].\n")
+                            sys.exit(1)
             elif val.startswith("plot"):
                 import out_plot
                 output_func = out_plot.gen
@@ -80,10 +267,26 @@ if __name__ == '__main__':
                 import out_geojson_tiles
                 output_func = out_geojson_tiles.gen
                 options = val[val.index(":") + 1:].split(',')
-                output_options = {'min_zoom': int(options[0]), 'max_zoom': int(options[1]), 'output_path': options[2]}
+                output_options = {'min_zoom': int(options[0]), 'max_zoom': int(options[1]), 'output_path': options[2], 'processes': processes}
+                for o in options[3:]:
+                    if o in out_geojson_tiles.TILE_EXTENSIONS:
+                        output_options['tile_format'] = o
+                    elif o in utils.SIMPLIFY_METHODS:
+                        output_options['simplify'] = o
+                    else:
+                        sys.stderr.write("simplification must be one of %s, tile format one of %s.\n" % (", ".join(sorted(utils.SIMPLIFY_METHODS)), ", ".join(sorted(out_geojson_tiles.TILE_EXTENSIONS))))
+                        sys.exit(1)
             elif val.startswith("stats"):
                 import out_stats
                 output_func = out_stats.gen
+                output_options['processes'] = processes
+                output_parses = True
+                if ":" in val:
+                    output_format = val[val.index(":") + 1:]
+                    if output_format not in ['text', 'json']:
+                        sys.stderr.write("stats output format must be text or json.\n")
+                        sys.exit(1)
+                    output_options['output_format'] = output_format
             else:
                 sys.stderr.write("Invalid output.\n")
                 sys.exit(1)
@@ -92,33 +295,91 @@ if __name__ == '__main__':
         sys.stderr.write("Output not specified. Use -o (svg-map|svg-weighted|kml)[:output_options]. output_options is an enumeration of path, points.\n")
         sys.exit(1)
 
-    paths = []
+    # text outputs are written through a buffered sink, which also compresses
+    if output_name in ["svg-map", "svg-weighted", "kml", "wkt", "stats"]:
+        if compression == 'kmz' and output_name != "kml":
+            sys.stderr.write("only the kml output can be written as KMZ.\n")
+            sys.exit(1)
+        sink = output_options['out'] = output.Sink(sys.stdout, compression)
+    elif compression is not None:
+        sys.stderr.write("only text outputs can be compressed.\n")
+        sys.exit(1)
+    else:
+        sink = None
+    if precision is not None:
+        if output_name not in ["kml", "wkt"]:
+            sys.stderr.write("precision only applies to the kml and wkt outputs.\n")
+            sys.exit(1)
+        output_options['precision'] = precision
+
+    inputs = []
     for filename in args:
-        if filename.endswith(".gpx"):
+        # compressed files are read as the type of file they hold
+        name = compressed.base_name(filename)
+        if name.endswith(".gpx"):
             import in_gpx
             input_func = in_gpx.parse
-        elif filename.endswith(".kml"):
+        elif name.endswith(".kml"):
             import in_kml
             input_func = in_kml.parse
-        elif filename.endswith(".CSV"):
+        elif name.endswith(".CSV"):
             import in_columbus
             input_func = in_columbus.parse
-        elif filename.endswith(".wkt"):
+        elif name.endswith(".wkt"):
             import in_wkt
             input_func = in_wkt.parse
         else:
             sys.stderr.write("Can't guess file type from extension. filename: %s\n" % filename)
             sys.exit(1)
+        inputs.append((filename, input_func))
 
-        with file(filename) as f:
-            sys.stderr.write("parsing %s...\n" % filename)
-            m = re.match(r".*(plane|train|bus|car|motorcycle|boat|bike|walk).*", os.path.basename(filename))
-            transportation = m.group(1) if m else None
-            paths.extend(input_func(f, transportation=transportation))
+    parse_cache = cache.Cache(cache_dir, cache_size, rebuild_cache) if use_cache else None
+    tile_cache = None
+    if output_name == "svg-map":
+        output_options['tile_url'] = tile_url
+        if output_options.get('embed_tiles') and use_cache:
+            tile_cache = output_options['tile_cache'] = tiles.TileCache(os.path.join(cache_dir, "tiles"), tile_cache_size)
+    elif output_name == "geojson-tiles":
+        # tiles made through other filters have to be made again
+        output_options['filters'] = [f.name for f in filter_list]
 
-    sys.stderr.write("filtering...\n")
-    for filter_func in filter_funcs:
-        filter_func(paths)
+    if profile_stage is not None and profile_format is None:
+        profile_format = 'text'
+    profiler = instrument.current = instrument.Profile(profile_stage) if profile_format is not None else None
+
+    def read_paths(sources=None):
+        # nothing is parsed until the output asks for it; filters are chained generators on top of the parsers
+        selected = [(filename, input_func) for filename, input_func in inputs if sources is None or os.path.abspath(filename) in sources]
+        if parse_processes > 1:
+            paths = parse_parallel(selected, parse_processes, parse_cache)
+            if profiler is not None:
+                # the parsing itself happens in the workers, which measure it; this stage also counts the time spent waiting for them
+                paths = profiler.wrap("parse (%s processes)" % parse_processes, paths)
+        else:
+            parsed = (parse_file_cached(filename, input_func, parse_cache) for filename, input_func in selected)
+            if profiler is not None:
+                parsed = (profiler.wrap("parse " + filename, paths) for (filename, input_func), paths in itertools.izip(selected, parsed))
+            paths = itertools.chain.from_iterable(parsed)
+        return filters.chain(filter_list, paths, profiler.wrap if profiler is not None else None)
+
+    sources = [os.path.abspath(filename) for filename, input_func in inputs] if sources_independent else None
+    # workers can't start processes of their own
+    parse_processes = 1 if output_parses and sources is not None else processes
+    if parse_cache is not None and parse_processes < processes:
+        # the output's workers read the cache; what they would add to its index doesn't come back
+        parse_cache.prepare([(filename, input_func, get_transportation(filename)) for filename, input_func in inputs])
 
     sys.stderr.write("generating output...\n")
-    output_func(paths, **output_options)
+    try:
+        if profiler is not None:
+            profiler.call("output " + output_name, output_func, track.TrackStream(read_paths, sources), **output_options)
+            profiler.write(profile_format)
+        else:
+            output_func(track.TrackStream(read_paths, sources), **output_options)
+        if sink is not None:
+            sink.close()
+    finally:
+        if parse_cache is not None:
+            parse_cache.close()
+        if tile_cache is not None:
+            tile_cache.close()
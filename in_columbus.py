@@ -1,29 +1,184 @@
 import datetime
+import mmap
 import sys
 
+import numpy
+
+import track
 import utils
 
-def parse(fileobj, transportation):
-    path = {'transportation': transportation, 'points': []}
+# the file is decoded this many bytes (rounded to whole lines) at a time
+BLOCK_SIZE = 1 << 24
+
+def read_blocks(fileobj):
+    """Yield (block, number of its first line), each block ending with a whole line.
+    Real files are memory-mapped, anything else is read."""
+
+    line_number = 1
+    if isinstance(fileobj, file):
+        try:
+            data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError): # empty or not a regular file
+            data = None
+        if data is not None:
+            pos = 0
+            while pos < len(data):
+                end = min(pos + BLOCK_SIZE, len(data))
+                if end < len(data):
+                    newline = data.find("\n", end - 1)
+                    end = len(data) if newline == -1 else newline + 1
+                block = data[pos:end]
+                yield block, line_number
+                line_number += block.count("\n")
+                pos = end
+            data.close()
+            return
+
+    rest = ""
+    for data in iter(lambda: fileobj.read(BLOCK_SIZE), ""):
+        data = rest + data
+        end = data.rfind("\n") + 1
+        block, rest = data[:end], data[end:]
+        if block:
+            yield block, line_number
+            line_number += block.count("\n")
+    if rest:
+        yield rest, line_number
+
+def decode_numbers(values, dtype):
+    # parse a column of numbers in one go; fromstring stops at the first bad value
+    numbers = numpy.fromstring(",".join(values), dtype=dtype, sep=",")
+    return numbers if len(numbers) == len(values) else None
+
+def decode_latlon(values, positive, negative):
+    # "39.976505N" -> 39.976505, "116.332398W" -> -116.332398
+    text = ",".join(values) + ","
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    suffix = chars[numpy.flatnonzero(chars == ord(",")) - 1]
+    flip = suffix == ord(negative)
+    if len(suffix) != len(values) or not (flip | (suffix == ord(positive))).all():
+        return None
+    if text.count(positive) + text.count(negative) != len(values):
+        return None
+    numbers = numpy.fromstring(text[:-1].translate(None, positive + negative), sep=",")
+    if len(numbers) != len(values):
+        return None
+    numbers[flip] *= -1
+    return numbers
+
+def days_from_civil(y, m, d):
+    # days since 1970-01-01 of a proleptic Gregorian date, for arrays of years, months and days
+    y = y - (m <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m + numpy.where(m > 2, -3, 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def decode_digits(values):
+    # split a column of six digit values (YYMMDD or HHMMSS) into its three parts
+    text = ",".join(values)
+    if len(text) != 7 * len(values) - 1 or text.translate(None, "0123456789,") != "":
+        return None
+    chars = numpy.frombuffer(text, dtype=numpy.uint8)
+    if not (numpy.flatnonzero(chars == ord(",")) == numpy.arange(6, len(text), 7)).all():
+        return None
+    numbers = decode_numbers(values, numpy.int64)
+    return numbers // 10000, numbers // 100 % 100, numbers % 100
 
-    for i, line in enumerate(fileobj, 1):
-        parts = [p.replace("\x00", "") for p in line.split(",")]
+def decode_time(dates, times):
+    # the same as strptime(date + time, "%y%m%d%H%M%S"), as epoch time
+    date = decode_digits(dates)
+    time = decode_digits(times)
+    if date is None or time is None:
+        return None
+    year, month, day = date
+    hour, minute, second = time
+    year = numpy.where(year < 69, 2000 + year, 1900 + year)
+    if not ((month >= 1) & (month <= 12) & (day >= 1) & (hour < 24) & (minute < 60) & (second < 60)).all():
+        return None
+    days = days_from_civil(year, month, day)
+    if not (day <= days_from_civil(year + (month == 12), month % 12 + 1, 1) - days + day - 1).all():
+        return None
+    return (days * 86400 + hour * 3600 + minute * 60 + second) * track.SECOND
+
+# a block that can't be decoded at once is halved until it is this small, then read line by line
+MIN_DECODE_LINES = 1024
+
+def decode_lines(lines):
+    """Decode lines all at once, or return None if any of them doesn't look right."""
+
+    if lines and lines[0].startswith("INDEX,"): # first line, skip
+        lines = lines[1:]
+    if not lines:
+        return [numpy.zeros(0)] * 4
+    field_count = lines[0].count(",") + 1
+    if field_count < 7:
+        return None
+    fields = ",".join(lines).split(",")
+    if len(fields) != len(lines) * field_count:
+        return None
+
+    lat = decode_latlon(fields[4::field_count], "N", "S")
+    lon = decode_latlon(fields[5::field_count], "E", "W")
+    time = decode_time(fields[2::field_count], fields[3::field_count])
+    ele = decode_numbers(fields[6::field_count], numpy.int64)
+    if lat is None or lon is None or time is None or ele is None:
+        return None
+    return lat, lon, ele, time
+
+def parse_line_by_line(lines, first_line):
+    lat, lon, ele, time = [], [], [], []
+    for i, line in enumerate(lines, first_line):
+        parts = line.split(",")
 
         if parts[0] == "INDEX": # first line, skip
             continue
 
         try:
-            lat = utils.parse_latlon(parts[4])
-            lon = utils.parse_latlon(parts[5])
-            ele = int(parts[6])
-            time = datetime.datetime.strptime(parts[2] + parts[3], "%y%m%d%H%M%S")
+            point_lat = utils.parse_latlon(parts[4])
+            point_lon = utils.parse_latlon(parts[5])
+            point_ele = int(parts[6])
+            point_time = datetime.datetime.strptime(parts[2] + parts[3], "%y%m%d%H%M%S")
         except:
             sys.stderr.write("Error on line %s\n" % i)
             continue
 
-        if lat is None or lon is None:
+        if point_lat is None or point_lon is None:
             continue
 
-        path['points'].append(utils.Point(lat, lon, ele, time, None))
+        lat.append(point_lat)
+        lon.append(point_lon)
+        ele.append(point_ele)
+        time.append(track.to_epoch(point_time))
 
-    return [path]
+    return [numpy.array(lat, dtype=numpy.float64), numpy.array(lon, dtype=numpy.float64),
+            numpy.array(ele, dtype=numpy.int64), numpy.array(time, dtype=numpy.int64)]
+
+def parse_lines(lines, first_line):
+    """Decode lines in bulk; the parts with bad lines in them are read line by line,
+    reporting the lines that can't be parsed."""
+
+    columns = decode_lines(lines)
+    if columns is not None:
+        return columns
+    if len(lines) <= MIN_DECODE_LINES:
+        return parse_line_by_line(lines, first_line)
+    half = len(lines) // 2
+    return [numpy.concatenate(c) for c in zip(parse_lines(lines[:half], first_line),
+                                              parse_lines(lines[half:], first_line + half))]
+
+def parse(fileobj, transportation):
+    continues = False
+    for block, first_line in read_blocks(fileobj):
+        lines = block.replace("\x00", "").split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        lat, lon, ele, time = parse_lines(lines, first_line)
+        for start in xrange(0, len(lat), track.CHUNK_SIZE):
+            end = start + track.CHUNK_SIZE
+            yield track.Track(lat[start:end], lon[start:end], ele[start:end], time[start:end],
+                              transportation=transportation, continues=continues)
+            continues = True
+    if not continues:
+        yield track.Track([], [], transportation=transportation)
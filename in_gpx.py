@@ -1,70 +1,140 @@
+import calendar
 import datetime
-import xml.sax
-import xml.sax.handler
+import xml.parsers.expat
 
+import track
 import utils
 
-class GpxHandler(xml.sax.handler.ContentHandler):
+TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S"]
+
+class TimeParser(object):
+    """Converts GPX timestamps to epoch time (see track.SECOND).
+    ISO 8601 timestamps ("2012-05-01T08:00:00Z", optionally with fractions of a second or
+    a UTC offset) are sliced apart by hand, reusing the day from the previous point when
+    it is the same; anything else goes through strptime."""
+
+    def __init__(self):
+        self.day = None
+        self.day_epoch = None
+        self.time_format = None
+
+    def parse(self, value):
+        value = value.strip()
+        if len(value) >= 19 and value[4] == '-' and value[7] == '-' and value[10] in 'T ' and value[13] == ':' and value[16] == ':':
+            try:
+                return self.parse_iso(value)
+            except ValueError:
+                pass
+        return self.parse_slow(value)
+
+    def parse_iso(self, value):
+        day = value[:10]
+        if day != self.day:
+            self.day_epoch = calendar.timegm((int(value[:4]), int(value[5:7]), int(value[8:10]), 0, 0, 0))
+            self.day = day
+        seconds = self.day_epoch + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+        fraction = 0
+        rest = value[19:]
+        if rest[:1] == '.':
+            # kept to the microsecond, like strptime's %f
+            i = 1
+            while i < len(rest) and rest[i].isdigit():
+                i += 1
+            fraction = int(rest[1:min(i, 7)].ljust(6, '0'))
+            rest = rest[i:]
+        if rest in ('', 'Z'):
+            return seconds * track.SECOND + fraction
+        if len(rest) == 6 and rest[0] in '+-' and rest[3] == ':':
+            offset = int(rest[1:3]) * 3600 + int(rest[4:6]) * 60
+            return (seconds - offset if rest[0] == '+' else seconds + offset) * track.SECOND + fraction
+        raise ValueError(value)
+
+    def parse_slow(self, value):
+        if self.time_format is None:
+            for time_format in TIME_FORMATS:
+                try:
+                    datetime.datetime.strptime(value, time_format)
+                    self.time_format = time_format
+                    break
+                except ValueError:
+                    pass
+        if self.time_format is None:
+            raise Exception("Can't parse time.")
+        return track.to_epoch(datetime.datetime.strptime(value, self.time_format))
+
+class GpxHandler(object):
     def __init__(self, transportation):
         self.transportation = transportation
 
         self.xml_path = []
 
+        # text of the <ele>, <time> or <name> element being read, None outside of them
+        self.text = None
+
         self.point = None
         self.path = None
 
         self.paths = []
 
-        self.TIME_FORMAT = None
+        self.times = TimeParser()
 
-    def startElement(self, name, attrs):
+    def start_element(self, name, attrs):
+        parent = self.xml_path[-1] if self.xml_path else None
         self.xml_path.append(name)
 
-        if name in ['trkpt', 'rtept']:
-            self.point = {'lat': utils.parse_latlon(attrs['lat']), 'lon': utils.parse_latlon(attrs['lon'])}
-        elif name in ['trk', 'rte']:
-            self.path = {'transportation': self.transportation, 'points': []}
-
-    def characters(self, content):
-        tail = self.xml_path[-2:]
+        if name == 'trkpt' or name == 'rtept':
+            self.point = [utils.parse_latlon(attrs['lat']), utils.parse_latlon(attrs['lon']), None, None, None]
+        elif name == 'trk' or name == 'rte':
+            self.path = track.TrackBuilder(self.transportation)
+        elif parent == 'trkpt' or parent == 'rtept':
+            if name == 'ele' or name == 'time' or name == 'name':
+                self.text = []
+        elif name == 'name' and (parent == 'trk' or parent == 'rte'):
+            self.text = []
 
-        if tail == ['trkpt', 'ele'] or tail == ['rtept', 'ele']:
-            self.point['ele'] = self.point.get('ele', "") + content
-        elif tail == ['trkpt', 'time'] or tail == ['rtept', 'time']:
-            self.point['time'] = self.point.get('time', "") + content
-        elif tail == ['trkpt', 'name'] or tail == ['rtept', 'name']:
-            self.point['name'] = self.point.get('name', "") + content
-        elif tail == ['trk', 'name'] or tail == ['rte', 'name']:
-            self.path['name'] = self.path.get('name', "") + content
+    def character_data(self, content):
+        if self.text is not None:
+            self.text.append(content)
 
-    def endElement(self, name):
+    def end_element(self, name):
         self.xml_path.pop()
 
-        if name in ['trkpt', 'rtept']:
-            if 'ele' in self.point:
-                self.point['ele'] = float(self.point['ele'].strip())
-            if 'time' in self.point:
-                if self.TIME_FORMAT is None:
-                    for time_format in ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S"]:
-                        try:
-                            datetime.datetime.strptime(self.point['time'], time_format)
-                            self.TIME_FORMAT = time_format
-                        except ValueError:
-                            pass
-                if self.TIME_FORMAT is None:
-                    raise Exception("Can't parse time.")
-                self.point['time'] = datetime.datetime.strptime(self.point['time'], self.TIME_FORMAT)
-            if 'name' in self.point:
-                self.point['name'] = self.point['name'].strip()
-            self.path['points'].append(utils.Point(self.point['lat'], self.point['lon'], self.point.get('ele'), self.point.get('time'), self.point.get('name')))
+        if self.text is not None:
+            text = "".join(self.text).strip()
+            self.text = None
+            # an empty element is the same as none at all
+            if not text:
+                pass
+            elif self.point is not None:
+                if name == 'ele':
+                    self.point[2] = float(text)
+                elif name == 'time':
+                    self.point[3] = self.times.parse(text)
+                else:
+                    self.point[4] = text
+            else:
+                self.path.name = text
+        elif name == 'trkpt' or name == 'rtept':
+            self.path.append(*self.point)
+            if self.path.full():
+                self.paths.append(self.path.build())
             self.point = None
-        elif name in ['trk', 'rte']:
-            if 'name' in self.path:
-                self.path['name'] = self.path['name'].strip()
-            self.paths.append(self.path)
+        elif name == 'trk' or name == 'rte':
+            self.paths.extend(self.path.build_rest())
             self.path = None
 
 def parse(fileobj, transportation=None):
     handler = GpxHandler(transportation)
-    xml.sax.parse(fileobj, handler)
-    return handler.paths
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start_element
+    parser.EndElementHandler = handler.end_element
+    parser.CharacterDataHandler = handler.character_data
+    for data in iter(lambda: fileobj.read(utils.READ_SIZE), ""):
+        parser.Parse(data, False)
+        for path in handler.paths:
+            yield path
+        handler.paths = []
+    parser.Parse("", True)
+    for path in handler.paths:
+        yield path
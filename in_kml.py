@@ -1,42 +1,101 @@
-import datetime
 import xml.sax
 import xml.sax.handler
 
+import numpy
+
+import track
 import utils
 
+def parse_coordinates(text):
+    """Parse whitespace separated "lng,lat[,ele]" tuples into lng, lat and ele arrays
+    (ele is None for 2D tuples)."""
+
+    values = numpy.fromstring(text.replace(",", " "), sep=" ")
+    commas = text.count(",")
+    # all tuples have the same dimension unless the counts say otherwise
+    if len(values) == 3 * (len(values) - commas) and commas:
+        values = values.reshape(-1, 3)
+        return values[:, 0], values[:, 1], values[:, 2]
+    if len(values) == 2 * commas:
+        values = values.reshape(-1, 2)
+        return values[:, 0], values[:, 1], None
+
+    lng, lat, ele = [], [], []
+    for p in text.split():
+        coordinates = map(float, p.split(","))
+        lng.append(coordinates[0])
+        lat.append(coordinates[1])
+        ele.append(coordinates[2] if len(coordinates) > 2 else numpy.nan)
+    return lng, lat, ele
+
 class KmlHandler(xml.sax.handler.ContentHandler):
     def __init__(self, transportation):
         self.transportation = transportation
 
         self.xml_path = []
 
-        self.point = None
+        # pieces of <coordinates> text that haven't been parsed yet, None outside of the element
+        self.coordinates = None
+        self.coordinates_size = 0
         self.path = None
 
         self.paths = []
 
     def startElement(self, name, attrs):
+        if name == 'coordinates' and self.xml_path[-1:] in (['LineString'], ['LinearRing']):
+            self.coordinates = []
+            self.coordinates_size = 0
+
         self.xml_path.append(name)
 
         if name in ['LineString', 'LinearRing']:
-            self.path = {'transportation': self.transportation, 'points': []}
+            self.path = track.TrackBuilder(self.transportation)
 
     def characters(self, content):
-        tail = self.xml_path[-2:]
-        content = content.strip()
-        if not content:
+        if self.coordinates is None:
             return
-        if tail == ['LineString', 'coordinates'] or tail == ['LinearRing', 'coordinates']:
-            self.path['points'] = [utils.Point(lat, lng, ele, None, None) for lng, lat, ele in [map(float, p.split(",")) for p in content.strip().split(" ")]]
+        self.coordinates.append(content.encode("utf-8"))
+        self.coordinates_size += len(content)
+        if self.coordinates_size >= utils.READ_SIZE:
+            # parse what has been collected, except for a tuple that may not be complete yet
+            text = "".join(self.coordinates)
+            end = max(text.rfind(" "), text.rfind("\n"), text.rfind("\t"), text.rfind("\r")) + 1
+            self.coordinates = [text[end:]]
+            self.coordinates_size = len(text) - end
+            if text[:end].strip():
+                self.add_coordinates(text[:end])
+
+    def add_coordinates(self, text):
+        lng, lat, ele = parse_coordinates(text)
+        start = 0
+        while start < len(lat):
+            end = start + track.CHUNK_SIZE - len(self.path)
+            self.path.extend(lat[start:end], lng[start:end], ele[start:end] if ele is not None else None)
+            if self.path.full():
+                self.paths.append(self.path.build())
+            start = end
 
     def endElement(self, name):
         self.xml_path.pop()
 
-        if name in ['LineString', 'LinearRing']:
-            self.paths.append(self.path)
+        if name == 'coordinates' and self.coordinates is not None:
+            text = "".join(self.coordinates)
+            if text.strip():
+                self.add_coordinates(text)
+            self.coordinates = None
+        elif name in ['LineString', 'LinearRing']:
+            self.paths.extend(self.path.build_rest())
             self.path = None
 
 def parse(fileobj, transportation=None):
     handler = KmlHandler(transportation)
-    xml.sax.parse(fileobj, handler)
-    return handler.paths
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+    for data in iter(lambda: fileobj.read(utils.READ_SIZE), ""):
+        parser.feed(data)
+        for path in handler.paths:
+            yield path
+        handler.paths = []
+    parser.close()
+    for path in handler.paths:
+        yield path
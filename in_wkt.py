@@ -1,28 +1,236 @@
-import sys
+import re
 
-import utils
+import numpy
 
-from shapely import wkt
+import track
 
-def parse(fileobj, transportation):
-    paths = []
+# the file is read this many bytes at a time, and coordinates not closed by then are parsed
+BLOCK_SIZE = 1 << 24
+
+GEOMETRY_TYPES = set(["POINT", "LINESTRING", "LINEARRING", "POLYGON", "MULTIPOINT", "MULTILINESTRING", "MULTIPOLYGON", "GEOMETRYCOLLECTION"])
+DIMENSIONS = set(["Z", "M", "ZM"])
+
+# what the parentheses inside a geometry hold, for geometries whose members aren't named
+MEMBERS = {"POLYGON": "LINESTRING", "MULTIPOLYGON": "POLYGON", "MULTILINESTRING": "LINESTRING", "MULTIPOINT": "POINT"}
+# geometries with coordinates right inside their parentheses
+COORDINATE_TYPES = set(["POINT", "LINESTRING", "LINEARRING", "MULTIPOINT"])
+
+PARENS = re.compile(r"([()])")
+WORD = re.compile(r"[A-Za-z]+")
+SEPARATORS = " \t\r\n,"
+
+def pieces(fileobj):
+    """Split the text at parentheses, yielding "(", ")" and the text in between.
+    Text running across blocks comes in several pieces."""
+
+    for block in iter(lambda: fileobj.read(BLOCK_SIZE), ""):
+        for piece in PARENS.split(block):
+            if piece:
+                yield piece
+
+def geometry_type(word):
+    # "POINTZ" -> ("POINT", "Z")
+    if word in GEOMETRY_TYPES:
+        return word, None
+    for dims in ["ZM", "Z", "M"]:
+        if word.endswith(dims) and word[:-len(dims)] in GEOMETRY_TYPES:
+            return word[:-len(dims)], dims
+    return word, None
+
+def named_geometry(text):
+    """Return the geometry named in the text before a "(": (type, dimensions, where the name starts),
+    or None. Types other than GEOMETRY_TYPES are returned as they are, for shapely to read."""
+
+    geometry = None
+    for m in WORD.finditer(text):
+        word = m.group().upper()
+        if word in DIMENSIONS and geometry is not None:
+            geometry = geometry[0], word, geometry[2]
+        elif word == "EMPTY":
+            geometry = None
+        elif word != "SRID":
+            geometry = geometry_type(word) + (m.start(),)
+    return geometry
+
+def parse_coordinates(text, dims):
+    """Parse "x y[ z[ m]], ..." into lon, lat and ele arrays."""
+
+    count = text.count(",") + 1
+    first = text[:text.find(",")] if count > 1 else text
+    width = len(first.split())
+    numbers = numpy.fromstring(text.replace(",", " "), sep=" ")
+    if not 2 <= width <= 4 or len(numbers) != width * count:
+        raise ValueError("bad coordinates: %s" % text.strip()[:80])
+    coordinates = numbers.reshape(count, width)
+    if width == 4 or width == 3 and dims != "M":
+        ele = coordinates[:, 2]
+    else:
+        ele = numpy.full(count, numpy.nan)
+    return coordinates[:, 0], coordinates[:, 1], ele
+
+class PathBuilder(object):
+    """Gathers the coordinates of a path, handing them out as tracks of CHUNK_SIZE points."""
+
+    def __init__(self, transportation):
+        self.transportation = transportation
+        self.parts = []
+        self.size = 0
+        self.continues = False
+
+    def add(self, lon, lat, ele):
+        self.parts.append((lon, lat, ele))
+        self.size += len(lon)
+        return self.tracks() if self.size >= track.CHUNK_SIZE else []
+
+    def finish(self):
+        return self.tracks(True) if self.size else []
 
-    shape = wkt.loads(fileobj.read())
+    def tracks(self, final=False):
+        lon, lat, ele = [numpy.concatenate(column) for column in zip(*self.parts)]
+        end = len(lon) if final else len(lon) - len(lon) % track.CHUNK_SIZE
+        tracks = []
+        for start in xrange(0, end, track.CHUNK_SIZE):
+            chunk = slice(start, min(start + track.CHUNK_SIZE, end))
+            tracks.append(track.Track(lat[chunk], lon[chunk], ele[chunk], transportation=self.transportation, continues=self.continues))
+            self.continues = True
+        self.parts = [(lon[end:], lat[end:], ele[end:])]
+        self.size = len(lon) - end
+        return tracks
+
+def shape_coordinates(shape):
+    # lon, lat and ele arrays of every path of a shapely geometry
+    if shape.geom_type == "MultiPoint":
+        points = [numpy.asarray(point.coords) for point in shape.geoms]
+        coordinates = [numpy.concatenate(points)] if points else []
+    elif hasattr(shape, "geoms"):
+        coordinates = []
+        for member in shape.geoms:
+            coordinates.extend(shape_coordinates(member))
+        return coordinates
+    elif hasattr(shape, "exterior"):
+        coordinates = [numpy.asarray(ring.coords) for ring in [shape.exterior] + list(shape.interiors)]
+    else:
+        coordinates = [numpy.asarray(shape.coords)]
+    return [(c[:, 0], c[:, 1], c[:, 2] if c.shape[1] > 2 else numpy.full(len(c), numpy.nan)) for c in coordinates if len(c)]
+
+def parse_shapely(text, transportation):
+    """Read a geometry this module doesn't know with shapely, if it's installed."""
 
     try:
-      list(shape)
-    except:
-      shape = [shape]
-
-    for polygon in shape:
-      path = {'transportation': transportation}
-      points = []
-      xy = polygon.exterior.xy
-      x = [x for x in xy[0]]
-      y = [y for y in xy[1]]
-      for y, x in zip(y, x):
-        points.append(utils.Point(y, x, None, None, None))
-      path['points'] = points
-      paths.append(path)
-
-    return paths
+        from shapely import wkt
+    except ImportError:
+        raise ValueError("can't read %s without shapely" % text.split("(")[0].strip())
+    tracks = []
+    for lon, lat, ele in shape_coordinates(wkt.loads(text)):
+        path = PathBuilder(transportation)
+        tracks.extend(path.add(lon, lat, ele))
+        tracks.extend(path.finish())
+    return tracks
+
+class Reader(object):
+    """Goes through the pieces of the text keeping the geometries whose parentheses are open.
+    Every linestring and every ring of a polygon is a path; so are the points of a point or a multipoint.
+    open(), close() and add_text() return the tracks that are complete."""
+
+    def __init__(self, transportation):
+        self.transportation = transportation
+        # (type, dimensions) of every open parenthesis
+        self.stack = []
+        self.text = []
+        self.text_size = 0
+        self.path = None
+        self.path_depth = None
+        # text of a geometry for shapely, and the depth it started at
+        self.foreign = None
+        self.foreign_depth = None
+
+    def take_text(self):
+        text = "".join(self.text)
+        self.text = []
+        self.text_size = 0
+        return text
+
+    def open(self):
+        text = self.take_text()
+        if self.foreign is not None:
+            self.foreign.append(text + "(")
+            self.stack.append(None)
+            return []
+
+        parent = self.stack[-1] if self.stack else None
+        named = named_geometry(text)
+        if parent is None or parent[0] == "GEOMETRYCOLLECTION":
+            if named is None:
+                raise ValueError("expected a geometry before \"(\": %s" % text.strip()[:80])
+            geometry, dims, start = named
+            dims = dims or (parent[1] if parent else None)
+            if geometry not in GEOMETRY_TYPES:
+                self.foreign = [text[start:], "("]
+                self.foreign_depth = len(self.stack)
+                self.stack.append(None)
+                return []
+        else:
+            if parent[0] not in MEMBERS or text.strip(SEPARATORS):
+                raise ValueError("unexpected \"(\" in %s: %s" % (parent[0], text.strip()[:80]))
+            geometry, dims = MEMBERS[parent[0]], parent[1]
+
+        self.stack.append((geometry, dims))
+        # the points of a multipoint go in its path
+        if self.path is None and geometry in COORDINATE_TYPES:
+            self.path = PathBuilder(self.transportation)
+            self.path_depth = len(self.stack)
+        return []
+
+    def close(self):
+        text = self.take_text()
+        if not self.stack:
+            raise ValueError("unbalanced \")\"")
+        geometry = self.stack.pop()
+        if self.foreign is not None:
+            self.foreign.append(text + ")")
+            if len(self.stack) > self.foreign_depth:
+                return []
+            foreign, self.foreign = self.foreign, None
+            return parse_shapely("".join(foreign), self.transportation)
+
+        tracks = []
+        if geometry[0] in COORDINATE_TYPES and text.strip(SEPARATORS):
+            tracks.extend(self.path.add(*parse_coordinates(text, geometry[1])))
+        elif text.strip(SEPARATORS):
+            raise ValueError("unexpected text in %s: %s" % (geometry[0], text.strip()[:80]))
+        if self.path is not None and len(self.stack) < self.path_depth:
+            tracks.extend(self.path.finish())
+            self.path = self.path_depth = None
+        return tracks
+
+    def add_text(self, piece):
+        self.text.append(piece)
+        self.text_size += len(piece)
+        # very long coordinate lists are parsed as they come
+        if self.text_size < BLOCK_SIZE or self.foreign is not None or not self.stack or self.stack[-1][0] not in COORDINATE_TYPES:
+            return []
+        text = self.take_text()
+        end = text.rfind(",")
+        if end == -1:
+            self.text, self.text_size = [text], len(text)
+            return []
+        self.text, self.text_size = [text[end + 1:]], len(text) - end - 1
+        return self.path.add(*parse_coordinates(text[:end], self.stack[-1][1]))
+
+    def finish(self):
+        # only geometries without parentheses, like "POINT EMPTY", may be left
+        if self.stack or named_geometry(self.take_text()) is not None:
+            raise ValueError("unexpected end of input")
+
+def parse(fileobj, transportation):
+    reader = Reader(transportation)
+    for piece in pieces(fileobj):
+        if piece == "(":
+            tracks = reader.open()
+        elif piece == ")":
+            tracks = reader.close()
+        else:
+            tracks = reader.add_text(piece)
+        for t in tracks:
+            yield t
+    reader.finish()
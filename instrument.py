@@ -0,0 +1,208 @@
+"""Time, throughput and memory of the stages glot runs through: parsing each input file,
+each filter and the output.
+
+Stages are generators pulling tracks from each other, so the time spent getting a track
+from a stage includes the time of the stages before it. Every stage also records the time
+spent in the stages it pulls from, which is taken off to get the time of the stage itself;
+"wall" and "cpu" are that time, and points/s the points the stage went through
+(points it got, or for parsers the points it produced) per second of it.
+Peak RSS is the largest the process had been when the stage last produced something.
+
+Stages run by worker processes (with -j) are measured there and added to the same stages
+of the main process: their times add up over the processes, and the stage that started the
+workers also counts the time it waited for them."""
+
+import cProfile
+import json
+import pstats
+import resource
+import sys
+import time
+
+# the number of functions listed for a stage run under cProfile
+PROFILE_TOP = 25
+
+# the Profile of the run, if it is profiled, for worker processes to measure themselves with
+current = None
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def max_rss_mb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def in_worker(func, *args):
+    """Call <func> in a worker process. Returns what it returns and what was measured meanwhile,
+    to be passed to merge() in the main process (None when the run isn't profiled)."""
+
+    if current is None:
+        return func(*args), None
+    return current.worker(func, *args)
+
+def merge(measured):
+    if current is not None and measured is not None:
+        current.merge(measured)
+
+class WorkerProfile(object):
+    # what pstats reads the functions profiled in a worker process from
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.wall = self.cpu = 0.0
+        # time spent in the stages this one pulls from
+        self.inner_wall = self.inner_cpu = 0.0
+        self.points_in = self.points_out = 0
+        self.max_rss = 0.0
+
+    def to_dict(self):
+        wall = self.wall - self.inner_wall
+        points = self.points_in or self.points_out
+        return {'stage': self.name, 'wall_s': wall, 'cpu_s': self.cpu - self.inner_cpu,
+                'points_in': self.points_in, 'points_out': self.points_out,
+                'points_per_s': points / wall if wall > 0 else None, 'max_rss_mb': self.max_rss}
+
+class Profile(object):
+    """Stats of all stages, by name. A stage that runs several times (outputs going over the
+    input more than once) adds up. <profile_stage> names the stages run under cProfile:
+    those whose names start with it."""
+
+    def __init__(self, profile_stage=None):
+        self.stages = []
+        self.by_name = {}
+        self.running = []
+        self.profile_stage = profile_stage
+        self.profiler = cProfile.Profile() if profile_stage is not None else None
+        self.profiled = False
+        self.profiler_used = False
+        self.worker_profiles = []
+
+    def stats(self, name):
+        if name not in self.by_name:
+            self.by_name[name] = StageStats(name)
+            self.stages.append(self.by_name[name])
+        return self.by_name[name]
+
+    def profiles(self, name):
+        # stages already running under the profiler don't start it again
+        return self.profiler is not None and not self.profiled and name.startswith(self.profile_stage)
+
+    def enter(self, stats):
+        profiled = self.profiles(stats.name)
+        if profiled:
+            self.profiler.enable()
+            self.profiled = self.profiler_used = True
+        self.running.append(stats)
+        return time.time(), cpu_time(), profiled
+
+    def leave(self, stats, started, points=None):
+        start_wall, start_cpu, profiled = started
+        wall = time.time() - start_wall
+        cpu = cpu_time() - start_cpu
+        self.running.pop()
+        if profiled:
+            self.profiler.disable()
+            self.profiled = False
+        stats.wall += wall
+        stats.cpu += cpu
+        stats.max_rss = max_rss_mb()
+        if points is not None:
+            stats.points_out += points
+        if self.running:
+            outer = self.running[-1]
+            outer.inner_wall += wall
+            outer.inner_cpu += cpu
+            if points is not None:
+                outer.points_in += points
+
+    def wrap(self, name, paths):
+        """Measure a stage producing <paths>."""
+
+        return self.measure(self.stats(name), iter(paths))
+
+    def measure(self, stats, paths):
+        while True:
+            started = self.enter(stats)
+            try:
+                path = next(paths)
+            except StopIteration:
+                self.leave(stats, started)
+                return
+            except:
+                self.leave(stats, started)
+                raise
+            self.leave(stats, started, len(path))
+            yield path
+
+    def call(self, name, func, *args, **kwargs):
+        """Measure a stage that is a function call, like the output."""
+
+        stats = self.stats(name)
+        started = self.enter(stats)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.leave(stats, started)
+
+    def worker(self, func, *args):
+        """Call <func> in a worker process, as part of the stage that was running when the
+        process was started. The stats measured before are the main process's, so they are
+        dropped first; what is measured is returned with the result, for merge()."""
+
+        self.stages = []
+        self.by_name = {}
+        if self.profiler is not None:
+            # the main process may have been profiling when the worker was started
+            self.profiler.disable()
+            self.profiler = cProfile.Profile()
+            self.profiled = self.profiler_used = False
+        if self.running:
+            result = self.call(self.running[-1].name, func, *args)
+        else:
+            result = func(*args)
+        profile = None
+        if self.profiler_used:
+            self.profiler.create_stats()
+            profile = self.profiler.stats
+        return result, ([stats.__dict__ for stats in self.stages], profile)
+
+    def merge(self, measured):
+        """Add what a worker process measured to the stages of the same names."""
+
+        records, profile = measured
+        for record in records:
+            stats = self.stats(record['name'])
+            for field in ['wall', 'cpu', 'inner_wall', 'inner_cpu', 'points_in', 'points_out']:
+                setattr(stats, field, getattr(stats, field) + record[field])
+            stats.max_rss = max(stats.max_rss, record['max_rss'])
+        if profile is not None:
+            self.worker_profiles.append(WorkerProfile(profile))
+
+    def write(self, output_format='text', out=sys.stderr):
+        # in the order the points go through them; filters are set up in that order
+        order = ["parse", "filter", "output"]
+        stages = [stats.to_dict() for stats in sorted(self.stages, key=lambda stats: order.index(stats.name.split()[0]))]
+        if output_format == 'json':
+            json.dump({'stages': stages}, out, indent=2)
+            out.write("\n")
+        else:
+            out.write("%-40s%10s%10s%12s%12s%12s%10s\n" % ("stage", "wall s", "cpu s", "points in", "points out", "points/s", "peak MB"))
+            for stage in stages:
+                out.write("%-40s%10.3f%10.3f%12d%12d%12s%10.0f\n" % (stage['stage'], stage['wall_s'], stage['cpu_s'], stage['points_in'], stage['points_out'],
+                                                                   "%.0f" % stage['points_per_s'] if stage['points_per_s'] is not None else "-", stage['max_rss_mb']))
+        profiles = ([self.profiler] if self.profiler_used else []) + self.worker_profiles
+        if profiles:
+            out.write("\ncProfile of %s (including the stages it pulls from):\n" % self.profile_stage)
+            stats = pstats.Stats(profiles[0], stream=out)
+            if len(profiles) > 1:
+                stats.add(*profiles[1:])
+            stats.sort_stats('tottime').print_stats(PROFILE_TOP)
+        elif self.profiler is not None:
+            out.write("\nno stage named %s to profile.\n" % self.profile_stage)
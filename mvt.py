@@ -0,0 +1,285 @@
+"""Mapbox Vector Tiles (https://github.com/mapbox/vector-tile-spec, version 2) for paths,
+written and read without any protobuf library.
+
+A tile has one layer, "paths", with a LINESTRING feature per path going through the tile.
+Coordinates are quantized to a grid of EXTENT x EXTENT units over the tile and stored as
+zigzag encoded deltas, so a point usually takes 2 to 4 bytes instead of about 40 in GeoJSON.
+
+Run as "python mvt.py <dir>" to compare the size and speed of the JSON tiles in <dir>
+(written by the geojson-tiles output) with the same tiles in this format."""
+
+import glob
+import json
+import math
+import os
+import sys
+import time
+import zlib
+
+import numpy
+
+EXTENT = 4096
+LAYER_NAME = "paths"
+LINESTRING = 2
+
+MOVE_TO = 1
+LINE_TO = 2
+
+# protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+def varint(value):
+    data = []
+    while value > 0x7f:
+        data.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    data.append(chr(value))
+    return "".join(data)
+
+# smallest values that need 2, 3, ... bytes as varints
+VARINT_LIMITS = numpy.array([1 << shift for shift in xrange(7, 64, 7)], dtype=numpy.uint64)
+
+def varint_sizes(values):
+    return numpy.searchsorted(VARINT_LIMITS, values, side='right') + 1
+
+def varints(values, sizes=None):
+    """Encode an array of non-negative integers as consecutive varints."""
+
+    values = numpy.asarray(values, dtype=numpy.uint64)
+    if not len(values):
+        return ""
+    if sizes is None:
+        sizes = varint_sizes(values)
+    offsets = numpy.concatenate([[0], numpy.cumsum(sizes)[:-1]])
+    data = numpy.zeros(int(sizes.sum()), dtype=numpy.uint8)
+    for group in xrange(int(sizes.max())):
+        has = sizes > group
+        bits = (values[has] >> numpy.uint64(7 * group)) & numpy.uint64(0x7f)
+        more = numpy.where(sizes[has] > group + 1, 0x80, 0).astype(numpy.uint64)
+        data[offsets[has] + group] = (bits | more).astype(numpy.uint8)
+    return data.tostring()
+
+def read_varints(data):
+    """Decode a string of consecutive varints into an array."""
+
+    data = numpy.frombuffer(data, dtype=numpy.uint8)
+    if not len(data):
+        return numpy.zeros(0, dtype=numpy.uint64)
+    ends = numpy.flatnonzero(data < 0x80)
+    starts = numpy.concatenate([[0], ends[:-1] + 1])
+    group = numpy.arange(len(data)) - numpy.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7f).astype(numpy.uint64) << (7 * group).astype(numpy.uint64)
+    return numpy.add.reduceat(parts, starts)
+
+def zigzag(values):
+    values = numpy.asarray(values, dtype=numpy.int64)
+    return ((values << 1) ^ (values >> 63)).astype(numpy.uint64)
+
+def unzigzag(values):
+    values = numpy.asarray(values, dtype=numpy.uint64)
+    return (values >> numpy.uint64(1)).astype(numpy.int64) ^ -(values & numpy.uint64(1)).astype(numpy.int64)
+
+def key(field, wire_type):
+    return varint(field << 3 | wire_type)
+
+def length_delimited(field, data):
+    return key(field, LENGTH_DELIMITED) + varint(len(data)) + data
+
+def read_message(data):
+    """Yield (field, wire type, value) for the fields of a protobuf message;
+    varints are decoded, other values are left as strings."""
+
+    pos = 0
+    while pos < len(data):
+        field_key, pos = read_varint(data, pos)
+        field, wire_type = field_key >> 3, field_key & 0x7
+        if wire_type == VARINT:
+            value, pos = read_varint(data, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            size, pos = read_varint(data, pos)
+            value, pos = data[pos:pos + size], pos + size
+        elif wire_type == FIXED64:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == FIXED32:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError("Unsupported wire type %s." % wire_type)
+        yield field, wire_type, value
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def tile_coordinates(lon, lat, zoom, tile_x, tile_y, extent=EXTENT):
+    """Project points to integer coordinates on the tile's grid (0, 0 is the top left corner)."""
+
+    n = 2.0 ** zoom
+    lat = numpy.radians(lat)
+    x = (numpy.asarray(lon) + 180.0) / 360.0 * n
+    y = (1.0 - numpy.log(numpy.tan(lat) + (1 / numpy.cos(lat))) / math.pi) / 2.0 * n
+    return (numpy.round((x - tile_x) * extent).astype(numpy.int64),
+            numpy.round((y - tile_y) * extent).astype(numpy.int64))
+
+def tile_lonlat(x, y, zoom, tile_x, tile_y, extent=EXTENT):
+    """The inverse of tile_coordinates."""
+
+    n = 2.0 ** zoom
+    lon = (tile_x + numpy.asarray(x, dtype=numpy.float64) / extent) / n * 360.0 - 180.0
+    lat = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1 - 2 * (tile_y + numpy.asarray(y, dtype=numpy.float64) / extent) / n))))
+    return lon, lat
+
+def encode_tile(zoom, tile_x, tile_y, lines, extent=EXTENT):
+    """Encode a tile with one feature for each (lon, lat) pair of arrays in <lines>.
+    Consecutive points that fall on the same grid unit are merged; lines that end up
+    with a single point are left out, as the format requires two."""
+
+    features = []
+    if lines:
+        lon = numpy.concatenate([line_lon for line_lon, line_lat in lines])
+        lat = numpy.concatenate([line_lat for line_lon, line_lat in lines])
+        line_ids = numpy.repeat(numpy.arange(len(lines)), [len(line_lon) for line_lon, line_lat in lines])
+        x, y = tile_coordinates(lon, lat, zoom, tile_x, tile_y, extent)
+
+        starts = numpy.concatenate([[True], line_ids[1:] != line_ids[:-1]])
+        moved = starts.copy()
+        moved[1:] |= (x[1:] != x[:-1]) | (y[1:] != y[:-1])
+        x, y, line_ids, starts = x[moved], y[moved], line_ids[moved], starts[moved]
+        counts = numpy.bincount(line_ids, minlength=len(lines))
+        drawn = (counts >= 2)[line_ids]
+        x, y, line_ids, starts = x[drawn], y[drawn], line_ids[drawn], starts[drawn]
+        counts = counts[counts >= 2]
+
+        if len(counts):
+            # each line is a MoveTo to its first point and a LineTo through the others, with the
+            # coordinates as deltas from the previous point; the cursor starts at 0, 0 in every feature
+            dx = numpy.diff(numpy.concatenate([[0], x]))
+            dy = numpy.diff(numpy.concatenate([[0], y]))
+            dx[starts] = x[starts]
+            dy[starts] = y[starts]
+
+            sizes = 2 * counts + 2
+            line_offsets = numpy.concatenate([[0], numpy.cumsum(sizes)[:-1]])
+            commands = numpy.zeros(int(sizes.sum()), dtype=numpy.uint64)
+            commands[line_offsets] = MOVE_TO | 1 << 3
+            commands[line_offsets + 3] = (LINE_TO | (counts - 1) << 3).astype(numpy.uint64)
+            # the first point goes right after MoveTo, the others after LineTo
+            point_offsets = numpy.repeat(line_offsets, counts) + 1 + 2 * (numpy.arange(len(x)) - numpy.repeat(numpy.cumsum(counts) - counts, counts))
+            point_offsets[~starts] += 1
+            commands[point_offsets] = zigzag(dx)
+            commands[point_offsets + 1] = zigzag(dy)
+
+            command_sizes = varint_sizes(commands)
+            data = varints(commands, command_sizes)
+            byte_ends = numpy.cumsum(numpy.add.reduceat(command_sizes, line_offsets)).tolist()
+            start = 0
+            for end in byte_ends:
+                feature = key(3, VARINT) + varint(LINESTRING) + length_delimited(4, data[start:end])
+                features.append(length_delimited(2, feature))
+                start = end
+
+    layer = (length_delimited(1, LAYER_NAME) + "".join(features) +
+             key(5, VARINT) + varint(extent) + key(15, VARINT) + varint(2))
+    return length_delimited(3, layer)
+
+def decode_geometry(commands):
+    """Turn the commands of a LINESTRING feature into a list of (x, y) arrays."""
+
+    lines = []
+    x = y = 0
+    i = 0
+    while i < len(commands):
+        command, count = int(commands[i]) & 0x7, int(commands[i]) >> 3
+        deltas = unzigzag(commands[i + 1:i + 1 + 2 * count]).reshape(-1, 2)
+        i += 1 + 2 * count
+        xs = x + numpy.cumsum(deltas[:, 0])
+        ys = y + numpy.cumsum(deltas[:, 1])
+        if count:
+            x, y = int(xs[-1]), int(ys[-1])
+        if command == MOVE_TO:
+            lines.append((xs, ys))
+        elif command == LINE_TO:
+            lines[-1] = (numpy.concatenate([lines[-1][0], xs]), numpy.concatenate([lines[-1][1], ys]))
+        else:
+            raise ValueError("Unexpected command %s in a line." % command)
+    return lines
+
+def decode_tile(data):
+    """Decode a tile into a list of layers, each a dict with name, extent and features.
+    Features are dicts with type and geometry, a list of (x, y) arrays of grid coordinates."""
+
+    layers = []
+    for field, wire_type, value in read_message(data):
+        if field != 3:
+            continue
+        layer = {'name': None, 'extent': EXTENT, 'features': []}
+        for layer_field, layer_wire_type, layer_value in read_message(value):
+            if layer_field == 1:
+                layer['name'] = layer_value
+            elif layer_field == 5:
+                layer['extent'] = layer_value
+            elif layer_field == 2:
+                feature = {'type': None, 'geometry': []}
+                for feature_field, feature_wire_type, feature_value in read_message(layer_value):
+                    if feature_field == 3:
+                        feature['type'] = feature_value
+                    elif feature_field == 4:
+                        feature['geometry'] = decode_geometry(read_varints(feature_value))
+                layer['features'].append(feature)
+        layers.append(layer)
+    return layers
+
+def compare(tile_dir):
+    json_size = json_gzip_size = mvt_size = mvt_gzip_size = points = 0
+    json_encode_time = json_decode_time = mvt_encode_time = mvt_decode_time = 0.0
+
+    filenames = glob.glob(os.path.join(tile_dir, "*_*_*.json"))
+    for filename in filenames:
+        zoom, tile_x, tile_y = map(int, os.path.basename(filename)[:-len(".json")].split("_"))
+        with file(filename) as f:
+            content = f.read()
+
+        t = time.time()
+        features = json.loads(content)
+        json_decode_time += time.time() - t
+        t = time.time()
+        json.dumps(features)
+        json_encode_time += time.time() - t
+
+        lines = []
+        for feature in features:
+            coordinates = numpy.array(feature['geometry']['coordinates'], dtype=numpy.float64).reshape(-1, 2)
+            lines.append((coordinates[:, 0], coordinates[:, 1]))
+            points += len(coordinates)
+
+        t = time.time()
+        tile = encode_tile(zoom, tile_x, tile_y, lines)
+        mvt_encode_time += time.time() - t
+        t = time.time()
+        decode_tile(tile)
+        mvt_decode_time += time.time() - t
+
+        json_size += len(content)
+        json_gzip_size += len(zlib.compress(content, 6))
+        mvt_size += len(tile)
+        mvt_gzip_size += len(zlib.compress(tile, 6))
+
+    print "%s tiles, %s points" % (len(filenames), points)
+    print "%-6s%14s%14s%16s%16s" % ("", "bytes", "compressed", "encode pts/s", "decode pts/s")
+    for name, size, gzip_size, encode_time, decode_time in [("json", json_size, json_gzip_size, json_encode_time, json_decode_time),
+                                                            ("mvt", mvt_size, mvt_gzip_size, mvt_encode_time, mvt_decode_time)]:
+        print "%-6s%14d%14d%16d%16d" % (name, size, gzip_size, points / max(encode_time, 1e-9), points / max(decode_time, 1e-9))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.stderr.write("usage: python mvt.py <geojson tile dir>\n")
+        sys.exit(1)
+    compare(sys.argv[1])
@@ -1,38 +1,211 @@
-from collections import defaultdict
+from collections import deque
+import hashlib
 import math
+import multiprocessing
 import os
 import json
 
+import numpy
+
+import cache
+import mvt
+import track
 import utils
 
+MANIFEST_NAME = "manifest.json"
+
+TILE_EXTENSIONS = {'json': ".json", 'mvt': ".mvt"}
+
+# tiles are handed to worker processes in batches of about this many points
+BATCH_POINTS = 1 << 16
+
 def epsilon_for_zoom(zoom, lat):
     # from http://wiki.openstreetmap.org/wiki/Zoom_levels (metres per pixel)
     return 40075000 * math.cos(math.radians(lat)) / (2 ** (zoom + 8))
 
-def decorate_path_with_xy(path):
-    decorated = []
-    for p in path:
-        x, y = utils.latlng_to_xy(p.lat, p.lon)
-        decorated.append({'lat': p.lat, 'lon': p.lon, 'x': x, 'y': y})
-    return decorated
-
-def gen_for_zoom(paths, zoom, output_path):
-    tiles = defaultdict(lambda: defaultdict(list))
-    for i, path in enumerate(paths):
-        for point in path['points']:
-            tile_x, tile_y = utils.osm_get_tile_xy(point.lat, point.lon, zoom)
-            tiles[(zoom, tile_x, tile_y)][i].append(point)
-    for tile_key, tile_paths in tiles.iteritems():
-        geojson_features = []
-        for path_key, path in tile_paths.iteritems():
-            path = decorate_path_with_xy(path)
-            avg_lat = sum(p['lat'] for p in path) / len(path)
-            epsilon = epsilon_for_zoom(zoom, avg_lat)
-            path = utils.simplify(path, epsilon)
-            geojson_features.append({'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': [(p['lon'], p['lat']) for p in path]}})
-        with file(os.path.join(output_path, "%s_%s_%s.json" % (tile_key)), 'w') as f:
-            json.dump(geojson_features, f)
-
-def gen(paths, min_zoom, max_zoom, output_path):
+def tile_name(zoom, tile_x, tile_y):
+    return "%s_%s_%s" % (zoom, tile_x, tile_y)
+
+def tile_filename(output_path, name, tile_format):
+    return os.path.join(output_path, name + TILE_EXTENSIONS[tile_format])
+
+def write_tile(job):
+    """Simplify and write one tile, unless the file already has the same contents.
+    Returns the tile name and the SHA-1 of its contents."""
+
+    output_path, zoom, tile_x, tile_y, simplify, tile_format, parts, old_digest = job
+    lines = []
+    for lat, lon in parts:
+        x, y = utils.latlng_to_xy(lat, lon)
+        epsilon = epsilon_for_zoom(zoom, lat.mean())
+        kept = utils.simplify(x, y, epsilon, simplify)
+        lines.append((lon[kept], lat[kept]))
+    if tile_format == 'mvt':
+        content = mvt.encode_tile(zoom, tile_x, tile_y, lines)
+    else:
+        # dumps goes through the C encoder, dump doesn't
+        content = json.dumps([{'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': zip(lon.tolist(), lat.tolist())}}
+                              for lon, lat in lines])
+    digest = hashlib.sha1(content).hexdigest()
+    name = tile_name(zoom, tile_x, tile_y)
+    filename = tile_filename(output_path, name, tile_format)
+    if digest != old_digest or not os.path.exists(filename):
+        with file(filename, 'w') as f:
+            f.write(content)
+    return name, digest
+
+def write_tiles(jobs):
+    # runs in a worker process
+    return [write_tile(job) for job in jobs]
+
+def batches(jobs):
+    batch = []
+    size = 0
+    for job in jobs:
+        batch.append(job)
+        size += sum(len(lat) for lat, lon in job[-2])
+        if size >= BATCH_POINTS:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+def tile_parts(paths, min_zoom, max_zoom):
+    """Yield (zoom, tile_x, tile_y, parts) for every tile with points in it,
+    parts being (path index, lat, lon) for each path going through the tile, in path order."""
+
+    if not paths:
+        return
+
+    lat = numpy.concatenate([path.lat for path in paths])
+    lon = numpy.concatenate([path.lon for path in paths])
+    path_ids = numpy.repeat(numpy.arange(len(paths)), [len(path) for path in paths])
+
+    # tiles are only computed at max zoom; the tile containing a tile one zoom level up has half its x and y
+    tiles_x, tiles_y = utils.osm_get_tiles_xy(lat, lon, max_zoom)
+
     for zoom in range(min_zoom, max_zoom + 1):
-        gen_for_zoom(paths, zoom, output_path)
+        shift = max_zoom - zoom
+        keys = ((tiles_x >> shift) << 32) | (tiles_y >> shift)
+        # a stable sort keeps the points of a tile in path order, and in order within each path
+        order = numpy.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        ids = path_ids[order]
+        starts = numpy.flatnonzero((keys[1:] != keys[:-1]) | (ids[1:] != ids[:-1])) + 1
+        bounds = [0] + starts.tolist() + [len(order)]
+
+        parts = []
+        for start, end in zip(bounds, bounds[1:]):
+            index = order[start:end]
+            parts.append((int(ids[start]), lat[index], lon[index]))
+            if end == len(order) or keys[end] != keys[start]:
+                key = int(keys[start])
+                yield zoom, key >> 32, key & 0xffffffff, parts
+                parts = []
+
+def read_manifest(output_path):
+    try:
+        with file(os.path.join(output_path, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_manifest(output_path, manifest):
+    utils.replace_file(os.path.join(output_path, MANIFEST_NAME), json.dumps(manifest))
+
+def remove_tile(output_path, name, tile_format):
+    try:
+        os.remove(tile_filename(output_path, name, tile_format))
+    except OSError:
+        pass
+
+def run_jobs(jobs, processes):
+    """Write the tiles for <jobs>, yielding (name, digest) for each."""
+
+    if processes <= 1:
+        for job in jobs:
+            yield write_tile(job)
+        return
+
+    pool = multiprocessing.Pool(processes)
+    # only keep a few batches ahead of the workers, so jobs don't pile up in memory
+    pending = deque()
+    try:
+        for batch in batches(jobs):
+            pending.append(pool.apply_async(write_tiles, (batch,)))
+            if len(pending) >= processes * 4:
+                for result in pending.popleft().get():
+                    yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def gen(paths, min_zoom, max_zoom, output_path, simplify='rdp', tile_format='json', processes=1, filters=()):
+    """Write the tiles, keeping a manifest of the inputs that went into each.
+
+    When the manifest was written with the same settings and the inputs can be read
+    separately, only the tiles that new, changed or removed input files go through are
+    simplified and written again, and only the input files with points in those tiles are read.
+    <filters> names the filters the paths went through; like everything else in the settings
+    that changes what tiles hold, a different chain of filters means rewriting all tiles."""
+
+    settings = {'min_zoom': min_zoom, 'max_zoom': max_zoom, 'simplify': simplify, 'format': tile_format,
+                'filters': list(filters), 'distance_model': utils.distance_model, 'parser_version': cache.VERSION}
+    manifest = read_manifest(output_path)
+    sources = getattr(paths, 'sources', None)
+    # only input files whose size or mtime changed since the manifest was written are hashed
+    old_inputs = manifest['inputs'] if manifest is not None else {}
+    inputs = dict((source, utils.file_info(source, old_inputs.get(source))) for source in sources or [])
+
+    if manifest is not None and manifest['settings'] == settings and sources is not None:
+        changed = [source for source in sources if old_inputs.get(source) != inputs[source]]
+        gone = set(changed) | (set(manifest['inputs']) - set(sources))
+        changed_paths = [path for path in track.join_chunks(paths.select(changed)) if len(path)]
+
+        dirty = set(tile_name(zoom, tile_x, tile_y) for zoom, tile_x, tile_y, parts in tile_parts(changed_paths, min_zoom, max_zoom))
+        dirty.update(name for name, tile in manifest['tiles'].iteritems() if gone.intersection(tile['inputs']))
+
+        # the unchanged inputs that share a tile with the changed ones are needed to rebuild it
+        needed = set(source for name in dirty for source in manifest['tiles'].get(name, {'inputs': []})['inputs'])
+        needed = [source for source in sources if source in needed and source not in changed]
+        paths = changed_paths + [path for path in track.join_chunks(paths.select(needed)) if len(path)]
+        order = dict((source, i) for i, source in enumerate(sources))
+        paths.sort(key=lambda path: order[path.source])
+
+        tiles = manifest['tiles']
+    else:
+        paths = [path for path in track.join_chunks(paths) if len(path)]
+        # everything is rewritten, so all tiles from before are stale
+        dirty = None
+        tiles = manifest['tiles'] if manifest is not None else {}
+        old_format = manifest['settings'].get('format', 'json') if manifest is not None else tile_format
+        if old_format != tile_format:
+            for name in tiles:
+                remove_tile(output_path, name, old_format)
+            tiles = {}
+
+    contributors = {}
+    def jobs():
+        for zoom, tile_x, tile_y, parts in tile_parts(paths, min_zoom, max_zoom):
+            name = tile_name(zoom, tile_x, tile_y)
+            if dirty is not None and name not in dirty:
+                continue
+            contributors[name] = sorted(set(paths[i].source for i, lat, lon in parts))
+            old_digest = tiles[name]['sha1'] if name in tiles else None
+            yield output_path, zoom, tile_x, tile_y, simplify, tile_format, [(lat, lon) for i, lat, lon in parts], old_digest
+
+    written = {}
+    for name, digest in run_jobs(jobs(), processes):
+        written[name] = {'inputs': contributors.pop(name), 'sha1': digest}
+
+    # tiles that used to have points and don't anymore
+    for name in [name for name in (tiles if dirty is None else dirty) if name in tiles and name not in written]:
+        remove_tile(output_path, name, tile_format)
+        del tiles[name]
+
+    tiles.update(written)
+    write_manifest(output_path, {'settings': settings, 'inputs': inputs, 'tiles': tiles})
@@ -0,0 +1,105 @@
+import math
+import sys
+
+import matplotlib
+matplotlib.use('agg')
+
+import matplotlib.cm
+import matplotlib.image
+import numpy
+
+import track
+from out_svg import get_bounds, latlon2xy, path2xy
+
+DEFAULT_WIDTH = 1024
+DEFAULT_HEIGHT = 1024
+
+COLOR_MAP = "inferno"
+
+# segments are rasterized in batches of about this many pixels, so memory doesn't depend on how long they are
+RASTER_BATCH = 1 << 20
+
+def projection(map_nw, map_se, width, height):
+    """Return a function turning the Mercator coordinates of path2xy into pixels, fitting the
+    bounds into the image without changing their aspect ratio and centering them.
+    x is in degrees of longitude and y in radians, so y is scaled to degrees to keep the shapes."""
+
+    min_x, min_y = latlon2xy(map_nw['lat'], map_nw['lon'])
+    max_x, max_y = latlon2xy(map_se['lat'], map_se['lon'])
+    min_y, max_y = math.degrees(min_y), math.degrees(max_y)
+    scales = [(size - 1) / span for size, span in [(width, max_x - min_x), (height, max_y - min_y)] if span > 0]
+    scale = min(scales) if scales else 0
+    offset_x = ((width - 1) - scale * (max_x - min_x)) / 2.0
+    offset_y = ((height - 1) - scale * (max_y - min_y)) / 2.0
+
+    def project(xs, ys):
+        return offset_x + scale * (xs - min_x), offset_y + scale * (numpy.degrees(ys) - min_y)
+    return project
+
+def raster_batches(x1, y1, x2, y2):
+    """Split segments into slices whose pixels add up to about RASTER_BATCH, yielding
+    (start, end, steps) with steps being the number of pixels of each segment in the slice."""
+
+    steps = numpy.maximum(numpy.ceil(numpy.maximum(abs(x2 - x1), abs(y2 - y1))), 1).astype(numpy.int64)
+    ends = numpy.cumsum(steps)
+    start = 0
+    while start < len(steps):
+        end = max(int(numpy.searchsorted(ends, ends[start] - steps[start] + RASTER_BATCH, side='right')), start + 1)
+        yield start, end, steps[start:end]
+        start = end
+
+def rasterize(grid, x1, y1, x2, y2):
+    """Add one to every pixel a segment goes through, not counting its end point
+    (the start of the next segment, or added on its own at the end of a path)."""
+
+    for start, end, steps in raster_batches(x1, y1, x2, y2):
+        offsets = numpy.arange(int(steps.sum())) - numpy.repeat(numpy.cumsum(steps) - steps, steps)
+        t = offsets / numpy.repeat(steps, steps).astype(numpy.float64)
+        xs = numpy.repeat(x1[start:end], steps) + t * numpy.repeat(x2[start:end] - x1[start:end], steps)
+        ys = numpy.repeat(y1[start:end], steps) + t * numpy.repeat(y2[start:end] - y1[start:end], steps)
+        add_points(grid, xs, ys)
+
+def add_points(grid, xs, ys):
+    height, width = grid.shape
+    xs = numpy.clip(numpy.round(xs), 0, width - 1).astype(numpy.int64)
+    ys = numpy.clip(numpy.round(ys), 0, height - 1).astype(numpy.int64)
+    pixels, counts = numpy.unique(ys * width + xs, return_counts=True)
+    grid.ravel()[pixels] += counts
+
+def colorize(grid, log=False):
+    """RGBA image of the counts, empty pixels being transparent."""
+
+    values = numpy.log1p(grid) if log else grid.astype(numpy.float64)
+    if values.max() > 0:
+        values /= values.max()
+    image = matplotlib.cm.get_cmap(COLOR_MAP)(values)
+    image[grid == 0, 3] = 0
+    return image
+
+def gen(paths, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, log=False):
+    # need to go through all points once to determine map bounds
+    map_nw, map_se = get_bounds(paths)
+
+    if map_nw is None and map_se is None:
+        sys.stderr.write("Empty input!\n")
+        return
+
+    project = projection(map_nw, map_se, width, height)
+    grid = numpy.zeros((height, width), dtype=numpy.int64)
+
+    prev = None
+    for path, ends_path in track.mark_path_ends(paths):
+        if not path.continues:
+            prev = None
+        if len(path):
+            xs, ys = project(*path2xy(path))
+            if prev is not None:
+                # the segment from the end of the chunk before
+                xs = numpy.concatenate([[prev[0]], xs])
+                ys = numpy.concatenate([[prev[1]], ys])
+            rasterize(grid, xs[:-1], ys[:-1], xs[1:], ys[1:])
+            prev = xs[-1], ys[-1]
+        if ends_path and prev is not None:
+            add_points(grid, numpy.array([prev[0]]), numpy.array([prev[1]]))
+
+    matplotlib.image.imsave(sys.stdout, colorize(grid, log), format='png')
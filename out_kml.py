@@ -1,4 +1,12 @@
-import sys
+from itertools import izip
+import shutil
+import tempfile
+
+import numpy
+
+import output
+import track
+import utils
 
 KML_START = """<?xml version="1.0" encoding="UTF-8" ?>
 <kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">
@@ -21,27 +29,66 @@ KML_START = """<?xml version="1.0" encoding="UTF-8" ?>
 
 KML_END = "</Document></kml>"
 
-def gen(paths, output_path=True, output_points=False):
-    sys.stdout.write(KML_START)
-    sys.stdout.write("<Folder><name>Tracks</name>\n")
-    for i, path in enumerate(paths, 1):
-        sys.stdout.write(("<Folder><name>%s</name>\n" % path.get('name', "Track %s" % i)).encode("utf-8"))
+PATH_START = "<Placemark><name>Path</name><styleUrl>#line</styleUrl><LineString><tessellate>1</tessellate><coordinates>\n"
+PATH_END = "</coordinates></LineString></Placemark>\n"
+
+def point_placemarks(path, coordinate_format):
+    lon = path.lon.tolist()
+    lat = path.lat.tolist()
+    ele = track.widen_ele(path.ele).tolist()
+    timed = path.time != track.NO_TIME
+    times = numpy.where(timed, numpy.datetime_as_string(numpy.where(timed, path.time // track.SECOND, 0).astype('datetime64[s]')), "").tolist()
+    placemarks = []
+    for name, x, y, z, t in izip(path.point_names(), lon, lat, ele, times):
+        coordinates = coordinate_format % (x, y)
+        if z == z:
+            coordinates = "%s,%s" % (coordinates, z)
+        timestamp = "<TimeStamp><when>%sZ</when></TimeStamp>" % t if t else ""
+        placemarks.append("<Placemark><name>%s</name><styleUrl>#track</styleUrl><Point><coordinates>%s</coordinates></Point>%s</Placemark>\n"
+                          % (name or "", coordinates, timestamp))
+    return "".join(placemarks)
+
+def gen(paths, output_path=True, output_points=False, out=None, precision=None):
+    """Write the KML to <out> (an output.Sink, standard output by default), with coordinates
+    rounded to <precision> digits if given."""
+
+    if out is None:
+        out = output.Sink()
+    fmt = output.coordinate_format(precision)
+    point_format = "%s,%s" % (fmt, fmt)
+    line_format = point_format + "\n"
+
+    out.write(KML_START)
+    out.write("<Folder><name>Tracks</name>\n")
+    i = 0
+    for path, ends_path in track.mark_path_ends(paths):
+        if not path.continues:
+            i += 1
+            out.write("<Folder><name>%s</name>\n" % (path.name if path.name is not None else "Track %s" % i))
+            if output_points:
+                out.write("<Folder><name>Points</name>\n")
+            if output_path:
+                if output_points:
+                    # the path goes after the points, so its coordinates are set aside until the path ends
+                    path_coordinates = tempfile.SpooledTemporaryFile(utils.SPOOL_SIZE)
+                else:
+                    path_coordinates = out
+                    path_coordinates.write(PATH_START)
         if output_points:
-            sys.stdout.write("<Folder><name>Points</name>\n")
-            for point in path['points']:
-                name = point.name or ""
-                coordinates = "%s,%s" % (point.lon, point.lat)
-                if point.ele is not None:
-                    coordinates = "%s,%s" % (coordinates, point.ele)
-                timestamp = "<TimeStamp><when>%s</when></TimeStamp>" % point.time.strftime("%Y-%m-%dT%H:%M:%SZ") if point.time else ""
-                sys.stdout.write(("<Placemark><name>%s</name><styleUrl>#track</styleUrl><Point><coordinates>%s</coordinates></Point>%s</Placemark>\n"
-                                  % (name, coordinates, timestamp)).encode("utf-8"))
-            sys.stdout.write("</Folder>\n")
+            out.write(point_placemarks(path, point_format))
         if output_path:
-            sys.stdout.write("<Placemark><name>Path</name><styleUrl>#line</styleUrl><LineString><tessellate>1</tessellate><coordinates>\n")
-            for point in path['points']:
-                sys.stdout.write("%s,%s\n" % (point.lon, point.lat))
-            sys.stdout.write("</coordinates></LineString></Placemark>\n")
-        sys.stdout.write("</Folder>\n")
-    sys.stdout.write("</Folder>\n")
-    sys.stdout.write(KML_END)
+            path_coordinates.write(output.format_rows(line_format, path.lon.tolist(), path.lat.tolist()))
+        if ends_path:
+            if output_points:
+                out.write("</Folder>\n")
+            if output_path:
+                if output_points:
+                    out.write(PATH_START)
+                    path_coordinates.seek(0)
+                    shutil.copyfileobj(path_coordinates, out)
+                    path_coordinates.close()
+                out.write(PATH_END)
+            out.write("</Folder>\n")
+    out.write("</Folder>\n")
+    out.write(KML_END)
+    out.flush()
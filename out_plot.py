@@ -3,60 +3,76 @@ import sys
 import matplotlib
 matplotlib.use('agg')
 
+import numpy
 import pylab
 
-from utils import distance
+import track
+from utils import distances
 
 COLORS = ["blue", "green", "red"]
 
-def hours_between(t1, t2):
-    delta = t2 - t1
-    return delta.days * 24 + float(delta.seconds) / 3600
+# lines are downsampled to this many points per pixel of the image's width before plotting
+POINTS_PER_PIXEL = 2
 
 def moving_avg(l, window):
-    avgs = []
-    for i in range(len(l)):
-        slice = l[max(i - window, 0) : min(i + window + 1, len(l))]
-        avg = float(sum(slice)) / len(slice)
-        avgs.append(avg)
+    """Average of every value with up to <window> values on each side, from cumulative sums.
+    Averages over a missing (NaN) value are missing."""
+
+    l = numpy.asarray(l, dtype=numpy.float64)
+    missing = numpy.isnan(l)
+    sums = numpy.concatenate([[0], numpy.cumsum(numpy.where(missing, 0, l))])
+    missing_counts = numpy.concatenate([[0], numpy.cumsum(missing)])
+    i = numpy.arange(len(l))
+    lo = numpy.maximum(i - window, 0)
+    hi = numpy.minimum(i + window + 1, len(l))
+    avgs = (sums[hi] - sums[lo]) / (hi - lo)
+    avgs[missing_counts[hi] != missing_counts[lo]] = numpy.nan
     return avgs
 
-def gen(paths, xaxis, yaxis, avg_window):
-    xes = []
-
-    eles = []
-    speeds = []
-
-    total_dist = 0
-    total_time = 0
-
-    prev_p = None
+def lttb(x, y, threshold):
+    """Indices of <threshold> points that keep the shape of the line through x, y
+    (Largest-Triangle-Three-Buckets, from Sveinn Steinarsson's thesis "Downsampling Time Series
+    for Visual Representation"). The first and last points are kept; from each bucket in between,
+    the point making the largest triangle with the point kept before and the average of the next bucket."""
+
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return numpy.arange(n)
+
+    bounds = (numpy.arange(threshold - 1) * (n - 2) / float(threshold - 2)).astype(numpy.int64) + 1
+    bounds[-1] = n - 1
+    kept = numpy.zeros(threshold, dtype=numpy.int64)
+    kept[-1] = n - 1
+    a = 0
+    for i in xrange(threshold - 2):
+        start, end = bounds[i], bounds[i + 1]
+        next_end = bounds[i + 2] if i + 2 < len(bounds) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        # a bucket of missing values keeps one, which leaves the gap in the line
+        areas = numpy.where(numpy.isnan(areas), -1, areas)
+        a = start + int(areas.argmax())
+        kept[i + 1] = a
+    return kept
 
-    for path in paths:
-        for p in path['points']:
-            if prev_p is not None:
-                d = float(distance(p, prev_p)) / 1000 # km
-                t = hours_between(prev_p.time, p.time) # h
-
-                try:
-                    s = d / t # km/h
-                except ZeroDivisionError:
-                    s = 0
+def gen(paths, xaxis, yaxis, avg_window):
+    # distance and time keep adding up across paths, as if they were one
+    points = track.concatenate(list(paths))
 
-                total_dist += d
-                total_time += t
-            else:
-                s = 0
+    d = distances(points.lat, points.lon) / 1000 # km
+    t = numpy.diff(points.time) / (3600.0 * track.SECOND) # h
 
-            if xaxis == 'time':
-                xes.append(total_time)
-            elif xaxis == 'distance':
-                xes.append(total_dist)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        s = numpy.where(t != 0, d / t, 0) # km/h
 
-            speeds.append(s)
-            eles.append(p.ele)
+    if xaxis == 'time':
+        xes = numpy.concatenate([[0], numpy.cumsum(t)])
+    elif xaxis == 'distance':
+        xes = numpy.concatenate([[0], numpy.cumsum(d)])
 
-            prev_p = p
+    speeds = numpy.concatenate([[0], s])
+    eles = points.ele.astype(numpy.float64)
 
     lines = []
     if 'elevation' in yaxis:
@@ -69,6 +85,7 @@ def gen(paths, xaxis, yaxis, avg_window):
         lines.append((speeds, "speed (km/h)"))
 
     figure = pylab.figure()
+    threshold = int(figure.get_figwidth() * figure.dpi * POINTS_PER_PIXEL)
     ax = None
     for i, line in enumerate(lines):
         if ax is None:
@@ -80,7 +97,8 @@ def gen(paths, xaxis, yaxis, avg_window):
                 ax.set_xlabel("distance (km)")
         else:
             ax = ax.twinx()
-        ax.plot(xes, line[0], COLORS[i], linewidth=0.8)
+        kept = lttb(xes, line[0], threshold)
+        ax.plot(xes[kept], line[0][kept], COLORS[i], linewidth=0.8)
         ax.set_ylabel(line[1], color=COLORS[i])
 
     figure.savefig(sys.stdout, format='png')
@@ -1,89 +1,252 @@
 from collections import defaultdict
 import datetime
+import json
 import math
+import multiprocessing
 import sys
 
-from utils import distance
+import numpy
+
+import instrument
+import output
+import track
+from utils import distances, distances_between
 
 def toseconds(t):
     return t.days * 24 * 3600 + t.seconds
 
+def duration(t):
+    return datetime.timedelta(microseconds=int(t))
+
+def seconds(t):
+    return t / float(track.SECOND)
+
 def kmph(m, s):
     try:
         return m / s * 3600 / 1000
     except ZeroDivisionError:
         return 0
 
-def gen(paths):
-    total_dist = 0
-    total_dist_transportation = defaultdict(int)
-    total_moving_time = datetime.timedelta(0)
-
-    for path in paths:
-        point_count = len(path['points'])
-        has_ele = path['points'][0].ele is not None
-        has_time = path['points'][0].time is not None
-
-        dist = 0
-
-        min_ele = max_ele = None
-        ele_sum = 0
-
-        min_time = max_time = None
-        moving_time = datetime.timedelta(0)
-        stopped_time = datetime.timedelta(0)
-
-        prev_p = None
-        for p in path['points']:
-            d = distance(prev_p, p) if prev_p is not None else 0
-            dist += d
-
-            if has_ele:
-                if min_ele is None and max_ele is None:
-                    min_ele = max_ele = p.ele
-                else:
-                    min_ele = min(min_ele, p.ele)
-                    max_ele = max(max_ele, p.ele)
-                ele_sum += p.ele
-            if has_time and p.time:
-                if min_time is None and max_time is None:
-                    min_time = max_time = p.time
-                else:
-                    min_time = min(min_time, p.time)
-                    max_time = max(max_time, p.time)
-                if d != 0:
-                    moving_time += p.time - prev_p.time
-                if d == 0 and prev_p is not None:
-                    stopped_time += p.time - prev_p.time
-            prev_p = p
-
-        avg_ele = ele_sum / point_count
-
-        ele_stdd = math.sqrt(sum((avg_ele - p.ele) ** 2 for p in path['points']) / point_count) if has_ele else 0
-
-        sys.stdout.write("points: %s, has elevation: %s, has time: %s\n" % (point_count, has_ele, has_time))
-        sys.stdout.write("dist: %.2fkm\n" % (dist / 1000))
-        if has_time:
-            time = max_time - min_time
-            sys.stdout.write("start time: %s\n" % min_time)
-            sys.stdout.write("end time: %s\n" % max_time)
-            sys.stdout.write("time: %s\n" % time)
-            sys.stdout.write("avg speed: %.2fkm/h\n" % kmph(dist, toseconds(time)))
-            sys.stdout.write("moving time: %s\n" % moving_time)
-            sys.stdout.write("stopped time: %s\n" % stopped_time)
-            sys.stdout.write("avg speed when moving: %.2fkm/h\n" % kmph(dist, toseconds(moving_time)))
-            sys.stdout.write("resolution: %.2f s/point\n" % (float(toseconds(time)) / float(point_count)))
+class PathStats(object):
+    """Statistics of one path. Stats of consecutive parts of a path are combined with merge(),
+    which is associative, so a path can be measured in pieces and put together in any grouping.
+    Elevation mean and variance are kept the way Welford's algorithm does (the mean and the sum of
+    squared differences from it) and merged with the formula of Chan et al."""
+
+    def __init__(self, has_ele=False, has_time=False, transportation=None, source=None):
+        self.has_ele = bool(has_ele)
+        self.has_time = bool(has_time)
+        self.transportation = transportation
+        self.source = source
+
+        self.point_count = 0
+        self.dist = 0.0
+
+        self.min_ele = self.max_ele = None
+        self.ele_mean = 0.0
+        self.ele_m2 = 0.0
+
+        # in the units of the time column
+        self.min_time = self.max_time = None
+        self.moving_time = self.stopped_time = 0
+
+        # (lat, lon, time) of the first and last points, for the segment between two merged parts
+        self.first = self.last = None
+
+    @classmethod
+    def of_chunk(cls, path, has_ele, has_time):
+        stats = cls(has_ele, has_time, path.transportation, path.source)
+        if not len(path):
+            return stats
+
+        d = distances(path.lat, path.lon)
+        stats.dist = float(d.sum())
+        stats.point_count = len(path)
+
         if has_ele:
-            sys.stdout.write("min ele: %.2fm; max ele: %.2fm; avg ele: %.2fm; ele std dev: %.2fm\n" % (min_ele, max_ele, avg_ele, ele_stdd))
-        sys.stdout.write("\n")
+            ele = path.ele.astype(numpy.float64)
+            stats.min_ele = float(ele.min())
+            stats.max_ele = float(ele.max())
+            stats.ele_mean = float(ele.mean())
+            stats.ele_m2 = float(((ele - stats.ele_mean) ** 2).sum())
+        if has_time:
+            times = path.time[path.time != track.NO_TIME]
+            if len(times):
+                stats.min_time = int(times.min())
+                stats.max_time = int(times.max())
+            timed = (path.time[1:] != track.NO_TIME) & (path.time[:-1] != track.NO_TIME)
+            dt = numpy.diff(path.time)
+            stats.moving_time = int(dt[timed & (d != 0)].sum())
+            stats.stopped_time = int(dt[timed & (d == 0)].sum())
+
+        stats.first = float(path.lat[0]), float(path.lon[0]), int(path.time[0])
+        stats.last = float(path.lat[-1]), float(path.lon[-1]), int(path.time[-1])
+        return stats
+
+    def add(self, path):
+        """Add the next chunk of the path."""
+
+        self.merge(PathStats.of_chunk(path, self.has_ele, self.has_time))
+
+    def merge(self, other):
+        """Add the stats of the part of the path that comes right after this one."""
+
+        if not other.point_count:
+            return
+        if not self.point_count:
+            self.__dict__.update(other.__dict__)
+            return
+
+        # the segment joining the two parts
+        lat1, lon1, time1 = self.last
+        lat2, lon2, time2 = other.first
+        d = float(distances_between(numpy.array([lat1]), numpy.array([lon1]), numpy.array([lat2]), numpy.array([lon2]))[0])
+        self.dist += d + other.dist
+        if self.has_time and time1 != track.NO_TIME and time2 != track.NO_TIME:
+            if d != 0:
+                self.moving_time += time2 - time1
+            else:
+                self.stopped_time += time2 - time1
+        self.moving_time += other.moving_time
+        self.stopped_time += other.stopped_time
 
-        total_dist += dist
-        total_dist_transportation[path.get('transportation')] += dist
-        total_moving_time += moving_time
+        if self.has_ele:
+            count = self.point_count + other.point_count
+            delta = other.ele_mean - self.ele_mean
+            self.ele_m2 += other.ele_m2 + delta ** 2 * self.point_count * other.point_count / count
+            self.ele_mean += delta * other.point_count / count
+            self.min_ele = min(self.min_ele, other.min_ele)
+            self.max_ele = max(self.max_ele, other.max_ele)
+        if other.min_time is not None:
+            self.min_time = other.min_time if self.min_time is None else min(self.min_time, other.min_time)
+            self.max_time = other.max_time if self.max_time is None else max(self.max_time, other.max_time)
 
-    sys.stdout.write("\n")
+        self.point_count += other.point_count
+        self.last = other.last
+
+    def ele_stdd(self):
+        return math.sqrt(self.ele_m2 / self.point_count) if self.has_ele else 0
+
+    def to_dict(self):
+        stats = {'source': self.source, 'transportation': self.transportation, 'points': self.point_count,
+                 'has_elevation': self.has_ele, 'has_time': self.has_time, 'distance_m': self.dist}
+        if self.has_time:
+            time_s = seconds(self.max_time - self.min_time)
+            stats.update({'start_time': track.from_epoch(self.min_time).isoformat(),
+                          'end_time': track.from_epoch(self.max_time).isoformat(),
+                          'time_s': time_s, 'moving_time_s': seconds(self.moving_time), 'stopped_time_s': seconds(self.stopped_time),
+                          'avg_speed_kmh': kmph(self.dist, time_s), 'avg_moving_speed_kmh': kmph(self.dist, seconds(self.moving_time)),
+                          'resolution_s': time_s / self.point_count})
+        if self.has_ele:
+            stats.update({'min_ele_m': self.min_ele, 'max_ele_m': self.max_ele,
+                          'avg_ele_m': self.ele_mean, 'ele_stddev_m': self.ele_stdd()})
+        return stats
+
+def path_stats(paths):
+    """PathStats for every path with points in it."""
+
+    stats = []
+    for path, ends_path in track.mark_path_ends(paths):
+        if not path.continues:
+            current = PathStats(path.has_ele(), path.has_time(), path.transportation, path.source)
+        current.add(path)
+        if ends_path and current.point_count:
+            stats.append(current)
+    return stats
+
+# the input of the stats being computed, which worker processes get when they are started
+_paths = None
+
+def file_stats(source):
+    # runs in a worker process; PathStats are small to send back, unlike the tracks
+    try:
+        stats, measured = instrument.in_worker(path_stats, _paths.select([source]))
+        return stats, measured, None
+    except Exception, e:
+        return None, None, "%s: %s" % (e.__class__.__name__, e)
+
+def parallel_path_stats(paths, processes):
+    """path_stats for each input file in a pool of <processes> workers, in file order.
+    A file that fails is reported and skipped."""
+
+    global _paths
+    _paths = paths
+    pool = multiprocessing.Pool(processes)
+    try:
+        stats = []
+        for source, (file_stats_list, measured, error) in zip(paths.sources, pool.imap(file_stats, paths.sources)):
+            instrument.merge(measured)
+            if error is not None:
+                sys.stderr.write("Error parsing %s: %s\n" % (source, error))
+                continue
+            stats.extend(file_stats_list)
+        return stats
+    finally:
+        pool.terminate()
+        pool.join()
+        _paths = None
+
+def totals(stats):
+    total_dist_transportation = defaultdict(float)
+    total_moving_time = 0
+    for s in stats:
+        total_dist_transportation[s.transportation] += s.dist
+        total_moving_time += s.moving_time
+    return sum(s.dist for s in stats), total_dist_transportation, total_moving_time
+
+def write_text(stats, out):
+    for s in stats:
+        moving_time = duration(s.moving_time)
+        stopped_time = duration(s.stopped_time)
+
+        out.write("points: %s, has elevation: %s, has time: %s\n" % (s.point_count, s.has_ele, s.has_time))
+        out.write("dist: %.2fkm\n" % (s.dist / 1000))
+        if s.has_time:
+            time = duration(s.max_time - s.min_time)
+            out.write("start time: %s\n" % track.from_epoch(s.min_time))
+            out.write("end time: %s\n" % track.from_epoch(s.max_time))
+            out.write("time: %s\n" % time)
+            out.write("avg speed: %.2fkm/h\n" % kmph(s.dist, toseconds(time)))
+            out.write("moving time: %s\n" % moving_time)
+            out.write("stopped time: %s\n" % stopped_time)
+            out.write("avg speed when moving: %.2fkm/h\n" % kmph(s.dist, toseconds(moving_time)))
+            out.write("resolution: %.2f s/point\n" % (float(toseconds(time)) / float(s.point_count)))
+        if s.has_ele:
+            out.write("min ele: %.2fm; max ele: %.2fm; avg ele: %.2fm; ele std dev: %.2fm\n" % (s.min_ele, s.max_ele, s.ele_mean, s.ele_stdd()))
+        out.write("\n")
+
+    total_dist, total_dist_transportation, total_moving_time = totals(stats)
+    total_moving_time = duration(total_moving_time)
+    out.write("\n")
     for t, d in sorted(total_dist_transportation.iteritems()):
-        sys.stdout.write("TOTAL dist %s: %.2fkm\n" % (t, d / 1000))
-    sys.stdout.write("TOTAL dist: %.2fkm\n" % (total_dist / 1000))
-    sys.stdout.write("TOTAL moving time: %s\n" % total_moving_time)
-    sys.stdout.write("avg speed when moving: %.2fkm/h\n" % kmph(total_dist, toseconds(total_moving_time)))
+        out.write("TOTAL dist %s: %.2fkm\n" % (t, d / 1000))
+    out.write("TOTAL dist: %.2fkm\n" % (total_dist / 1000))
+    out.write("TOTAL moving time: %s\n" % total_moving_time)
+    out.write("avg speed when moving: %.2fkm/h\n" % kmph(total_dist, toseconds(total_moving_time)))
+
+def write_json(stats, out):
+    total_dist, total_dist_transportation, total_moving_time = totals(stats)
+    json.dump({'paths': [s.to_dict() for s in stats],
+               'totals': {'distance_m': total_dist,
+                          'distance_m_by_transportation': dict((t or "", d) for t, d in total_dist_transportation.iteritems()),
+                          'moving_time_s': seconds(total_moving_time),
+                          'avg_moving_speed_kmh': kmph(total_dist, seconds(total_moving_time))}},
+              out, indent=2, sort_keys=True)
+    out.write("\n")
+
+def gen(paths, output_format='text', processes=1, out=None):
+    """Print stats for every path and totals. With several processes and inputs that can be
+    read separately, each input file is parsed and measured in a worker of its own."""
+
+    if processes > 1 and getattr(paths, 'sources', None) is not None:
+        stats = parallel_path_stats(paths, processes)
+    else:
+        stats = path_stats(paths)
+
+    if out is None:
+        out = output.Sink()
+    if output_format == 'json':
+        write_json(stats, out)
+    else:
+        write_text(stats, out)
+    out.flush()
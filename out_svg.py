@@ -1,30 +1,51 @@
-from collections import defaultdict
 from itertools import izip
 import math
+import shutil
 import sys
+import tempfile
+from xml.sax.saxutils import escape
+
+import numpy
+
+import output
+import tiles
+import track
 import utils
 
 
 PATH_COLORS = {"plane": "rgb(200,0,0)", "train": "rgb(0,0,0)", "bus": "rgb(0,0,200)", "car": "rgb(0,0,200)", "motorcycle": "rgb(0,0,200)", "boat": "rgb(100,100,100)", "bike": "rgb(0,200,0)", "walk": "rgb(0,200,0)"}
 
-def minmax(l):
-    min = max = None
-    for e in l:
-        if min is None or e < min:
-            min = e
-        if max is None or e > max:
-            max = e
-    return min, max
-
 def latlon2xy(lat, lon):
     return lon, -math.log(math.tan(math.pi / 4 + lat * (math.pi / 180) / 2))
 
+def path2xy(path):
+    return path.lon, -numpy.log(numpy.tan(math.pi / 4 + path.lat * (math.pi / 180) / 2))
+
+def get_bounds(paths):
+    map_nw = map_se = None
+    for path in paths:
+        if not len(path):
+            continue
+        nw = {'lat': float(path.lat.max()), 'lon': float(path.lon.min())}
+        se = {'lat': float(path.lat.min()), 'lon': float(path.lon.max())}
+        if map_nw is None and map_se is None:
+            map_nw, map_se = nw, se
+        else:
+            map_nw['lat'] = max(map_nw['lat'], nw['lat'])
+            map_nw['lon'] = min(map_nw['lon'], nw['lon'])
+            map_se['lat'] = min(map_se['lat'], se['lat'])
+            map_se['lon'] = max(map_se['lon'], se['lon'])
+    return map_nw, map_se
+
 def absolute(v, scale, min_v, max_v):
     return scale * (v - min_v) / (max_v - min_v)
 
 SVG_WIDTH = 1024
 SVG_HEIGHT = 1024
 
+# paths are simplified to within half a pixel, which doesn't show
+SIMPLIFY_EPSILON = 0.5
+
 SVG_START = """<?xml version="1.0" standalone="no" ?>
 <!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
 <svg width="%s" height="%s" version="1.1" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">
@@ -39,7 +60,7 @@ OSM_TILE_HEIGHT = 256
 
 SVG_BACKGROUND = """
 <g opacity="0.5">
-<image opacity="1" x="%(x)s" y="%(y)s" width="%(w)s" height="%(h)s" xlink:href="http://a.tile.openstreetmap.org/%(zoom)s/%(tile_x)s/%(tile_y)s.png" />
+<image opacity="1" x="%(x)s" y="%(y)s" width="%(w)s" height="%(h)s" xlink:href="%(href)s" />
 </g>
 """
 
@@ -65,28 +86,30 @@ def osm_get_tiles(map_nw, map_se):
              'zoom': zoom, 'tile_x': tile_x + i, 'tile_y': tile_y + j}
             for i in xrange(tiles_x) for j in xrange(tiles_y)]
 
-def gen_map(paths, output_path=True, output_points=False):
-    map_nw = map_se = None
+def pixels(xs, ys, prev):
+    """Round coordinates to whole pixels, keeping only the points that land on a different pixel
+    than the point before (<prev>, the last pixel kept, for the first one)."""
 
-    # need to go through all points once to determine map bounds
-    for path in paths:
-        for p in path['points']:
-            lat, lon = p.lat, p.lon
+    xs = numpy.round(xs).astype(numpy.int64)
+    ys = numpy.round(ys).astype(numpy.int64)
+    moved = numpy.ones(len(xs), dtype=bool)
+    moved[1:] = (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])
+    if len(xs) and prev is not None:
+        moved[0] = (xs[0], ys[0]) != prev
+    return xs[moved].tolist(), ys[moved].tolist()
 
-            if map_nw is None and map_se is None:
-                map_nw = {'lat': lat, 'lon': lon}
-                map_se = {'lat': lat, 'lon': lon}
-            else:
-                map_nw['lat'] = max(map_nw['lat'], lat)
-                map_nw['lon'] = min(map_nw['lon'], lon)
-                map_se['lat'] = min(map_se['lat'], lat)
-                map_se['lon'] = max(map_se['lon'], lon)
+def gen_map(paths, output_path=True, output_points=False, simplify=None, tile_url=tiles.DEFAULT_URL, embed_tiles=False, tile_cache=None, out=None):
+    # need to go through all points once to determine map bounds
+    map_nw, map_se = get_bounds(paths)
 
     if map_nw is None and map_se is None:
         sys.stderr.write("Empty input!\n")
         return
 
-    sys.stdout.write(SVG_START)
+    if out is None:
+        out = output.Sink()
+
+    out.write(SVG_START)
 
     osm_tiles = osm_get_tiles(map_nw, map_se)
 
@@ -95,101 +118,149 @@ def gen_map(paths, output_path=True, output_points=False):
     se_tile = osm_tiles[-1]
     map_se = osm_tile_nw(se_tile['tile_x'] + 1, se_tile['tile_y'] + 1, se_tile['zoom'])
 
-    for tile in osm_tiles:
-        sys.stdout.write(SVG_BACKGROUND % tile)
+    # embedded tiles are fetched now, so the SVG can be viewed offline
+    if embed_tiles:
+        hrefs = tiles.embed(osm_tiles, tile_url, tile_cache)
+    else:
+        hrefs = [tiles.tile_url(tile_url, tile) for tile in osm_tiles]
+    for tile, href in izip(osm_tiles, hrefs):
+        out.write(SVG_BACKGROUND % dict(tile, href=escape(href, {'"': "&quot;"})))
 
     min_x, min_y = latlon2xy(map_nw['lat'], map_nw['lon'])
     max_x, max_y = latlon2xy(map_se['lat'], map_se['lon'])
 
-    for path in paths:
-        path_color = PATH_COLORS.get(path.get('transportation'), "rgb(0,0,0)")
-        point_color = "rgb(255,0,0)"
-
-        prev_x = prev_y = None
-
-        for p in path['points']:
-            lat, lon = p.lat, p.lon
-            x, y = latlon2xy(lat, lon)
-
-            if output_path and prev_x is not None and prev_y is not None:
-                params = {'x1': absolute(prev_x, SVG_WIDTH, min_x, max_x), 'y1': absolute(prev_y, SVG_HEIGHT, min_y, max_y),
-                          'x2': absolute(x, SVG_WIDTH, min_x, max_x), 'y2': absolute(y, SVG_HEIGHT, min_y, max_y),
-                          'c': path_color}
-                sys.stdout.write("<line x1=\"%(x1)s\" y1=\"%(y1)s\" x2=\"%(x2)s\" y2=\"%(y2)s\" style=\"stroke:%(c)s;stroke-width:1;\" />\n" % params)
-
-            if output_points:
-                params = {'x': absolute(x, SVG_WIDTH, min_x, max_x), 'y': absolute(y, SVG_HEIGHT, min_y, max_y), 'c': point_color}
-                sys.stdout.write("<circle cx=\"%(x)s\" cy=\"%(y)s\" r=\"1\" fill=\"%(c)s\" />\n" % params)
+    point_color = "rgb(255,0,0)"
 
-            prev_x, prev_y = x, y
+    # every path is a single polyline through the pixels it goes through; the points of a path are
+    # drawn over it, so they are set aside until the path ends
+    for path, ends_path in track.mark_path_ends(paths):
+        if not path.continues:
+            line_started = False
+            prev_line = prev_point = None
+            circles = tempfile.SpooledTemporaryFile(utils.SPOOL_SIZE) if output_path else out
 
-    sys.stdout.write(SVG_END)
-
-def gen_weighted(paths, output_path=True, output_points=False):
-    map_nw = map_se = None
-
-    # all segments and points with associated weight
-    segments = defaultdict(int)
-    points = defaultdict(int)
-
-    # go through all points to compute point/segment weight
-    for path in paths:
-        svg_path = []
-        for p in path['points']:
-            lat, lon = p.lat, p.lon
-
-            if map_nw is None and map_se is None:
-                map_nw = {'lat': lat, 'lon': lon}
-                map_se = {'lat': lat, 'lon': lon}
-            else:
-                map_nw['lat'] = max(map_nw['lat'], lat)
-                map_nw['lon'] = min(map_nw['lon'], lon)
-                map_se['lat'] = min(map_se['lat'], lat)
-                map_se['lon'] = max(map_se['lon'], lon)
-
-            svg_point = latlon2xy(lat, lon)
-            svg_path.append(svg_point)
-
-            if output_points:
-                points[svg_point] += 1
+        xs, ys = path2xy(path)
+        xs = absolute(xs, SVG_WIDTH, min_x, max_x)
+        ys = absolute(ys, SVG_HEIGHT, min_y, max_y)
 
         if output_path:
-            for (x1, y1), (x2, y2) in izip(svg_path, svg_path[1:]):
-                segments[(x1, y1, x2, y2)] += 1
+            if simplify is not None:
+                drawn = utils.simplify(xs, ys, SIMPLIFY_EPSILON, simplify)
+                line_xs, line_ys = pixels(xs[drawn], ys[drawn], prev_line)
+            else:
+                line_xs, line_ys = pixels(xs, ys, prev_line)
+            if line_xs:
+                if not line_started:
+                    out.write("<polyline style=\"fill:none;stroke:%s;stroke-width:1;\" points=\"" % PATH_COLORS.get(path.transportation, "rgb(0,0,0)"))
+                    line_started = True
+                out.write(" ".join("%d,%d" % p for p in izip(line_xs, line_ys)) + " ")
+                prev_line = line_xs[-1], line_ys[-1]
+
+        if output_points:
+            point_xs, point_ys = pixels(xs, ys, prev_point)
+            circles.write("".join("<circle cx=\"%d\" cy=\"%d\" r=\"1\" fill=\"%s\" />\n" % (x, y, point_color) for x, y in izip(point_xs, point_ys)))
+            if point_xs:
+                prev_point = point_xs[-1], point_ys[-1]
+
+        if ends_path and output_path:
+            if line_started:
+                out.write("\" />\n")
+            circles.seek(0)
+            shutil.copyfileobj(circles, out)
+            circles.close()
+
+    out.write(SVG_END)
+    out.flush()
+
+def pixel_keys(xs, ys):
+    # pixels as 32 bit keys, x in the upper half; clipping keeps a stray point from reaching into the next field
+    xs = numpy.clip(numpy.round(xs), 0, 0xffff).astype(numpy.int64)
+    ys = numpy.clip(numpy.round(ys), 0, 0xffff).astype(numpy.int64)
+    return xs << 16 | ys
+
+def segment_keys(pixels):
+    """Keys for the segments between consecutive pixels, the same in both directions:
+    the smaller pixel key goes into the upper half. Segments within a pixel are left out."""
+
+    start, end = pixels[:-1], pixels[1:]
+    moved = start != end
+    start, end = start[moved], end[moved]
+    return numpy.minimum(start, end) << 32 | numpy.maximum(start, end)
+
+def batches(items):
+    # the elements of a block of counts are written in pieces, so they don't all have to be in memory as text
+    for keys, counts in items:
+        for start in xrange(0, len(keys), track.CHUNK_SIZE):
+            yield keys[start:start + track.CHUNK_SIZE], counts[start:start + track.CHUNK_SIZE]
+
+def gen_weighted(paths, output_path=True, output_points=False, out=None):
+    # need to go through all points once to determine map bounds, so segments can be counted by pixel
+    map_nw, map_se = get_bounds(paths)
 
     if map_nw is None and map_se is None:
         sys.stderr.write("Empty input!\n")
         return
 
-    sys.stdout.write(SVG_START)
+    if out is None:
+        out = output.Sink()
 
     min_x, min_y = latlon2xy(map_nw['lat'], map_nw['lon'])
     max_x, max_y = latlon2xy(map_se['lat'], map_se['lon'])
 
-    if output_path:
-        min_weight, max_weight = minmax(segments.itervalues())
+    # how many times each segment between two pixels is drawn and each pixel has a point in it
+    segments = utils.KeyCounter()
+    points = utils.KeyCounter()
 
-        for (x1, y1, x2, y2), weight in sorted(segments.iteritems(), key=lambda (s, w): w):
-            if min_weight == max_weight:
-                color = "rgb(0,0,0)"
-            else:
-                color = "hsl(240,%s%%,%s%%)" % (10 + absolute(weight, 80, min_weight, max_weight), 80 - absolute(weight, 70, min_weight, max_weight))
-            params = {'x1': absolute(x1, SVG_WIDTH, min_x, max_x), 'y1': absolute(y1, SVG_HEIGHT, min_y, max_y),
-                      'x2': absolute(x2, SVG_WIDTH, min_x, max_x), 'y2': absolute(y2, SVG_HEIGHT, min_y, max_y),
-                      'c': color}
-            sys.stdout.write("<line x1=\"%(x1)s\" y1=\"%(y1)s\" x2=\"%(x2)s\" y2=\"%(y2)s\" style=\"stroke:%(c)s;stroke-width:1;\" />\n" % params)
+    prev = None
+    for path in paths:
+        if not path.continues:
+            prev = None
+        if not len(path):
+            continue
+        xs, ys = path2xy(path)
+        keys = pixel_keys(absolute(xs, SVG_WIDTH, min_x, max_x), absolute(ys, SVG_HEIGHT, min_y, max_y))
 
-    if output_points:
-        min_weight, max_weight = minmax(points.itervalues())
+        if output_points:
+            points.add(keys)
 
-        for (x, y), weight in sorted(points.iteritems(), key=lambda (p, w): w):
-            if min_weight == max_weight:
-                color = "rgb(255,0,0)"
-                r = 1
-            else:
-                color = "hsl(0,%s%%,%s%%)" % (10 + absolute(weight, 80, min_weight, max_weight), 60 - absolute(weight, 50, min_weight, max_weight))
-                r = 1 + absolute(weight, 4, min_weight, max_weight)
-            params = {'x': absolute(x, SVG_WIDTH, min_x, max_x), 'y': absolute(y, SVG_HEIGHT, min_y, max_y), 'c': color, 'r': r}
-            sys.stdout.write("<circle cx=\"%(x)s\" cy=\"%(y)s\" r=\"%(r)s\" fill=\"%(c)s\" />\n" % params)
+        if output_path:
+            # the first segment of a chunk starts at the end of the one before
+            segments.add(segment_keys(keys if prev is None else numpy.concatenate([[prev], keys])))
+        prev = keys[-1]
+
+    out.write(SVG_START)
 
-    sys.stdout.write(SVG_END)
+    if output_path:
+        min_weight, max_weight, items = segments.by_count()
+
+        for keys, weights in batches(items):
+            starts, ends = keys >> 32, keys & 0xffffffff
+            lines = []
+            for x1, y1, x2, y2, weight in izip((starts >> 16).tolist(), (starts & 0xffff).tolist(),
+                                               (ends >> 16).tolist(), (ends & 0xffff).tolist(), weights.tolist()):
+                if min_weight == max_weight:
+                    color = "rgb(0,0,0)"
+                else:
+                    color = "hsl(240,%s%%,%s%%)" % (10 + absolute(weight, 80, min_weight, max_weight), 80 - absolute(weight, 70, min_weight, max_weight))
+                params = {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2, 'c': color}
+                lines.append("<line x1=\"%(x1)s\" y1=\"%(y1)s\" x2=\"%(x2)s\" y2=\"%(y2)s\" style=\"stroke:%(c)s;stroke-width:1;\" />\n" % params)
+            out.write("".join(lines))
+
+    if output_points:
+        min_weight, max_weight, items = points.by_count()
+
+        for keys, weights in batches(items):
+            circles = []
+            for x, y, weight in izip((keys >> 16).tolist(), (keys & 0xffff).tolist(), weights.tolist()):
+                if min_weight == max_weight:
+                    color = "rgb(255,0,0)"
+                    r = 1
+                else:
+                    color = "hsl(0,%s%%,%s%%)" % (10 + absolute(weight, 80, min_weight, max_weight), 60 - absolute(weight, 50, min_weight, max_weight))
+                    r = 1 + absolute(weight, 4, min_weight, max_weight)
+                params = {'x': x, 'y': y, 'c': color, 'r': r}
+                circles.append("<circle cx=\"%(x)s\" cy=\"%(y)s\" r=\"%(r)s\" fill=\"%(c)s\" />\n" % params)
+            out.write("".join(circles))
+
+    out.write(SVG_END)
+    out.flush()
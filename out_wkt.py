@@ -1,15 +1,50 @@
-import sys
+import shutil
+import tempfile
+
+import output
+import track
+import utils
 
 WKT_START = "GEOMETRYCOLLECTION ("
 WKT_END = ")"
 
-def gen(paths, output_path=True, output_points=False):
-    sys.stdout.write(WKT_START)
-    for i, path in enumerate(paths):
-        if output_points:
-            sys.stdout.write(", ".join("POINT (%s %s)" % (point.lon, point.lat) for point in path['points']))
-        if output_path:
-            if i != 0 or output_points:
-                sys.stdout.write(", ")
-            sys.stdout.write("LINESTRING (%s)\n" % ", ".join("%s %s" % (point.lon, point.lat) for point in path['points']))
-    sys.stdout.write(WKT_END)
+def gen(paths, output_path=True, output_points=False, out=None, precision=None):
+    """Write the WKT to <out> (an output.Sink, standard output by default), with coordinates
+    rounded to <precision> digits if given."""
+
+    if out is None:
+        out = output.Sink()
+    fmt = output.coordinate_format(precision)
+    point_format = "POINT (%s %s), " % (fmt, fmt)
+    coordinate_format = "%s %s, " % (fmt, fmt)
+
+    out.write(WKT_START)
+    i = -1
+    for path, ends_path in track.mark_path_ends(paths):
+        if not path.continues:
+            i += 1
+            points_written = coordinates_written = False
+            if output_path:
+                # the linestring goes after the points, so it is set aside until the path ends
+                line = tempfile.SpooledTemporaryFile(utils.SPOOL_SIZE) if output_points else out
+                if i != 0 or output_points:
+                    line.write(", ")
+                line.write("LINESTRING (")
+        if output_points and len(path):
+            if points_written:
+                out.write(", ")
+            out.write(output.format_rows(point_format, path.lon.tolist(), path.lat.tolist())[:-2])
+            points_written = True
+        if output_path and len(path):
+            if coordinates_written:
+                line.write(", ")
+            line.write(output.format_rows(coordinate_format, path.lon.tolist(), path.lat.tolist())[:-2])
+            coordinates_written = True
+        if output_path and ends_path:
+            line.write(")\n")
+            if output_points:
+                line.seek(0)
+                shutil.copyfileobj(line, out)
+                line.close()
+    out.write(WKT_END)
+    out.flush()
@@ -0,0 +1,108 @@
+import gzip
+import struct
+import sys
+import time
+import zlib
+
+# writes are collected until there is this much to pass on
+BUFFER_SIZE = 1 << 20
+
+COMPRESSIONS = ['gzip', 'kmz']
+# gzip's own default; higher levels are much slower for a few percent
+COMPRESS_LEVEL = 6
+
+KMZ_DOCUMENT = "doc.kml"
+
+def coordinate_format(precision=None):
+    """printf format of a coordinate: the way Python prints floats, or <precision> digits after the point."""
+
+    return "%s" if precision is None else "%%.%df" % precision
+
+def format_rows(row_format, *columns):
+    """<row_format> applied to every row of the columns (lists), joined. Formatting all rows
+    with one format string is quicker than formatting them one by one."""
+
+    if not columns or not len(columns[0]):
+        return ""
+    values = [value for row in zip(*columns) for value in row]
+    return (row_format * len(columns[0])) % tuple(values)
+
+def dos_time(t):
+    t = time.localtime(t)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+class KmzWriter(object):
+    """Writes a ZIP archive holding a single doc.kml with what is written to it.
+    The sizes and checksum go after the data, so <fileobj> doesn't need to be seekable (standard output)."""
+
+    def __init__(self, fileobj, level=COMPRESS_LEVEL):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.crc = 0
+        self.size = self.compressed_size = 0
+        self.time, self.date = dos_time(time.time())
+        # version 2.0, sizes in the data descriptor, deflated
+        self.header = struct.pack("<HHHHH", 20, 0x08, 8, self.time, self.date)
+        local_header = struct.pack("<I", 0x04034b50) + self.header + struct.pack("<IIIHH", 0, 0, 0, len(KMZ_DOCUMENT), 0) + KMZ_DOCUMENT
+        self.fileobj.write(local_header)
+        self.header_size = len(local_header)
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.write_compressed(self.compressor.compress(data))
+
+    def write_compressed(self, data):
+        self.compressed_size += len(data)
+        self.fileobj.write(data)
+
+    def close(self):
+        self.write_compressed(self.compressor.flush())
+        if self.size >= 1 << 32 or self.compressed_size >= 1 << 32:
+            raise IOError("KMZ output over 4GB is not supported")
+        crc = self.crc & 0xffffffff
+        descriptor = struct.pack("<IIII", 0x08074b50, crc, self.compressed_size, self.size)
+        directory = (struct.pack("<IH", 0x02014b50, 20) + self.header +
+                     struct.pack("<IIIHHHHHII", crc, self.compressed_size, self.size, len(KMZ_DOCUMENT), 0, 0, 0, 0, 0, 0) + KMZ_DOCUMENT)
+        directory_offset = self.header_size + self.compressed_size + len(descriptor)
+        end = struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, 1, 1, len(directory), directory_offset, 0)
+        self.fileobj.write(descriptor + directory + end)
+
+class Sink(object):
+    """Where text outputs write to. Writes are collected into large blocks before going to <fileobj>,
+    compressed if asked to (gzip, or kmz for KML), and unicode is written as UTF-8."""
+
+    def __init__(self, fileobj=None, compression=None, buffer_size=BUFFER_SIZE):
+        self.fileobj = fileobj if fileobj is not None else sys.stdout
+        if compression == 'gzip':
+            # no file name in the header; the output has none
+            self.target = gzip.GzipFile(filename="", mode='wb', compresslevel=COMPRESS_LEVEL, fileobj=self.fileobj)
+        elif compression == 'kmz':
+            self.target = KmzWriter(self.fileobj)
+        else:
+            self.target = self.fileobj
+        self.buffer_size = buffer_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.target.write("".join(self.parts))
+            self.parts = []
+            self.size = 0
+
+    def close(self):
+        """Write what is left and end the compressed stream. <fileobj> stays open."""
+
+        self.flush()
+        if self.target is not self.fileobj:
+            self.target.close()
+        self.fileobj.flush()
@@ -0,0 +1,122 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import cache
+import in_gpx
+import track
+import utils
+
+GLOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "glot.py")
+
+GPX = '<gpx><trk><name>%s</name><trkseg><trkpt lat="47.1" lon="8.1"/><trkpt lat="47.2" lon="8.2"/></trkseg></trk></gpx>'
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, "cache")
+        self.inputs = [self.write_input("%s_bus.gpx" % name, name) for name in ["a", "b"]]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_input(self, name, content):
+        path = os.path.join(self.directory, name)
+        with file(path, 'w') as f:
+            f.write(GPX % content)
+        return path
+
+    def store(self, parse_cache, filename):
+        with file(filename) as f:
+            packed = "".join(track.pack(t) for t in in_gpx.parse(f, "bus"))
+        parse_cache.store(filename, in_gpx.parse, "bus", packed)
+
+    def read_index(self):
+        with file(os.path.join(self.cache_dir, cache.INDEX_NAME)) as f:
+            return json.load(f)
+
+    def test_round_trip(self):
+        parse_cache = cache.Cache(self.cache_dir)
+        self.assertEqual(parse_cache.read(self.inputs[0], in_gpx.parse, "bus"), None)
+        self.store(parse_cache, self.inputs[0])
+        tracks = parse_cache.read(self.inputs[0], in_gpx.parse, "bus")
+        self.assertEqual([t.name for t in tracks], ["a"])
+        self.assertEqual(tracks[0].lat.tolist(), [47.1, 47.2])
+        # another parser or transportation is another entry
+        self.assertEqual(parse_cache.read(self.inputs[0], in_gpx.parse, "walk"), None)
+        parse_cache.close()
+
+        info = self.read_index()[self.inputs[0]]
+        self.assertEqual(info['sha1'], utils.file_digest(self.inputs[0]))
+        self.assertEqual(info['size'], os.path.getsize(self.inputs[0]))
+        self.assertEqual(len(info['entries']), 1)
+
+    def test_changed_file(self):
+        parse_cache = cache.Cache(self.cache_dir)
+        self.store(parse_cache, self.inputs[0])
+        self.write_input("a_bus.gpx", "changed")
+        os.utime(self.inputs[0], (0, 0))
+        self.assertEqual(parse_cache.read(self.inputs[0], in_gpx.parse, "bus"), None)
+
+    def test_close_prunes_index(self):
+        parse_cache = cache.Cache(self.cache_dir)
+        for filename in self.inputs:
+            self.store(parse_cache, filename)
+        parse_cache.close()
+        self.assertEqual(sorted(self.read_index()), sorted(self.inputs))
+
+        # a deleted input file
+        os.remove(self.inputs[1])
+        cache.Cache(self.cache_dir).close()
+        self.assertEqual(sorted(self.read_index()), self.inputs[:1])
+
+        # evicted entries
+        cache.Cache(self.cache_dir, max_size=0).close()
+        self.assertEqual(self.read_index(), {})
+
+    def test_prepare(self):
+        parse_cache = cache.Cache(self.cache_dir)
+        parse_cache.prepare([(filename, in_gpx.parse, "bus") for filename in self.inputs])
+        self.assertTrue(parse_cache.index_changed)
+        parse_cache.index_changed = False
+        # what a worker does with its copy of the cache
+        hashed = []
+        file_digest = utils.file_digest
+        utils.file_digest = lambda filename: hashed.append(filename) or file_digest(filename)
+        try:
+            for filename in self.inputs:
+                parse_cache.entry_path(filename, in_gpx.parse, "bus")
+        finally:
+            utils.file_digest = file_digest
+        self.assertEqual(hashed, [])
+        self.assertFalse(parse_cache.index_changed)
+
+    def glot(self, *options):
+        process = subprocess.Popen([sys.executable, GLOT, "--cache-dir", self.cache_dir] + list(options) + self.inputs,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        self.assertEqual(process.returncode, 0, err)
+        return out, err
+
+    def test_parallel_stats(self):
+        # the stats workers parse and cache the files; the index is kept by the parent
+        out, err = self.glot("-j", "2", "-o", "stats")
+        index = self.read_index()
+        self.assertEqual(sorted(index), sorted(self.inputs))
+        self.assertTrue(all(os.path.exists(os.path.join(self.cache_dir, info['entries'][0])) for info in index.values()))
+
+        index_path = os.path.join(self.cache_dir, cache.INDEX_NAME)
+        os.utime(index_path, (1000000000, 1000000000))
+        cached_out, err = self.glot("-j", "2", "-o", "stats")
+        self.assertEqual(cached_out, out)
+        self.assertEqual(err.count("from cache"), 2)
+        # nothing new went into the index
+        self.assertEqual(os.stat(index_path).st_mtime, 1000000000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+from StringIO import StringIO
+import bz2
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import compressed
+
+GLOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "glot.py")
+
+def have_xz():
+    try:
+        subprocess.call(["xz", "--version"], stdout=open(os.devnull, 'w'))
+    except OSError:
+        return False
+    return True
+
+HAVE_XZ = compressed.lzma is not None or have_xz()
+
+def sample_data(n=20000):
+    # compresses well, but not into a single read
+    return "".join('<trkpt lat="%.6f" lon="%.6f"><ele>%d</ele></trkpt>\n' % (47 + i * 1e-5, 8 - i * 1e-5, i % 700) for i in xrange(n))
+
+def gzip_data(data):
+    out = StringIO()
+    with gzip.GzipFile(filename="", mode='wb', fileobj=out) as f:
+        f.write(data)
+    return out.getvalue()
+
+def xz_data(data):
+    if compressed.lzma is not None:
+        return compressed.lzma.compress(data)
+    process = subprocess.Popen(["xz", "-c"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return process.communicate(data)[0]
+
+COMPRESS = {'gzip': gzip_data, 'bzip2': bz2.compress, 'xz': xz_data}
+EXTENSION = {'gzip': ".gz", 'bzip2': ".bz2", 'xz': ".xz"}
+
+class CompressedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.read_size = compressed.COMPRESSED_READ_SIZE
+
+    def tearDown(self):
+        compressed.COMPRESSED_READ_SIZE = self.read_size
+        shutil.rmtree(self.directory)
+
+    def compressions(self):
+        return [c for c in sorted(COMPRESS) if c != 'xz' or HAVE_XZ]
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with file(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, path, size=-1):
+        with compressed.open_file(path) as f:
+            if size < 0:
+                return f.read()
+            parts = []
+            while True:
+                part = f.read(size)
+                if not part:
+                    return "".join(parts)
+                self.assertTrue(len(part) <= size)
+                parts.append(part)
+
+    def test_round_trip(self):
+        data = sample_data()
+        for compression in self.compressions():
+            path = self.write("track.gpx" + EXTENSION[compression], COMPRESS[compression](data))
+            self.assertEqual(self.read(path), data, compression)
+            self.assertEqual(self.read(path, 1000), data, compression)
+
+    def test_small_reads(self):
+        data = sample_data(2000)
+        compressed.COMPRESSED_READ_SIZE = 7
+        for compression in self.compressions():
+            path = self.write("track" + EXTENSION[compression], COMPRESS[compression](data))
+            self.assertEqual(self.read(path, 333), data, compression)
+
+    def test_concatenated(self):
+        # concatenated gzip files and pbzip2 output hold several streams
+        data = sample_data(3000)
+        for compression in self.compressions():
+            compress = COMPRESS[compression]
+            path = self.write("track" + EXTENSION[compression], compress(data[:100]) + compress(data[100:5000]) + compress(data[5000:]))
+            self.assertEqual(self.read(path), data, compression)
+            compressed.COMPRESSED_READ_SIZE = 11
+            self.assertEqual(self.read(path, 500), data, compression)
+            compressed.COMPRESSED_READ_SIZE = self.read_size
+
+    def test_truncated(self):
+        for compression in self.compressions():
+            data = COMPRESS[compression](sample_data(3000))
+            path = self.write("track" + EXTENSION[compression], data[:len(data) / 2])
+            self.assertRaises(IOError, self.read, path)
+
+    def test_uncompressed(self):
+        data = sample_data(100)
+        path = self.write("track.gpx", data)
+        with compressed.open_file(path) as f:
+            self.assertTrue(isinstance(f, file))
+            self.assertEqual(f.read(), data)
+        self.assertEqual(self.read(self.write("empty", "")), "")
+
+    def test_names(self):
+        self.assertEqual(compressed.base_name("/data/track.gpx.gz"), "/data/track.gpx")
+        self.assertEqual(compressed.base_name("track.CSV.bz2"), "track.CSV")
+        self.assertEqual(compressed.base_name("track.wkt.xz"), "track.wkt")
+        self.assertEqual(compressed.base_name("track.gpx"), "track.gpx")
+        for compression in self.compressions():
+            self.assertEqual(compressed.detect(COMPRESS[compression]("x")), compression)
+        self.assertEqual(compressed.detect("<?xml"), None)
+        self.assertEqual(compressed.detect(""), None)
+
+    def test_glot(self):
+        # a compressed file gives what the file itself does
+        data = '<gpx><trk><trkseg>%s</trkseg></trk></gpx>' % "".join(
+            '<trkpt lat="%.4f" lon="%.4f"><ele>%d</ele><time>2014-05-01T08:%02d:%02dZ</time></trkpt>' % (47 + i * 1e-3, 8 + i * 1e-3, 400 + i, i / 60, i % 60)
+            for i in xrange(300))
+        path = self.write("track.gpx", data)
+        expected = subprocess.check_output([sys.executable, GLOT, "--no-cache", "-o", "stats", path], stderr=open(os.devnull, 'w'))
+        for compression in self.compressions():
+            compressed_path = self.write("track.gpx" + EXTENSION[compression], COMPRESS[compression](data))
+            out = subprocess.check_output([sys.executable, GLOT, "--no-cache", "-o", "stats", compressed_path], stderr=open(os.devnull, 'w'))
+            self.assertEqual(out.replace(compressed_path, path), expected, compression)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+from collections import defaultdict
+import math
+import unittest
+
+import numpy
+
+import filters
+import track
+import utils
+
+def baseline_name_match(paths, radius):
+    """The coordinates name_match_filter gave when it compared every point with every other one,
+    for paths given as lists of Points."""
+
+    def find_group(groups, point):
+        for group in groups:
+            for p in group:
+                if utils.distance(p, point) <= radius:
+                    return group
+        return None
+
+    all_points = defaultdict(list)
+    for path in paths:
+        for point in path:
+            all_points[point.name].append(point)
+
+    group_coords = {}
+    for name, points in all_points.iteritems():
+        groups = []
+        for point in points:
+            group = find_group(groups, point)
+            if group is None:
+                group = []
+                groups.append(group)
+            group.append(point)
+        group_coords[name] = [(sum(p.lat for p in group) / len(group), sum(p.lon for p in group) / len(group)) for group in groups]
+
+    result = []
+    for path in paths:
+        coords = []
+        for point in path:
+            closest, min_distance = None, None
+            for lat, lon in group_coords[point.name]:
+                d = utils.vincenty_scalar(lat, lon, point.lat, point.lon)
+                if min_distance is None or d < min_distance:
+                    closest, min_distance = (lat, lon), d
+            coords.append(closest)
+        result.append(coords)
+    return result
+
+def clustered_paths(random, radius, clusters, spread, points=40):
+    """Paths through up to <points> points each, scattered around <clusters> centres which are up to
+    <spread> radii apart from each other; the points are up to about one radius from their centre."""
+
+    base_lat, base_lon = random.uniform(-70, 70), random.uniform(-180, 180)
+    metre = 1 / 111195.0
+    centres = [(base_lat + random.uniform(0, spread * radius) * metre,
+                base_lon + random.uniform(0, spread * radius) * metre / math.cos(math.radians(base_lat)))
+               for i in xrange(clusters)]
+    paths = []
+    for i in xrange(random.randint(1, 4)):
+        builder = track.TrackBuilder()
+        for j in xrange(random.randint(1, points)):
+            lat, lon = centres[random.randint(clusters)]
+            d, bearing = random.uniform(0, 1.2 * radius), random.uniform(0, 2 * math.pi)
+            name = ["Stop A", "Stop B", None][random.randint(3)]
+            builder.append(lat + d * math.cos(bearing) * metre, lon + d * math.sin(bearing) * metre / math.cos(math.radians(lat)), name=name)
+        paths.append(builder.build())
+    return paths
+
+class NameMatchTest(unittest.TestCase):
+
+    def check(self, paths, radius):
+        expected = baseline_name_match([list(path.points) for path in paths], radius)
+        filtered = list(filters.name_match_filter(radius)(paths))
+        self.assertEqual([zip(path.lat.tolist(), path.lon.tolist()) for path in filtered], expected)
+        # only the coordinates change
+        for path, original in zip(filtered, paths):
+            self.assertEqual(path.point_names(), original.point_names())
+
+    def test_like_baseline(self):
+        random = numpy.random.RandomState(8)
+        for trial in xrange(40):
+            radius = [1, 15, 200, 3000][trial % 4]
+            # a few cells, where the closest group is found by looking at all of them, and many
+            for clusters, spread, points in [(3, 2, 40), (30, 40, 40), (150, 30, 150)]:
+                self.check(clustered_paths(random, radius, clusters, spread, points), radius)
+
+    def test_chunks(self):
+        random = numpy.random.RandomState(9)
+        paths = clustered_paths(random, 50, 10, 10)
+        chunks = []
+        for path in paths:
+            for start in xrange(0, len(path), 7):
+                chunk = path.take(slice(start, start + 7))
+                chunk.continues = start > 0
+                chunks.append(chunk)
+        filtered = list(filters.name_match_filter(50)(chunks))
+        self.assertEqual([len(path) for path in filtered], [len(path) for path in paths])
+        self.assertEqual([zip(path.lat.tolist(), path.lon.tolist()) for path in filtered],
+                         baseline_name_match([list(path.points) for path in paths], 50))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+from StringIO import StringIO
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import in_columbus
+import track
+import utils
+
+HEADER = "INDEX,TAG,DATE,TIME,LATITUDE N/S,LONGITUDE E/W,HEIGHT,SPEED,HEADING,VOX\n"
+
+LINES = [
+    "1   ,T,140501,080000,47.376900N,008.541700E,408 ,12 ,0  ,    ",
+    "2   ,T,140501,080005,47.377000N,008.542000E,-12 ,15 ,0  ,    ",
+    "3\x00\x00  ,T,140501,080010,33.856800S,151.215300E,5   ,15 ,0  ,    ",
+    "4   ,T,681231,235959,40.712800N,074.006000W,10  ,15 ,0  ,    ",
+    "5   ,T,690101,000000,40.712800N,074.006000W,10  ,15 ,0  ,    ",
+    "6   ,T,000229,120000,0.000000N,0.000000E,0   ,15 ,0  ,    ",
+    "7   ,T,140230,080000,47.376900N,008.541700E,408 ,12 ,0  ,    ",
+    "8   ,T,140501,080060,47.376900N,008.541700E,408 ,12 ,0  ,    ",
+    "9   ,T,140501,080015,47.376900X,008.541700E,408 ,12 ,0  ,    ",
+    "10  ,T,140501,080020,,008.541700E,408 ,12 ,0  ,    ",
+    "11  ,T,140501,0800,47.376900N,008.541700E,408 ,12 ,0  ,    ",
+    "12  ,T,140501,080025,47.376900N,008.541700E,4.5 ,12 ,0  ,    ",
+    "13  ,T,140501,080030,47.377900N,008.543700E,411 ,12 ,0  ,    ",
+]
+
+def baseline_points(text):
+    """The points and bad lines the line by line reader glot started with gives for <text>,
+    except that the NULs padding the end of a file aren't reported as a bad line any more."""
+
+    points, errors = [], []
+    for i, line in enumerate(text.splitlines(True), 1):
+        if not line.strip("\x00"):
+            continue
+        parts = [p.replace("\x00", "") for p in line.split(",")]
+        if parts[0] == "INDEX":
+            continue
+        try:
+            lat = utils.parse_latlon(parts[4])
+            lon = utils.parse_latlon(parts[5])
+            ele = int(parts[6])
+            time = datetime.datetime.strptime(parts[2] + parts[3], "%y%m%d%H%M%S")
+        except:
+            errors.append(i)
+            continue
+        if lat is None or lon is None:
+            continue
+        points.append(utils.Point(lat, lon, ele, time, None))
+    return points, errors
+
+class ColumbusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stderr = sys.stderr
+        self.block_size = in_columbus.BLOCK_SIZE
+        self.min_decode_lines = in_columbus.MIN_DECODE_LINES
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        in_columbus.BLOCK_SIZE = self.block_size
+        in_columbus.MIN_DECODE_LINES = self.min_decode_lines
+        shutil.rmtree(self.directory)
+
+    def parse(self, text, from_file):
+        sys.stderr = StringIO()
+        if from_file:
+            path = os.path.join(self.directory, "track.CSV")
+            with file(path, 'wb') as f:
+                f.write(text)
+            with file(path, 'rb') as f:
+                tracks = list(in_columbus.parse(f, "bike"))
+        else:
+            tracks = list(in_columbus.parse(StringIO(text), "bike"))
+        errors = [int(line.split()[-1]) for line in sys.stderr.getvalue().splitlines()]
+        return tracks, errors
+
+    def check(self, text):
+        expected_points, expected_errors = baseline_points(text)
+        for from_file in [True, False]:
+            tracks, errors = self.parse(text, from_file)
+            self.assertEqual([p for t in tracks for p in t.points], expected_points)
+            self.assertEqual(errors, expected_errors)
+            self.assertEqual([t.continues for t in tracks], [False] + [True] * (len(tracks) - 1))
+            self.assertTrue(all(t.transportation == "bike" for t in tracks))
+
+    def test_like_baseline(self):
+        self.check(HEADER + "\n".join(LINES) + "\n")
+
+    def test_good_lines(self):
+        # read in bulk
+        text = HEADER + "".join(line + "\n" for line in LINES[:6] + LINES[-1:]) + "\x00" * 40
+        tracks, errors = self.parse(text, True)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(tracks[0]), 7)
+        self.assertEqual(tracks[0].time[0], 1398931200 * track.SECOND)
+        self.check(text)
+
+    def test_leap_second(self):
+        # strptime reads it, but it isn't a valid datetime
+        text = HEADER + "".join(line + "\n" for line in [LINES[0], LINES[1], LINES[7], LINES[12]])
+        tracks, errors = self.parse(text, True)
+        self.assertEqual(errors, [4])
+        self.check(text)
+
+    def test_blocks(self):
+        lines = (LINES * 40)[:500]
+        text = HEADER + "".join(line + "\n" for line in lines)
+        in_columbus.BLOCK_SIZE = 1000
+        in_columbus.MIN_DECODE_LINES = 4
+        self.check(text)
+        self.check(text.rstrip("\n"))
+
+    def test_empty(self):
+        for text in ["", HEADER]:
+            for from_file in [True, False]:
+                tracks, errors = self.parse(text, from_file)
+                self.assertEqual([len(t) for t in tracks], [0])
+
+if __name__ == '__main__':
+    unittest.main()
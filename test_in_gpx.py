@@ -0,0 +1,99 @@
+from StringIO import StringIO
+import datetime
+import math
+import unittest
+
+import in_gpx
+import track
+import utils
+
+GPX = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test">
+ <trk>
+  <name> Morning ride </name>
+  <trkseg>
+   <trkpt lat="47.3769" lon="8.5417"><ele>408.5</ele><time>2014-05-01T08:00:00Z</time><name>Start</name></trkpt>
+   <trkpt lat="47.3770" lon="8.5420"><ele> 409 </ele><time>2014-05-01T08:00:05Z</time></trkpt>
+   <trkpt lat="47.3772" lon="8.5424"><time>2014-05-01T10:00:10+02:00</time><name>Caf\xc3\xa9</name></trkpt>
+  </trkseg>
+ </trk>
+ <rte>
+  <rtept lat="46.9480" lon="7.4474"/>
+  <rtept lat="46.9490" lon="7.4480"><ele>540</ele></rtept>
+ </rte>
+</gpx>
+"""
+
+START = datetime.datetime(2014, 5, 1, 8, 0, 0)
+
+def parse(text, transportation=None):
+    return list(in_gpx.parse(StringIO(text), transportation))
+
+def point_gpx(content):
+    return '<gpx><trk><trkseg><trkpt lat="1.5" lon="2.5">%s</trkpt></trkseg></trk></gpx>' % content
+
+class GpxTest(unittest.TestCase):
+
+    def test_parse(self):
+        trk, rte = parse(GPX, "bike")
+        self.assertEqual(trk.name, "Morning ride")
+        self.assertEqual(trk.transportation, "bike")
+        self.assertEqual(trk.lat.tolist(), [47.3769, 47.3770, 47.3772])
+        self.assertEqual(trk.lon.tolist(), [8.5417, 8.5420, 8.5424])
+        self.assertEqual(trk.ele[:2].tolist(), [408.5, 409])
+        self.assertTrue(math.isnan(trk.ele[2]))
+        self.assertEqual([p.time for p in trk.points], [START, START + datetime.timedelta(seconds=5), START + datetime.timedelta(seconds=10)])
+        self.assertEqual(trk.point_names(), ["Start", None, u"Caf\xe9"])
+        self.assertEqual(rte.name, None)
+        self.assertEqual(rte.lat.tolist(), [46.9480, 46.9490])
+        self.assertFalse(rte.has_time())
+
+    def test_points(self):
+        # the same points as the utils.Point objects of the SAX parser this one replaced
+        trk = parse(GPX)[0]
+        self.assertEqual(trk.points[0], utils.Point(47.3769, 8.5417, 408.5, START, "Start"))
+        self.assertEqual(trk.points[2], utils.Point(47.3772, 8.5424, None, START + datetime.timedelta(seconds=10), u"Caf\xe9"))
+
+    def test_empty_elements(self):
+        for content in ["<ele/><time/><name/>", "<ele></ele><time> </time><name>\n</name>"]:
+            t, = parse(point_gpx(content))
+            p = t.points[0]
+            self.assertEqual((p.ele, p.time, p.name), (None, None, None))
+
+    def test_empty_track_name(self):
+        t, = parse('<gpx><trk><name></name><trkseg><trkpt lat="1" lon="2"/></trkseg></trk></gpx>')
+        self.assertEqual(t.name, None)
+
+    def test_time_formats(self):
+        for value in ["2014-05-01T08:00:00Z", "2014-05-01T08:00:00", "2014-05-01T09:30:00+01:30", "2014-05-01T06:00:00-02:00"]:
+            t, = parse(point_gpx("<time>%s</time>" % value))
+            self.assertEqual(t.points[0].time, START, value)
+
+    def test_fractions(self):
+        for value, microseconds in [("2014-05-01T08:00:00.5Z", 500000), ("2014-05-01T08:00:00.123456789Z", 123456),
+                                    ("2014-05-01T10:00:00.25+02:00", 250000), ("2014-05-01T08:00:00.000123", 123)]:
+            t, = parse(point_gpx("<time>%s</time>" % value))
+            self.assertEqual(t.time[0], track.to_epoch(START) + microseconds, value)
+            self.assertEqual(t.points[0].time, START + datetime.timedelta(microseconds=microseconds), value)
+
+    def test_bad_time(self):
+        self.assertRaises(Exception, parse, point_gpx("<time>yesterday</time>"))
+
+    def test_small_reads(self):
+        read_size = utils.READ_SIZE
+        utils.READ_SIZE = 7
+        try:
+            tracks = parse(GPX)
+        finally:
+            utils.READ_SIZE = read_size
+        expected = parse(GPX)
+        self.assertEqual([list(t.points) for t in tracks], [list(t.points) for t in expected])
+
+    def test_chunks(self):
+        points = "".join('<trkpt lat="%s" lon="1"/>' % (i * 1e-5) for i in xrange(track.CHUNK_SIZE + 10))
+        chunks = parse("<gpx><trk><trkseg>%s</trkseg></trk></gpx>" % points)
+        self.assertEqual([len(t) for t in chunks], [track.CHUNK_SIZE, 10])
+        self.assertEqual([t.continues for t in chunks], [False, True])
+
+if __name__ == '__main__':
+    unittest.main()
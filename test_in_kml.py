@@ -0,0 +1,75 @@
+from StringIO import StringIO
+import math
+import re
+import unittest
+
+import in_kml
+import track
+import utils
+
+KML = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2"><Document>
+<Placemark><name>Point</name><Point><coordinates>8.5,47.3,400</coordinates></Point></Placemark>
+<Placemark><name>Line</name><LineString><tessellate>1</tessellate><coordinates>
+  8.5417,47.3769,408.5 8.5420,47.3770,409
+\t8.5424,47.3772,410.25
+</coordinates></LineString></Placemark>
+<Placemark><MultiGeometry>
+ <LineString><coordinates>-0.1276,51.5072,11 -0.1280,51.5080,12.5</coordinates></LineString>
+ <Polygon><outerBoundaryIs><LinearRing><coordinates>7.44,46.94,540 7.45,46.94,541 7.45,46.95,542 7.44,46.94,540</coordinates></LinearRing></outerBoundaryIs></Polygon>
+</MultiGeometry></Placemark>
+</Document></kml>
+"""
+
+def baseline_points(text):
+    """The points of every LineString and LinearRing, as the SAX handler glot started with read them
+    (given the whole text of each <coordinates> element at once)."""
+
+    paths = []
+    for element in re.findall(r"<(?:LineString|LinearRing)>.*?<coordinates>(.*?)</coordinates>", text, re.S):
+        paths.append([utils.Point(lat, lng, ele, None, None) for lng, lat, ele in [map(float, p.split(",")) for p in element.strip().split()]])
+    return paths
+
+def parse(text, transportation=None):
+    return list(in_kml.parse(StringIO(text), transportation))
+
+def points(tracks):
+    return [list(t.points) for t in track.join_chunks(tracks)]
+
+class KmlTest(unittest.TestCase):
+
+    def test_like_baseline(self):
+        tracks = parse(KML, "walk")
+        self.assertEqual(points(tracks), baseline_points(KML))
+        self.assertTrue(all(t.transportation == "walk" for t in tracks))
+
+    def test_small_reads(self):
+        read_size = utils.READ_SIZE
+        utils.READ_SIZE = 5
+        try:
+            tracks = parse(KML)
+        finally:
+            utils.READ_SIZE = read_size
+        self.assertEqual(points(tracks), baseline_points(KML))
+
+    def test_long_line(self):
+        coordinates = " ".join("%.6f,%.6f,%d" % (8 + i * 1e-6, 47 - i * 1e-6, i % 500) for i in xrange(track.CHUNK_SIZE + 100))
+        text = "<kml><Placemark><LineString><coordinates>%s</coordinates></LineString></Placemark></kml>" % coordinates
+        tracks = parse(text)
+        self.assertEqual([len(t) for t in tracks], [track.CHUNK_SIZE, 100])
+        self.assertEqual([t.continues for t in tracks], [False, True])
+        self.assertEqual(points(tracks), baseline_points(text))
+
+    def test_2d(self):
+        t, = parse("<kml><LineString><coordinates>8.5,47.3 8.6,47.4</coordinates></LineString></kml>")
+        self.assertEqual(t.lat.tolist(), [47.3, 47.4])
+        self.assertFalse(t.has_ele())
+
+    def test_mixed_dimensions(self):
+        t, = parse("<kml><LineString><coordinates>8.5,47.3 8.6,47.4,12 8.7,47.5</coordinates></LineString></kml>")
+        self.assertEqual(t.lon.tolist(), [8.5, 8.6, 8.7])
+        self.assertEqual(t.ele[1], 12)
+        self.assertTrue(math.isnan(t.ele[0]) and math.isnan(t.ele[2]))
+
+if __name__ == '__main__':
+    unittest.main()
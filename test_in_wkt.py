@@ -0,0 +1,101 @@
+from StringIO import StringIO
+import unittest
+
+import numpy
+
+import in_wkt
+import track
+
+try:
+    from shapely import wkt
+except ImportError:
+    wkt = None
+
+GEOMETRIES = [
+    "POINT (8.5 47.3)",
+    "POINT Z (8.5 47.3 400)",
+    "LINESTRING (8.5417 47.3769, 8.542 47.377, 8.5424 47.3772)",
+    "LINESTRING Z (8.5 47.3 400.5, 8.6 47.4 401, 8.7 47.5 402)",
+    "LINESTRING ZM (8.5 47.3 400 1, 8.6 47.4 401 2)",
+    "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0), (2 2, 4 2, 4 4, 2 2))",
+    "MULTIPOINT ((1 2), (3 4), (5 6))",
+    "MULTIPOINT (1 2, 3 4)",
+    "MULTILINESTRING ((1 1, 2 2), (3 3, 4 4, 5 5))",
+    "MULTIPOLYGON (((0 0, 1 0, 1 1, 0 0)), ((5 5, 6 5, 6 6, 5 5), (5.2 5.1, 5.5 5.1, 5.5 5.4, 5.2 5.1)))",
+    "GEOMETRYCOLLECTION (POINT (1 2), LINESTRING (3 4, 5 6), POLYGON ((0 0, 1 0, 1 1, 0 0)))",
+    "linestring(1e-3 -2.5E1,+3 4)",
+    "POINT EMPTY",
+    "LINESTRING EMPTY",
+]
+
+def parse(text):
+    return list(in_wkt.parse(StringIO(text), "boat"))
+
+def coordinates(tracks):
+    return [(t.lon.tolist(), t.lat.tolist(), t.ele.tolist()) for t in track.join_chunks(tracks)]
+
+def shapely_coordinates(text):
+    return [(lon.tolist(), lat.tolist(), numpy.asarray(ele, dtype=numpy.float32).tolist())
+            for lon, lat, ele in in_wkt.shape_coordinates(wkt.loads(text))]
+
+def same(a, b):
+    # NaN elevations compare equal
+    return repr(a) == repr(b)
+
+class WktTest(unittest.TestCase):
+
+    def setUp(self):
+        self.block_size = in_wkt.BLOCK_SIZE
+
+    def tearDown(self):
+        in_wkt.BLOCK_SIZE = self.block_size
+
+    @unittest.skipIf(wkt is None, "shapely isn't installed")
+    def test_like_shapely(self):
+        for text in GEOMETRIES:
+            self.assertTrue(same(coordinates(parse(text)), shapely_coordinates(text)), text)
+
+    @unittest.skipIf(wkt is None, "shapely isn't installed")
+    def test_small_blocks(self):
+        text = "\n".join(GEOMETRIES)
+        expected = coordinates(parse(text))
+        in_wkt.BLOCK_SIZE = 3
+        self.assertTrue(same(coordinates(parse(text)), expected))
+        self.assertTrue(same(expected, sum([shapely_coordinates(g) for g in GEOMETRIES], [])))
+
+    def test_polygon(self):
+        # the exterior and every interior ring is a path
+        tracks = parse("POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0), (2 2, 4 2, 4 4, 2 2))")
+        self.assertEqual([len(t) for t in tracks], [5, 4])
+        self.assertEqual(tracks[1].lon.tolist(), [2, 4, 4, 2])
+        self.assertTrue(all(t.transportation == "boat" and not t.continues for t in tracks))
+        self.assertFalse(tracks[0].has_ele())
+
+    def test_measures(self):
+        # M is a measure, not an elevation (the GEOS shapely uses reads it as Z)
+        t, = parse("LINESTRING M (8.5 47.3 1, 8.6 47.4 2)")
+        self.assertEqual(t.lat.tolist(), [47.3, 47.4])
+        self.assertFalse(t.has_ele())
+        t, = parse("LINESTRING ZM (8.5 47.3 400 1, 8.6 47.4 401 2)")
+        self.assertEqual(t.ele.tolist(), [400, 401])
+
+    def test_srid(self):
+        self.assertTrue(same(coordinates(parse("SRID=4326;POINT (8.5 47.3)")), coordinates(parse("POINT (8.5 47.3)"))))
+
+    def test_long_line(self):
+        n = track.CHUNK_SIZE + 5
+        text = "LINESTRING (%s)" % ", ".join("%d %d" % (i, -i) for i in xrange(n))
+        in_wkt.BLOCK_SIZE = 1000
+        tracks = parse(text)
+        self.assertEqual([len(t) for t in tracks], [track.CHUNK_SIZE, 5])
+        self.assertEqual([t.continues for t in tracks], [False, True])
+        lon, lat, ele = coordinates(tracks)[0]
+        self.assertEqual(lon, range(n))
+        self.assertEqual(lat, [-i for i in xrange(n)])
+
+    def test_errors(self):
+        for text in ["LINESTRING (1 2, 3 4", "LINESTRING (1 2, 3 4))", "LINESTRING (1 2, 3)", "(1 2)", "POLYGON ((0 0, 1 1) x)"]:
+            self.assertRaises(ValueError, parse, text)
+
+if __name__ == '__main__':
+    unittest.main()
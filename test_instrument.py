@@ -0,0 +1,64 @@
+import multiprocessing
+import unittest
+
+import instrument
+import track
+
+def parse(n):
+    return [track.Track([0.0] * n, [0.0] * n)]
+
+def count(n):
+    paths = parse(n)
+    if instrument.current is not None:
+        paths = instrument.current.wrap("parse %d" % n, paths)
+    return sum(len(path) for path in paths)
+
+def count_in_worker(n):
+    return instrument.in_worker(count, n)
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = instrument.current = instrument.Profile()
+
+    def tearDown(self):
+        instrument.current = None
+
+    def stages(self):
+        return dict((stats.name, stats) for stats in self.profile.stages)
+
+    def test_nested_stages(self):
+        paths = self.profile.wrap("parse a", parse(5) + parse(2))
+        self.assertEqual(self.profile.call("output test", lambda: sum(len(path) for path in paths)), 7)
+        stages = self.stages()
+        self.assertEqual((stages["parse a"].points_in, stages["parse a"].points_out), (0, 7))
+        self.assertEqual((stages["output test"].points_in, stages["output test"].points_out), (7, 0))
+        self.assertEqual(stages["output test"].inner_wall, stages["parse a"].wall)
+
+    def test_workers(self):
+        def run():
+            pool = multiprocessing.Pool(2)
+            try:
+                results = pool.map(count_in_worker, [3, 4, 3])
+            finally:
+                pool.terminate()
+                pool.join()
+            for result, measured in results:
+                instrument.merge(measured)
+            return [result for result, measured in results]
+
+        self.assertEqual(self.profile.call("output test", run), [3, 4, 3])
+        stages = self.stages()
+        self.assertEqual(sorted(stages), ["output test", "parse 3", "parse 4"])
+        self.assertEqual(stages["parse 3"].points_out, 6)
+        self.assertEqual(stages["parse 4"].points_out, 4)
+        self.assertEqual(stages["output test"].points_in, 10)
+        self.assertTrue(stages["output test"].inner_wall >= stages["parse 3"].wall + stages["parse 4"].wall - 1e-9)
+
+    def test_not_profiled(self):
+        instrument.current = None
+        self.assertEqual(count_in_worker(0), (0, None))
+        instrument.merge(None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+
+import numpy
+
+import mvt
+
+ZOOM, TILE_X, TILE_Y = 13, 4289, 2866
+
+def line(*points):
+    x, y = zip(*points)
+    return mvt.tile_lonlat(numpy.array(x), numpy.array(y), ZOOM, TILE_X, TILE_Y)
+
+def features(data):
+    layer, = mvt.decode_tile(data)
+    return layer['features']
+
+def geometry_data(data):
+    # the packed commands of every feature, read with the scalar decoder
+    fields = list(mvt.read_message(data))
+    layer = dict((field, value) for field, wire_type, value in fields)[3]
+    commands = []
+    for field, wire_type, value in mvt.read_message(layer):
+        if field == 2:
+            geometry = dict((f, v) for f, w, v in mvt.read_message(value))[4]
+            values, pos = [], 0
+            while pos < len(geometry):
+                value, pos = mvt.read_varint(geometry, pos)
+                values.append(value)
+            commands.append(values)
+    return commands
+
+class MvtTest(unittest.TestCase):
+
+    def test_varints(self):
+        values = [0, 1, 127, 128, 300, 16383, 16384, (1 << 32) + 5, (1 << 63) + 1, (1 << 64) - 1]
+        data = mvt.varints(numpy.array(values, dtype=numpy.uint64))
+        self.assertEqual(data, "".join(mvt.varint(value) for value in values))
+        self.assertEqual(mvt.read_varints(data).tolist(), values)
+        self.assertEqual(mvt.varint(300), "\xac\x02")
+        self.assertEqual(mvt.varints([]), "")
+        self.assertEqual(mvt.read_varints("").tolist(), [])
+
+    def test_zigzag(self):
+        values = [0, -1, 1, -2, 2, 2147483647, -2147483648, (1 << 62), -(1 << 62)]
+        self.assertEqual(mvt.zigzag(values)[:5].tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(mvt.unzigzag(mvt.zigzag(values)).tolist(), values)
+
+    def test_spec_example(self):
+        # the linestring example of the vector tile specification, section 4.3.5
+        data = mvt.encode_tile(ZOOM, TILE_X, TILE_Y, [line((2, 2), (2, 10), (10, 10))])
+        self.assertEqual(geometry_data(data), [[9, 4, 4, 18, 0, 16, 16, 0]])
+        # the cursor starts at 0, 0 again in the next feature
+        data = mvt.encode_tile(ZOOM, TILE_X, TILE_Y, [line((2, 2), (2, 10), (10, 10)), line((1, 1), (3, 5))])
+        self.assertEqual(geometry_data(data), [[9, 4, 4, 18, 0, 16, 16, 0], [9, 2, 2, 10, 4, 8]])
+
+    def test_layer(self):
+        data = mvt.encode_tile(ZOOM, TILE_X, TILE_Y, [])
+        layer, = mvt.decode_tile(data)
+        self.assertEqual(layer, {'name': mvt.LAYER_NAME, 'extent': mvt.EXTENT, 'features': []})
+        (field, wire_type, layer_data), = mvt.read_message(data)
+        # version 2 of the format
+        self.assertIn((15, mvt.VARINT, 2), list(mvt.read_message(layer_data)))
+
+    def test_round_trip(self):
+        random = numpy.random.RandomState(3)
+        lines = []
+        for n in [2, 50, 1000]:
+            x = numpy.cumsum(random.randint(-40, 41, n)) + 2000
+            y = numpy.cumsum(random.randint(-40, 41, n)) + 2000
+            lines.append(line(*zip(x, y)))
+        decoded = features(mvt.encode_tile(ZOOM, TILE_X, TILE_Y, lines))
+        self.assertEqual(len(decoded), len(lines))
+        for feature, (lon, lat) in zip(decoded, lines):
+            self.assertEqual(feature['type'], mvt.LINESTRING)
+            (x, y), = feature['geometry']
+            expected_x, expected_y = mvt.tile_coordinates(lon, lat, ZOOM, TILE_X, TILE_Y)
+            kept = numpy.concatenate([[True], (numpy.diff(expected_x) != 0) | (numpy.diff(expected_y) != 0)])
+            self.assertEqual(x.tolist(), expected_x[kept].tolist())
+            self.assertEqual(y.tolist(), expected_y[kept].tolist())
+            decoded_lon, decoded_lat = mvt.tile_lonlat(x, y, ZOOM, TILE_X, TILE_Y)
+            # within half a grid unit
+            self.assertTrue(numpy.abs(decoded_lon - lon[kept]).max() <= 360.0 / 2 ** ZOOM / mvt.EXTENT / 2 + 1e-12)
+
+    def test_merged_points(self):
+        # repeated points are merged and lines left with one point dropped
+        lines = [line((5, 5), (5, 5), (6, 5), (6, 5)), line((7, 7), (7, 7)), line((8, 8)), line((-20, 4100), (4200, -5))]
+        decoded = features(mvt.encode_tile(ZOOM, TILE_X, TILE_Y, lines))
+        self.assertEqual([[(x.tolist(), y.tolist()) for x, y in f['geometry']] for f in decoded],
+                         [[([5, 6], [5, 5])], [([-20, 4200], [4100, -5])]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import out_geojson_tiles
+import utils
+
+GLOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "glot.py")
+
+def gpx(points):
+    trkpts = "".join('<trkpt lat="%s" lon="%s"><time>2014-05-01T10:%02d:%02dZ</time></trkpt>' % (lat, lon, i // 60, i % 60)
+                     for i, (lat, lon) in enumerate(points))
+    return '<?xml version="1.0"?><gpx><trk><trkseg>%s</trkseg></trk></gpx>' % trkpts
+
+def walk(lat, lon, count=200):
+    # a point every 2 seconds, far enough apart not to count as stopped
+    return [(lat + i * 0.0002, lon + i * 0.0001) for i in xrange(count)]
+
+def read_tiles(directory):
+    tiles = {}
+    for name in os.listdir(directory):
+        if name != out_geojson_tiles.MANIFEST_NAME:
+            with file(os.path.join(directory, name)) as f:
+                tiles[name] = f.read()
+    return tiles
+
+class TileManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.inputs = []
+        for i, (lat, lon) in enumerate([(47.37, 8.54), (47.40, 8.50), (46.95, 7.44)]):
+            self.inputs.append(self.write_input("track%d.gpx" % i, walk(lat, lon)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_input(self, name, points):
+        path = os.path.join(self.directory, name)
+        with file(path, 'w') as f:
+            f.write(gpx(points))
+        return path
+
+    def glot(self, tiles, options=(), inputs=None):
+        if not os.path.isdir(os.path.join(self.directory, tiles)):
+            os.mkdir(os.path.join(self.directory, tiles))
+        subprocess.check_call([sys.executable, GLOT, "--no-cache"] + list(options) +
+                              ["-o", "geojson-tiles:10,13,%s" % os.path.join(self.directory, tiles)] + (inputs or self.inputs),
+                              stderr=open(os.devnull, 'w'))
+        return read_tiles(os.path.join(self.directory, tiles))
+
+    def test_filters_force_rebuild(self):
+        unfiltered = self.glot("tiles")
+        filtered = self.glot("tiles", ["-f", "skip=20"])
+        self.assertNotEqual(unfiltered, filtered)
+        self.assertEqual(filtered, self.glot("fresh", ["-f", "skip=20"]))
+        self.assertEqual(unfiltered, self.glot("tiles"))
+
+    def test_changed_input(self):
+        self.glot("tiles")
+        self.write_input("track1.gpx", walk(47.41, 8.51))
+        self.assertEqual(self.glot("tiles"), self.glot("fresh"))
+
+    def test_removed_input(self):
+        self.glot("tiles")
+        self.assertEqual(self.glot("tiles", inputs=self.inputs[:2]), self.glot("fresh", inputs=self.inputs[:2]))
+
+    def test_unchanged_inputs_not_hashed(self):
+        self.glot("tiles")
+        hashed = []
+        file_digest = utils.file_digest
+        utils.file_digest = lambda filename: hashed.append(filename) or file_digest(filename)
+        try:
+            manifest = out_geojson_tiles.read_manifest(os.path.join(self.directory, "tiles"))
+            info = [utils.file_info(source, manifest['inputs'][source]) for source in self.inputs]
+        finally:
+            utils.file_digest = file_digest
+        self.assertEqual(hashed, [])
+        self.assertEqual([i['sha1'] for i in info], [file_digest(source) for source in self.inputs])
+
+    def test_settings(self):
+        self.glot("tiles", ["-f", "skip=20"])
+        with file(os.path.join(self.directory, "tiles", out_geojson_tiles.MANIFEST_NAME)) as f:
+            settings = json.load(f)['settings']
+        self.assertEqual(settings['filters'], ["discard-stopped", "skip=20"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+from StringIO import StringIO
+import json
+import unittest
+
+import numpy
+
+import out_stats
+import track
+
+def sample_path(n=50):
+    random = numpy.random.RandomState(2)
+    lat = 47.0 + numpy.cumsum(random.choice([0, 0, 1e-4, 2e-4], n))
+    lon = 8.0 + numpy.cumsum(random.choice([0, 1e-4], n))
+    ele = random.uniform(400, 500, n).astype(numpy.float32)
+    time = 1398931200 * track.SECOND + numpy.cumsum(random.randint(1, 4 * track.SECOND, n))
+    return track.Track(lat, lon, ele, time, transportation="bike", source="/data/ride.gpx")
+
+def pieces(path, bounds):
+    bounds = [0] + bounds + [len(path)]
+    return [path.take(slice(start, end)) for start, end in zip(bounds, bounds[1:])]
+
+def of_piece(piece):
+    return out_stats.PathStats.of_chunk(piece, True, True)
+
+def merged(*stats):
+    result = out_stats.PathStats(True, True)
+    for s in stats:
+        result.merge(s)
+    return result
+
+class PathStatsTest(unittest.TestCase):
+
+    def assertSameStats(self, a, b):
+        a, b = a.to_dict(), b.to_dict()
+        self.assertEqual(sorted(a), sorted(b))
+        for key in a:
+            if isinstance(a[key], float):
+                self.assertAlmostEqual(a[key], b[key], 6, key)
+            else:
+                self.assertEqual(a[key], b[key], key)
+
+    def test_associative(self):
+        path = sample_path()
+        whole = of_piece(path)
+        a, b, c, d = [of_piece(piece) for piece in pieces(path, [7, 8, 30])]
+        self.assertSameStats(merged(merged(a, b), merged(c, d)), whole)
+        self.assertSameStats(merged(a, merged(b, merged(c, d))), whole)
+        self.assertSameStats(merged(merged(merged(a, b), c), d), whole)
+        self.assertSameStats(merged(a, b, c, d), whole)
+        self.assertEqual(merged(a, b, c, d).moving_time + merged(a, b, c, d).stopped_time, int(path.time[-1] - path.time[0]))
+
+    def test_empty_parts(self):
+        path = sample_path()
+        empty = of_piece(path.take(slice(0, 0)))
+        self.assertSameStats(merged(empty, of_piece(path), empty), of_piece(path))
+
+    def test_missing_times(self):
+        path = sample_path()
+        time = path.time.copy()
+        time[10:20] = track.NO_TIME
+        path = path.copy_with(time=time)
+        a, b, c = [of_piece(piece) for piece in pieces(path, [15, 25])]
+        self.assertSameStats(merged(merged(a, b), c), of_piece(path))
+        self.assertSameStats(merged(a, merged(b, c)), of_piece(path))
+
+    def test_chunks(self):
+        # a path read in chunks has the same stats as the whole path
+        path = sample_path(200)
+        chunks = pieces(path, [64, 128, 192])
+        for chunk in chunks[1:]:
+            chunk.continues = True
+        stats, = out_stats.path_stats(chunks)
+        self.assertSameStats(stats, out_stats.path_stats([path])[0])
+        self.assertEqual(stats.point_count, 200)
+
+    def test_json(self):
+        out = StringIO()
+        out_stats.write_json(out_stats.path_stats([sample_path()]), out)
+        data = json.loads(out.getvalue())
+        path, = data['paths']
+        self.assertEqual(path['points'], 50)
+        self.assertEqual(path['moving_time_s'] + path['stopped_time_s'], path['time_s'])
+        self.assertEqual(data['totals']['moving_time_s'], path['moving_time_s'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+from StringIO import StringIO
+import gzip
+import unittest
+import zipfile
+
+import numpy
+
+import out_kml
+import out_wkt
+import output
+import track
+
+def sample_paths(n=3000):
+    random = numpy.random.RandomState(4)
+    lat = 47.0 + numpy.cumsum(random.uniform(-1e-4, 1e-4, n))
+    lon = 8.0 + numpy.cumsum(random.uniform(-1e-4, 1e-4, n))
+    ele = random.uniform(400, 500, n).astype(numpy.float32)
+    time = 1398931200 * track.SECOND + numpy.arange(n) * track.SECOND
+    return [track.Track(lat, lon, ele, time, name="ride"), track.Track(lat[:10] + 1, lon[:10], ele[:10], time[:10])]
+
+def kml(compression=None, buffer_size=output.BUFFER_SIZE, **options):
+    f = StringIO()
+    out = output.Sink(f, compression, buffer_size)
+    out_kml.gen(sample_paths(), output_points=True, out=out, **options)
+    out.close()
+    return f.getvalue()
+
+class CountingFile(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+class OutputTest(unittest.TestCase):
+
+    def test_kmz(self):
+        expected = kml()
+        # a small buffer makes for many compressed writes
+        for buffer_size in [output.BUFFER_SIZE, 1000]:
+            archive = zipfile.ZipFile(StringIO(kml('kmz', buffer_size)))
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(archive.namelist(), [output.KMZ_DOCUMENT])
+            info, = archive.infolist()
+            self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(info.file_size, len(expected))
+            self.assertEqual(archive.read(output.KMZ_DOCUMENT), expected)
+
+    def test_empty_kmz(self):
+        f = StringIO()
+        output.Sink(f, 'kmz').close()
+        archive = zipfile.ZipFile(StringIO(f.getvalue()))
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(archive.read(output.KMZ_DOCUMENT), "")
+
+    def test_gzip(self):
+        expected = kml()
+        for buffer_size in [output.BUFFER_SIZE, 1000]:
+            data = kml('gzip', buffer_size)
+            self.assertTrue(len(data) < len(expected))
+            self.assertEqual(gzip.GzipFile(fileobj=StringIO(data)).read(), expected)
+
+    def test_buffering(self):
+        f = CountingFile()
+        out = output.Sink(f, buffer_size=10)
+        out.write("abcd")
+        out.write(u"\xe9t\xe9")
+        self.assertEqual(f.writes, [])
+        out.write("ef")
+        self.assertEqual(f.writes, ["abcd\xc3\xa9t\xc3\xa9ef"])
+        out.write("g")
+        out.close()
+        self.assertEqual(f.writes, ["abcd\xc3\xa9t\xc3\xa9ef", "g"])
+
+    def test_coordinate_format(self):
+        # as str() prints them, which is what the outputs always wrote
+        self.assertEqual(output.coordinate_format() % 8.123456789012, "8.12345678901")
+        self.assertEqual(output.coordinate_format(5) % 8.123456789012, "8.12346")
+        self.assertEqual(output.coordinate_format(0) % 47.6, "48")
+        self.assertEqual(output.coordinate_format(2) % -0.004, "-0.00")
+        self.assertEqual(output.format_rows("%s,%s\n", [1.5, 2.5], [3, 4]), "1.5,3\n2.5,4\n")
+        self.assertEqual(output.format_rows("%s,%s\n", [], []), "")
+
+    def test_precision(self):
+        rounded = kml(precision=3)
+        self.assertNotEqual(rounded, kml())
+        for line in rounded.splitlines():
+            if line[:1].isdigit():
+                x, y = line.split(",")
+                self.assertEqual((len(x.split(".")[1]), len(y.split(".")[1])), (3, 3))
+        f = StringIO()
+        out = output.Sink(f)
+        out_wkt.gen(sample_paths()[1:], out=out, precision=2)
+        out.close()
+        self.assertEqual(f.getvalue(), "GEOMETRYCOLLECTION (LINESTRING (%s)\n)" % ", ".join(
+            "%.2f %.2f" % (x, y) for x, y in zip(sample_paths()[1].lon, sample_paths()[1].lat)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import tiles
+
+# what the stand-in tile server serves, by path
+SERVED = {
+    "/13/4289/2866.png": "\x89PNG\r\n\x1a\n" + "png tile" * 100,
+    "/13/4290/2866.png": "\xff\xd8\xff\xe0" + "jpeg tile" * 100,
+    "/13/4291/2866.png": "GIF89a" + "gif tile" * 100,
+    "/13/4292/2866.png": "RIFF\x00\x00\x00\x00WEBPVP8 " + "webp tile" * 100,
+}
+SLOW = "/13/4293/2866.png"
+
+def tile(x, y=2866, zoom=13):
+    return {'zoom': zoom, 'tile_x': x, 'tile_y': y}
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class TileHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        if self.path == SLOW:
+            time.sleep(tiles.FETCH_TIMEOUT * 5)
+        data = SERVED.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class TilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.timeout = tiles.FETCH_TIMEOUT
+        tiles.FETCH_TIMEOUT = 0.5
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+        self.server = TileServer(("127.0.0.1", 0), TileHandler)
+        self.server.hits = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.template = "http://127.0.0.1:%d/{z}/{x}/{y}.png" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        sys.stderr = self.stderr
+        tiles.FETCH_TIMEOUT = self.timeout
+        shutil.rmtree(self.directory)
+
+    def url(self, x):
+        return tiles.tile_url(self.template, tile(x))
+
+    def test_embed(self):
+        tile_cache = tiles.TileCache(self.directory)
+        hrefs = tiles.embed([tile(x) for x in [4289, 4290, 4291, 4292]], self.template, tile_cache)
+        types = ["image/png", "image/jpeg", "image/gif", "image/webp"]
+        for href, image_type, x in zip(hrefs, types, [4289, 4290, 4291, 4292]):
+            prefix = "data:%s;base64," % image_type
+            self.assertTrue(href.startswith(prefix), href[:40])
+            self.assertEqual(base64.b64decode(href[len(prefix):]), SERVED["/13/%d/2866.png" % x])
+        self.assertEqual(sorted(self.server.hits), sorted(SERVED))
+        self.assertEqual(sys.stderr.getvalue(), "")
+
+        # from the cache this time
+        del self.server.hits[:]
+        self.assertEqual(tiles.embed([tile(x) for x in [4289, 4290, 4291, 4292]], self.template, tiles.TileCache(self.directory)), hrefs)
+        self.assertEqual(self.server.hits, [])
+
+    def test_errors(self):
+        tile_cache = tiles.TileCache(self.directory)
+        missing, slow, good = tile(1), tile(4293), tile(4289)
+        hrefs = tiles.embed([missing, slow, good], self.template, tile_cache)
+        # left as links
+        self.assertEqual(hrefs[:2], [self.url(1), self.url(4293)])
+        self.assertTrue(hrefs[2].startswith("data:image/png;base64,"))
+        errors = sys.stderr.getvalue().splitlines()
+        self.assertEqual(len(errors), 2)
+        self.assertTrue("404" in errors[0] and errors[0].startswith("Error fetching %s" % self.url(1)), errors[0])
+        self.assertTrue(errors[1].startswith("Error fetching %s" % self.url(4293)), errors[1])
+        # failures aren't cached
+        self.assertEqual(tile_cache.read(self.url(1)), None)
+        self.assertEqual(tile_cache.read(self.url(4293)), None)
+
+    def test_no_cache(self):
+        hrefs = tiles.embed([tile(4289), tile(4289)], self.template)
+        self.assertEqual(hrefs[0], tiles.data_uri(SERVED["/13/4289/2866.png"]))
+        self.assertEqual(hrefs[1], hrefs[0])
+        self.assertEqual(len(self.server.hits), 2)
+
+    def test_eviction(self):
+        tile_cache = tiles.TileCache(self.directory, max_size=2 * 1000)
+        urls = ["http://tiles.example.com/%d.png" % i for i in xrange(4)]
+        for i, url in enumerate(urls):
+            tile_cache.store(url, "x" * 1000)
+            os.utime(tile_cache.path(url), (1000000000 + i, 1000000000 + i))
+        # reading a tile makes it recently used
+        self.assertEqual(tile_cache.read(urls[0]), "x" * 1000)
+        tile_cache.close()
+        self.assertEqual([tile_cache.read(url) is not None for url in urls], [True, False, False, True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import datetime
+import mmap
+import tempfile
+import unittest
+
+import numpy
+
+import track
+import utils
+
+def sample_track(n=5, **kwargs):
+    builder = track.TrackBuilder("bus", "Line 4")
+    start = track.to_epoch(datetime.datetime(2014, 5, 1, 8, 0, 0, 250000))
+    for i in xrange(n):
+        builder.append(47.0 + i * 1e-4, 8.0 - i * 1e-4, 400.5 + i if i % 2 else None,
+                       start + i * 1500000 if i != 1 else None, "Stop %d" % (i % 2) if i != 2 else None)
+    t = builder.build()
+    for name, value in kwargs.iteritems():
+        setattr(t, name, value)
+    return t
+
+def columns(t):
+    return [t.lat.tolist(), t.lon.tolist(), t.ele.tobytes(), t.time.tolist(), t.name_codes.tolist(),
+            t.names, t.transportation, t.name, t.continues, t.source]
+
+class TrackTest(unittest.TestCase):
+
+    def test_epoch(self):
+        for dt in [datetime.datetime(2014, 5, 1, 8, 0, 0), datetime.datetime(2014, 5, 1, 8, 0, 0, 123456),
+                   datetime.datetime(1969, 12, 31, 23, 59, 59, 999999), datetime.datetime(2200, 1, 1)]:
+            self.assertEqual(track.from_epoch(track.to_epoch(dt)), dt)
+        self.assertEqual(track.to_epoch(datetime.datetime(1970, 1, 1, 0, 0, 1, 5)), track.SECOND + 5)
+
+    def test_builder(self):
+        t = sample_track()
+        self.assertEqual(t.time[1], track.NO_TIME)
+        self.assertEqual(t.time[4] - t.time[0], 6 * track.SECOND)
+        self.assertEqual(t.points[0], utils.Point(47.0, 8.0, None, datetime.datetime(2014, 5, 1, 8, 0, 0, 250000), "Stop 0"))
+        self.assertEqual(t.points[3].time, datetime.datetime(2014, 5, 1, 8, 0, 4, 750000))
+        self.assertEqual(t.point_names(), ["Stop 0", "Stop 1", None, "Stop 1", "Stop 0"])
+
+    def test_pack_round_trip(self):
+        tracks = [sample_track(source="/data/a.gpx"), sample_track(3, continues=True, source="/data/a.gpx"),
+                  track.Track([], [], transportation="walk"), sample_track(1, names=[u"Caf\xe9"], name=u"Z\xfcrich")]
+        packed = "".join(track.pack(t) for t in tracks)
+        unpacked = list(track.unpack(packed))
+        self.assertEqual([columns(t) for t in unpacked], [columns(t) for t in tracks])
+
+    def test_unpack_mmap(self):
+        t = sample_track(1000)
+        with tempfile.TemporaryFile() as f:
+            f.write(track.pack(t))
+            f.flush()
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            unpacked, = track.unpack(buf)
+            self.assertEqual(columns(unpacked), columns(t))
+            del unpacked
+            buf.close()
+
+    def test_unpack_bad_data(self):
+        self.assertRaises(ValueError, list, track.unpack("GLT0" + "\0" * 12))
+
+    def test_join_chunks(self):
+        first = sample_track(4)
+        rest = sample_track(3, continues=True)
+        other = sample_track(2)
+        joined = list(track.join_chunks([first, rest, other]))
+        self.assertEqual([len(t) for t in joined], [7, 2])
+        self.assertEqual(joined[0].point_names(), first.point_names() + rest.point_names())
+        self.assertTrue(numpy.array_equal(joined[0].time, numpy.concatenate([first.time, rest.time])))
+
+if __name__ == '__main__':
+    unittest.main()
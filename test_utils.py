@@ -0,0 +1,227 @@
+from collections import Counter
+import math
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+import utils
+
+def reference_rdp(x, y, epsilon, first, last):
+    # the recursive algorithm, one point at a time; the indices kept between first and last
+    if last - first < 2:
+        return [first, last]
+    dx, dy = x[last] - x[first], y[last] - y[first]
+    length = math.hypot(dx, dy)
+    max_d, index = 0, None
+    for i in xrange(first + 1, last):
+        if length == 0:
+            d = math.hypot(x[i] - x[first], y[i] - y[first])
+        else:
+            d = abs(dy * (x[i] - x[first]) - dx * (y[i] - y[first])) / length
+        if d > max_d:
+            max_d, index = d, i
+    if max_d > epsilon:
+        return reference_rdp(x, y, epsilon, first, index)[:-1] + reference_rdp(x, y, epsilon, index, last)
+    return [first, last]
+
+def reference_vw(x, y, epsilon):
+    # every remaining point's area worked out again after each removal; a point's effective area
+    # is never less than that of a neighbour removed before it
+    remaining = range(len(x))
+    floor = [0] * len(x)
+    while len(remaining) > 2:
+        areas = [(max(floor[j], utils.triangle_area(x[i], y[i], x[j], y[j], x[k], y[k])), j)
+                 for i, j, k in zip(remaining, remaining[1:], remaining[2:])]
+        area, j = min(areas)
+        if area >= epsilon ** 2:
+            break
+        position = remaining.index(j)
+        remaining.remove(j)
+        for neighbour in remaining[position - 1:position + 1]:
+            floor[neighbour] = max(floor[neighbour], area)
+    return remaining
+
+def random_walks():
+    random = numpy.random.RandomState(5)
+    walks = []
+    for n in [1, 2, 3, 10, 100, 400]:
+        walks.append((numpy.cumsum(random.normal(size=n)), numpy.cumsum(random.normal(size=n))))
+    # a closed loop, where the first and last points coincide
+    angles = numpy.linspace(0, 2 * math.pi, 60)
+    x, y = 10 * numpy.cos(angles) + random.normal(scale=0.3, size=60), 10 * numpy.sin(angles) + random.normal(scale=0.3, size=60)
+    x[-1], y[-1] = x[0], y[0]
+    walks.append((x, y))
+    return walks
+
+def random_pairs(random, n, min_distance, max_distance, max_lat=80):
+    # pairs of points a random distance apart (spread evenly on a log scale) in a random direction
+    lat1 = random.uniform(-max_lat, max_lat, n)
+    lon1 = random.uniform(-180, 180, n)
+    d = numpy.exp(random.uniform(math.log(min_distance), math.log(max_distance), n))
+    bearing = random.uniform(0, 2 * math.pi, n)
+    lat2 = lat1 + numpy.degrees(d * numpy.cos(bearing) / utils.EARTH_RADIUS)
+    lon2 = lon1 + numpy.degrees(d * numpy.sin(bearing) / utils.EARTH_RADIUS / numpy.cos(numpy.radians(lat1)))
+    return lat1, lon1, numpy.clip(lat2, -89.9, 89.9), (lon2 + 180) % 360 - 180
+
+def concatenated(items):
+    items = list(items)
+    if not items:
+        return [], []
+    keys, counts = zip(*items)
+    return numpy.concatenate(keys).tolist(), numpy.concatenate(counts).tolist()
+
+class KeyCounterTest(unittest.TestCase):
+
+    def setUp(self):
+        random = numpy.random.RandomState(1)
+        self.chunks = [random.randint(-500, 500, size) * (1 << 40) + random.randint(0, 3, size) for size in [300, 1, 0, 1000, 57]]
+        self.expected = Counter(numpy.concatenate(self.chunks).tolist())
+
+    def counter(self, max_keys):
+        counter = utils.KeyCounter(max_keys)
+        for chunk in self.chunks:
+            counter.add(chunk)
+        return counter
+
+    def test_items(self):
+        for max_keys in [utils.COUNTER_KEYS, 100, 7, 1]:
+            counter = self.counter(max_keys)
+            if max_keys < len(self.expected):
+                self.assertTrue(counter.runs, max_keys)
+            keys, counts = concatenated(counter.items())
+            self.assertEqual(keys, sorted(self.expected), max_keys)
+            self.assertEqual(counts, [self.expected[key] for key in keys], max_keys)
+
+    def test_by_count(self):
+        expected = sorted((count, key) for key, count in self.expected.iteritems())
+        for max_keys in [utils.COUNTER_KEYS, 100, 7]:
+            min_count, max_count, items = self.counter(max_keys).by_count()
+            keys, counts = concatenated(items)
+            self.assertEqual(zip(counts, keys), expected, max_keys)
+            self.assertEqual((min_count, max_count), (expected[0][0], expected[-1][0]))
+
+    def test_empty(self):
+        counter = utils.KeyCounter(5)
+        counter.add(numpy.zeros(0, dtype=numpy.int64))
+        self.assertEqual(list(counter.items()), [])
+        min_count, max_count, items = counter.by_count()
+        self.assertEqual((min_count, max_count, list(items)), (None, None, []))
+
+class DistanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = numpy.random.RandomState(6)
+        self.distance_model = utils.distance_model
+
+    def tearDown(self):
+        utils.distance_model = self.distance_model
+
+    def test_vincenty(self):
+        pairs = [numpy.concatenate(columns) for columns in zip(
+            random_pairs(self.random, 300, 0.01, 10), random_pairs(self.random, 300, 10, 5e6),
+            # the same point, along the equator, half way around the earth, over the pole
+            zip((47.3, 8.5, 47.3, 8.5), (0, 0, 0, 120), (-33.9, 151.2, 47.3, 8.5), (89, 0, 89, 180)))]
+        for size in [3, utils.VINCENTY_SCALAR_SIZE, utils.VINCENTY_SCALAR_SIZE + 1, len(pairs[0])]:
+            lat1, lon1, lat2, lon2 = [column[-size:] for column in pairs]
+            expected = [utils.vincenty_scalar(*args) for args in zip(lat1, lon1, lat2, lon2)]
+            self.assertTrue(numpy.allclose(utils.vincenty(lat1, lon1, lat2, lon2), expected, rtol=1e-12, atol=1e-9), size)
+        # zero length
+        self.assertEqual(utils.vincenty(pairs[0], pairs[1], pairs[0], pairs[1]).tolist(), [0] * len(pairs[0]))
+        p1, p2 = utils.Point(47.3769, 8.5417, None, None, None), utils.Point(-33.8568, 151.2153, None, None, None)
+        self.assertEqual(utils.distance(p1, p2), utils.vincenty_scalar(47.3769, 8.5417, -33.8568, 151.2153))
+        self.assertAlmostEqual(utils.vincenty(47.3769, 8.5417, -33.8568, 151.2153), utils.distance(p1, p2), 6)
+
+    def test_haversine_error(self):
+        lat1, lon1, lat2, lon2 = random_pairs(self.random, 20000, 1, 1e6, max_lat=89)
+        error = utils.haversine(lat1, lon1, lat2, lon2) / utils.vincenty(lat1, lon1, lat2, lon2) - 1
+        self.assertTrue(-0.0045 <= error.min() and error.max() <= 0.0057, (error.min(), error.max()))
+
+    def test_equirectangular_error(self):
+        for max_lat, max_distance, max_error in [(80, 1e4, 3e-6), (70, 1e4, 1e-6), (60, 1e5, 5e-5)]:
+            lat1, lon1, lat2, lon2 = random_pairs(self.random, 20000, 1, max_distance, max_lat)
+            error = numpy.abs(utils.equirectangular(lat1, lon1, lat2, lon2) / utils.haversine(lat1, lon1, lat2, lon2) - 1)
+            self.assertTrue(error.max() < max_error, (max_lat, max_distance, error.max()))
+        # across the antimeridian
+        self.assertAlmostEqual(utils.equirectangular(0, 179.9, 0, -179.9), utils.haversine(0, 179.9, 0, -179.9), 3)
+
+    def test_batches(self):
+        lat, lon, lat2, lon2 = random_pairs(self.random, 100, 0.01, 1e5)
+        lat[10], lon[10] = lat[9], lon[9]
+        for model, distances_between in sorted(utils.DISTANCE_MODELS.items()):
+            consecutive = utils.distances(lat, lon, model)
+            self.assertEqual(len(consecutive), 99)
+            self.assertEqual(consecutive[9], 0)
+            self.assertTrue(numpy.allclose(consecutive, distances_between(lat[:-1], lon[:-1], lat[1:], lon[1:]), rtol=1e-12), model)
+            self.assertEqual(utils.distances(lat[:1], lon[:1], model).tolist(), [])
+            self.assertEqual(utils.distances([], [], model).tolist(), [])
+
+            pairwise = utils.distances_between(lat, lon, lat2, lon2, model)
+            self.assertTrue(numpy.allclose(pairwise, [distances_between(*args) for args in zip(lat, lon, lat2, lon2)], rtol=1e-12), model)
+            to_one = utils.distances_to(lat.tolist(), lon.tolist(), lat2[0], lon2[0], model)
+            self.assertTrue(numpy.allclose(to_one, [distances_between(a, b, lat2[0], lon2[0]) for a, b in zip(lat, lon)], rtol=1e-12), model)
+
+            # the model of --distance-model
+            utils.distance_model = model
+            self.assertEqual(utils.distances(lat, lon).tolist(), consecutive.tolist())
+
+class ReplaceFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "index.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replace(self):
+        utils.replace_file(self.path, "first")
+        utils.replace_file(self.path, "second")
+        with file(self.path, 'rb') as f:
+            self.assertEqual(f.read(), "second")
+        self.assertEqual(os.listdir(self.directory), ["index.json"])
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0666 & ~utils.UMASK)
+
+    def test_failed_write(self):
+        self.assertRaises(TypeError, utils.replace_file, self.path, None)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_concurrent_writes(self):
+        # every write ends up whole, never mixed with another
+        contents = [chr(ord("a") + i) * 100000 for i in xrange(8)]
+        errors = []
+        def write(content):
+            try:
+                for i in xrange(20):
+                    utils.replace_file(self.path, content)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=write, args=(content,)) for content in contents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        with file(self.path, 'rb') as f:
+            self.assertIn(f.read(), contents)
+        self.assertEqual(os.listdir(self.directory), ["index.json"])
+
+class SimplifyTest(unittest.TestCase):
+
+    def test_rdp(self):
+        for x, y in random_walks():
+            for epsilon in [0, 0.5, 2, 10, 1000]:
+                expected = reference_rdp(x.tolist(), y.tolist(), epsilon, 0, len(x) - 1) if len(x) > 1 else [0]
+                self.assertEqual(utils.simplify(x, y, epsilon, 'rdp').tolist(), expected, (len(x), epsilon))
+
+    def test_vw(self):
+        for x, y in random_walks():
+            for epsilon in [0, 0.5, 2, 10, 1000]:
+                self.assertEqual(utils.simplify(x, y, epsilon, 'vw').tolist(), reference_vw(x.tolist(), y.tolist(), epsilon), (len(x), epsilon))
+
+if __name__ == '__main__':
+    unittest.main()
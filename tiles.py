@@ -0,0 +1,112 @@
+import base64
+import hashlib
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import urllib2
+
+import cache
+import utils
+
+# {z}, {x} and {y} are replaced by the zoom level and the tile coordinates
+DEFAULT_URL = "http://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+
+DEFAULT_DIR = os.path.join(cache.DEFAULT_DIR, "tiles")
+DEFAULT_SIZE = 256 << 20
+
+# tile servers ask clients not to open many connections at once
+FETCH_THREADS = 4
+FETCH_TIMEOUT = 30
+
+# tile servers usually refuse requests without one
+USER_AGENT = "glot (https://github.com/ibz/glot)"
+
+TILE_EXTENSION = ".tile"
+
+def tile_url(template, tile):
+    return template.replace("{z}", str(tile['zoom'])).replace("{x}", str(tile['tile_x'])).replace("{y}", str(tile['tile_y']))
+
+def image_type(data):
+    if data.startswith("\xff\xd8"):
+        return "image/jpeg"
+    if data.startswith("GIF8"):
+        return "image/gif"
+    if data.startswith("RIFF") and data[8:12] == "WEBP":
+        return "image/webp"
+    return "image/png"
+
+def data_uri(data):
+    return "data:%s;base64,%s" % (image_type(data), base64.b64encode(data))
+
+class TileCache(object):
+    """Tiles fetched before, kept on disk by their URL. Once the cache grows over
+    max_size bytes, the least recently used tiles are removed."""
+
+    def __init__(self, directory=DEFAULT_DIR, max_size=DEFAULT_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest() + TILE_EXTENSION)
+
+    def read(self, url):
+        """Return the tile at <url>, or None if it isn't cached."""
+
+        path = self.path(url)
+        try:
+            with file(path, 'rb') as f:
+                data = f.read()
+        except EnvironmentError:
+            return None
+        # mark the tile as recently used
+        os.utime(path, None)
+        return data
+
+    def store(self, url, data):
+        utils.replace_file(self.path(url), data)
+
+    def close(self):
+        cache.evict(os.path.join(self.directory, "*" + TILE_EXTENSION), self.max_size)
+
+def fetch(url, tile_cache=None):
+    data = tile_cache.read(url) if tile_cache is not None else None
+    if data is None:
+        response = urllib2.urlopen(urllib2.Request(url, headers={'User-Agent': USER_AGENT}), timeout=FETCH_TIMEOUT)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        if tile_cache is not None:
+            tile_cache.store(url, data)
+    return data
+
+def fetch_tile(job):
+    # runs in a thread of the pool
+    url, tile_cache = job
+    try:
+        return fetch(url, tile_cache), None
+    except Exception, e:
+        return None, "%s: %s" % (e.__class__.__name__, e)
+
+def embed(tiles, template=DEFAULT_URL, tile_cache=None, threads=FETCH_THREADS):
+    """Return the tiles as data URIs, fetching those that aren't cached with <threads> at a time.
+    A tile that can't be fetched is reported and left as a link."""
+
+    urls = [tile_url(template, tile) for tile in tiles]
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(fetch_tile, [(url, tile_cache) for url in urls])
+    finally:
+        pool.close()
+        pool.join()
+
+    hrefs = []
+    for url, (data, error) in zip(urls, results):
+        if error is not None:
+            sys.stderr.write("Error fetching %s: %s\n" % (url, error))
+            hrefs.append(url)
+        else:
+            hrefs.append(data_uri(data))
+    return hrefs
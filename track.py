@@ -0,0 +1,304 @@
+from array import array
+import calendar
+import datetime
+import json
+import struct
+
+import numpy
+
+import utils
+
+NO_TIME = numpy.iinfo(numpy.int64).min
+NO_NAME = -1
+
+# parsers hand out long paths in chunks of this many points
+CHUNK_SIZE = 1 << 16
+
+# times are kept in microseconds, the resolution of datetime
+SECOND = 1000000
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_epoch(dt):
+    return calendar.timegm(dt.utctimetuple()) * SECOND + dt.microsecond
+
+def from_epoch(t):
+    return EPOCH + datetime.timedelta(microseconds=int(t))
+
+def widen_ele(ele):
+    """Return float32 elevations as float64 values that print the way they were read.
+    Elevations are stored in single precision; going through their shortest repr
+    gives back 123.4 instead of 123.40000152587891."""
+
+    return ele.astype(str).astype(numpy.float64)
+
+class Track(object):
+    """The points of one path, stored column-wise.
+
+    lat and lon are float64 arrays, ele is a float32 array (NaN where missing),
+    time is an int64 array of microseconds since the epoch (NO_TIME where missing) and
+    name_codes indexes into the names list (NO_NAME where missing).
+
+    A long path may come as several tracks; all but the first have continues set.
+    source is the absolute path of the file the track was read from, when known.
+    """
+
+    def __init__(self, lat, lon, ele=None, time=None, name_codes=None, names=None, transportation=None, name=None, continues=False, source=None):
+        self.lat = numpy.asarray(lat, dtype=numpy.float64)
+        self.lon = numpy.asarray(lon, dtype=numpy.float64)
+        n = len(self.lat)
+        self.ele = numpy.asarray(ele, dtype=numpy.float32) if ele is not None else numpy.full(n, numpy.nan, dtype=numpy.float32)
+        self.time = numpy.asarray(time, dtype=numpy.int64) if time is not None else numpy.full(n, NO_TIME, dtype=numpy.int64)
+        self.name_codes = numpy.asarray(name_codes, dtype=numpy.int32) if name_codes is not None else numpy.full(n, NO_NAME, dtype=numpy.int32)
+        self.names = names if names is not None else []
+        self.transportation = transportation
+        self.name = name
+        self.continues = continues
+        self.source = source
+
+    def __len__(self):
+        return len(self.lat)
+
+    def __repr__(self):
+        return "<Track %r: %s points>" % (self.name, len(self))
+
+    @property
+    def points(self):
+        return PointView(self)
+
+    def point(self, i):
+        ele = self.ele[i]
+        t = self.time[i]
+        return utils.Point(float(self.lat[i]), float(self.lon[i]),
+                           float(repr(ele)) if ele == ele else None,
+                           from_epoch(t) if t != NO_TIME else None,
+                           self.point_name(i))
+
+    def point_name(self, i):
+        code = self.name_codes[i]
+        return self.names[code] if code != NO_NAME else None
+
+    def point_names(self):
+        """Decode the name column into a list of strings (None where missing)."""
+
+        lookup = self.names + [None]
+        return [lookup[code] for code in self.name_codes.tolist()]
+
+    def has_ele(self):
+        return len(self) > 0 and not numpy.isnan(self.ele[0])
+
+    def has_time(self):
+        return len(self) > 0 and self.time[0] != NO_TIME
+
+    def copy_with(self, **columns):
+        """Return a track sharing this track's metadata with some columns replaced."""
+
+        kwargs = {'lat': self.lat, 'lon': self.lon, 'ele': self.ele, 'time': self.time, 'name_codes': self.name_codes}
+        kwargs.update(columns)
+        return Track(names=self.names, transportation=self.transportation, name=self.name, continues=self.continues, source=self.source, **kwargs)
+
+    def take(self, index):
+        """Return the subset selected by an index array or a boolean mask."""
+
+        return self.copy_with(lat=self.lat[index], lon=self.lon[index], ele=self.ele[index],
+                              time=self.time[index], name_codes=self.name_codes[index])
+
+    @classmethod
+    def from_points(cls, points, transportation=None, name=None):
+        builder = TrackBuilder(transportation, name)
+        for p in points:
+            builder.append(p.lat, p.lon, p.ele, to_epoch(p.time) if p.time is not None else None, p.name)
+        return builder.build()
+
+class PointView(object):
+    """Read-only sequence of utils.Point over a Track, for code that walks points one by one."""
+
+    def __init__(self, track):
+        self.track = track
+
+    def __len__(self):
+        return len(self.track)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.track.point(j) for j in xrange(*i.indices(len(self.track)))]
+        if i < 0:
+            i += len(self.track)
+        if not 0 <= i < len(self.track):
+            raise IndexError(i)
+        return self.track.point(i)
+
+    def __iter__(self):
+        for i in xrange(len(self.track)):
+            yield self.track.point(i)
+
+class TrackBuilder(object):
+    """Accumulates points into compact arrays while a file is being parsed."""
+
+    def __init__(self, transportation=None, name=None):
+        self.transportation = transportation
+        self.name = name
+        self.names = []
+        self.name_index = {}
+        self.built = False
+        self.reset()
+
+    def reset(self):
+        # times are whole numbers of microseconds, which doubles hold exactly for 285 years either side of 1970
+        self.lat = array('d')
+        self.lon = array('d')
+        self.ele = array('f')
+        self.time = array('d')
+        self.name_codes = array('i')
+
+    def __len__(self):
+        return len(self.lat)
+
+    def encode_name(self, name):
+        if name is None:
+            return NO_NAME
+        code = self.name_index.get(name)
+        if code is None:
+            code = self.name_index[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def append(self, lat, lon, ele=None, time=None, name=None):
+        self.lat.append(lat)
+        self.lon.append(lon)
+        self.ele.append(ele if ele is not None else numpy.nan)
+        self.time.append(time if time is not None else numpy.nan)
+        self.name_codes.append(self.encode_name(name))
+
+    def extend(self, lat, lon, ele=None, time=None):
+        """Append many points at once from arrays; missing elevations and times are NaN."""
+
+        n = len(lat)
+        self.lat.fromstring(numpy.asarray(lat, dtype=numpy.float64).tostring())
+        self.lon.fromstring(numpy.asarray(lon, dtype=numpy.float64).tostring())
+        self.ele.fromstring(numpy.asarray(ele if ele is not None else numpy.full(n, numpy.nan), dtype=numpy.float32).tostring())
+        self.time.fromstring(numpy.asarray(time if time is not None else numpy.full(n, numpy.nan), dtype=numpy.float64).tostring())
+        self.name_codes.fromstring(numpy.full(n, NO_NAME, dtype=numpy.int32).tostring())
+
+    def full(self):
+        return len(self.lat) >= CHUNK_SIZE
+
+    def build(self):
+        """Return the points appended since the last call as a track."""
+
+        time = _column(self.time, numpy.float64)
+        missing = numpy.isnan(time)
+        time = time.astype(numpy.int64)
+        time[missing] = NO_TIME
+        track = Track(_column(self.lat, numpy.float64), _column(self.lon, numpy.float64), _column(self.ele, numpy.float32),
+                      time, _column(self.name_codes, numpy.int32), self.names, self.transportation, self.name, self.built)
+        self.built = True
+        self.reset()
+        return track
+
+    def build_rest(self):
+        """Return the last chunk of the path, if there is anything left to return."""
+
+        if len(self) or not self.built:
+            return [self.build()]
+        return []
+
+def _column(values, dtype):
+    # the arrays are replaced on reset, so the numpy view can keep the buffer; frombuffer refuses empty ones
+    return numpy.frombuffer(values, dtype=dtype) if len(values) else numpy.zeros(0, dtype=dtype)
+
+def concatenate(tracks, transportation=None, name=None, source=None):
+    """Join several tracks into one, merging their name dictionaries."""
+
+    names = []
+    name_index = {}
+    codes = []
+    for t in tracks:
+        remap = numpy.empty(len(t.names) + 1, dtype=numpy.int32)
+        remap[-1] = NO_NAME
+        for i, n in enumerate(t.names):
+            if n not in name_index:
+                name_index[n] = len(names)
+                names.append(n)
+            remap[i] = name_index[n]
+        codes.append(remap[t.name_codes])
+    if not tracks:
+        return Track([], [], names=names, transportation=transportation, name=name, source=source)
+    return Track(numpy.concatenate([t.lat for t in tracks]), numpy.concatenate([t.lon for t in tracks]),
+                 numpy.concatenate([t.ele for t in tracks]), numpy.concatenate([t.time for t in tracks]),
+                 numpy.concatenate(codes), names, transportation, name, source=source)
+
+def join_chunks(tracks):
+    """Reassemble the chunks of each path into a single track, for consumers that need whole paths."""
+
+    chunks = []
+    for t in tracks:
+        if chunks and not t.continues:
+            yield concatenate(chunks, chunks[0].transportation, chunks[0].name, chunks[0].source) if len(chunks) > 1 else chunks[0]
+            chunks = []
+        chunks.append(t)
+    if chunks:
+        yield concatenate(chunks, chunks[0].transportation, chunks[0].name, chunks[0].source) if len(chunks) > 1 else chunks[0]
+
+def mark_path_ends(tracks):
+    """Pair every chunk with whether it is the last chunk of its path, looking one chunk ahead."""
+
+    prev = None
+    for t in tracks:
+        if prev is not None:
+            yield prev, not t.continues
+        prev = t
+    if prev is not None:
+        yield prev, True
+
+class TrackStream(object):
+    """Tracks produced lazily by factory(). Every iteration calls factory() again, so an output
+    that needs two passes re-reads its input instead of keeping it all in memory.
+
+    sources lists the input files when the tracks of each can be read on their own:
+    factory(some_sources) then produces only the tracks read from those files."""
+
+    def __init__(self, factory, sources=None):
+        self.factory = factory
+        self.sources = sources
+
+    def __iter__(self):
+        return iter(self.factory())
+
+    def select(self, sources):
+        """Return a stream of the tracks read from <sources> only."""
+
+        return TrackStream(lambda: self.factory(sources), sources)
+
+# A packed track is a header (magic, point count, metadata length), the metadata as JSON padded
+# to 8 bytes, then the lat, lon, time, ele and name_codes columns in native little-endian layout.
+PACK_MAGIC = "GLT1"
+PACK_HEADER = struct.Struct("<4sQI")
+PACK_COLUMNS = [('lat', numpy.float64), ('lon', numpy.float64), ('time', numpy.int64), ('ele', numpy.float32), ('name_codes', numpy.int32)]
+
+def pack(t):
+    """Serialize a track to a string, cheap to send between processes or write to disk."""
+
+    meta = json.dumps({'names': t.names, 'transportation': t.transportation, 'name': t.name, 'continues': t.continues, 'source': t.source})
+    meta += " " * (-(PACK_HEADER.size + len(meta)) % 8)
+    columns = [numpy.ascontiguousarray(getattr(t, column), dtype=numpy.dtype(dtype).newbyteorder('<')).tostring()
+               for column, dtype in PACK_COLUMNS]
+    return PACK_HEADER.pack(PACK_MAGIC, len(t), len(meta)) + meta + "".join(columns)
+
+def unpack(buf):
+    """Read the tracks packed back to back in <buf> (a string or an mmap).
+    The columns are views into the buffer, not copies."""
+
+    offset = 0
+    while offset < len(buf):
+        magic, n, meta_size = PACK_HEADER.unpack_from(buf, offset)
+        if magic != PACK_MAGIC:
+            raise ValueError("Not a packed track at offset %s." % offset)
+        offset += PACK_HEADER.size
+        meta = json.loads(buf[offset:offset + meta_size])
+        offset += meta_size
+        columns = {}
+        for column, dtype in PACK_COLUMNS:
+            dtype = numpy.dtype(dtype).newbyteorder('<')
+            columns[column] = numpy.frombuffer(buf, dtype=dtype, count=n, offset=offset) if n else numpy.zeros(0, dtype=dtype)
+            offset += n * dtype.itemsize
+        yield Track(names=meta['names'], transportation=meta['transportation'], name=meta['name'], continues=meta['continues'], source=meta['source'], **columns)
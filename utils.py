@@ -1,20 +1,72 @@
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+import hashlib
+import heapq
+from itertools import izip
 import math
 from math import sqrt, radians, sin, cos, tan, atan, atan2, log
+import os
 import re
+import tempfile
+
+import numpy
 
 Point = namedtuple('Point', "lat lon ele time name")
 
+# input files are read and parsed this many bytes at a time
+READ_SIZE = 1 << 16
+
+# outputs that have to write something out of order keep up to this many bytes in memory before spilling to disk
+SPOOL_SIZE = 1 << 24
+
+def file_digest(filename):
+    """SHA-1 of the contents of a file, as a hex string."""
+
+    digest = hashlib.sha1()
+    with file(filename, 'rb') as f:
+        for data in iter(lambda: f.read(READ_SIZE), ""):
+            digest.update(data)
+    return digest.hexdigest()
+
+def file_info(filename, known=None):
+    """Size, mtime and SHA-1 of a file, as a dict. The SHA-1 of <known> (what this returned for
+    the file before) is reused when the size and mtime are the same, so an untouched file isn't read."""
+
+    st = os.stat(filename)
+    if isinstance(known, dict) and known.get('size') == st.st_size and known.get('mtime') == st.st_mtime:
+        return known
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': file_digest(filename)}
+
+# mkstemp makes files only their owner can read; replace_file gives them the usual permissions
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def replace_file(filename, content):
+    """Write a file through a temporary one, so that it is never seen half written. The temporary
+    file is unique, so runs writing the same file at once (in a shared cache) don't mix their writes."""
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(filename) or ".")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0666 & ~UMASK)
+        os.rename(tmp_path, filename)
+    except:
+        os.remove(tmp_path)
+        raise
+
 def distance(p1, p2):
+    return vincenty_scalar(p1.lat, p1.lon, p2.lat, p2.lon)
+
+def vincenty_scalar(lat1, lon1, lat2, lon2):
     # taken from http://www.movable-type.co.uk/scripts/latlong-vincenty.html and translated into Python
 
     a = 6378137
     b = 6356752.314245
     f = 1 / 298.257223563
 
-    L = radians(p2.lon - p1.lon)
-    U1 = atan((1 - f) * tan(radians(p1.lat)))
-    U2 = atan((1 - f) * tan(radians(p2.lat)))
+    L = radians(lon2 - lon1)
+    U1 = atan((1 - f) * tan(radians(lat1)))
+    U2 = atan((1 - f) * tan(radians(lat2)))
 
     sin_U1 = sin(U1)
     cos_U1 = cos(U1)
@@ -53,7 +105,7 @@ def distance(p1, p2):
         l = L + (1 - C) * f * sin_alpha * (s + C * sin_s * (cos2_sm + C * cos_s * (-1 + 2 * cos2_sm * cos2_sm)))
 
     if iter_limit == 0:
-        raise Exception("Failed to compute distance between %s and %s." % p1, p2)
+        raise Exception("Failed to compute distance between %s and %s." % ((lat1, lon1), (lat2, lon2)))
 
     u_sq = cos_sq_alpha * (a * a - b * b) / (b * b)
     A = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
@@ -62,6 +114,295 @@ def distance(p1, p2):
 
     return b * A * (s - delta_s)
 
+VINCENTY_SCALAR_SIZE = 16
+
+def vincenty(lat1, lon1, lat2, lon2):
+    # the same iteration as distance(), run over whole arrays until every pair has converged
+
+    a = 6378137
+    b = 6356752.314245
+    f = 1 / 298.257223563
+
+    lat1, lon1, lat2, lon2 = numpy.broadcast_arrays(*[numpy.asarray(v, dtype=numpy.float64) for v in (lat1, lon1, lat2, lon2)])
+
+    if lat1.size <= VINCENTY_SCALAR_SIZE:
+        # numpy's per-call overhead dominates for a handful of pairs
+        d = [vincenty_scalar(*args) for args in zip(lat1.ravel().tolist(), lon1.ravel().tolist(), lat2.ravel().tolist(), lon2.ravel().tolist())]
+        return numpy.array(d, dtype=numpy.float64).reshape(lat1.shape)
+
+    L = numpy.radians(lon2 - lon1).ravel()
+    U1 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lat1))).ravel()
+    U2 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lat2))).ravel()
+
+    sin_U1 = numpy.sin(U1)
+    cos_U1 = numpy.cos(U1)
+    sin_U2 = numpy.sin(U2)
+    cos_U2 = numpy.cos(U2)
+
+    sin_s = numpy.zeros(L.shape)
+    cos_s = numpy.zeros(L.shape)
+    s = numpy.zeros(L.shape)
+    cos_sq_alpha = numpy.zeros(L.shape)
+    cos2_sm = numpy.zeros(L.shape)
+
+    l = L.copy()
+    todo = numpy.arange(len(L))
+    iter_limit = 100
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        while len(todo) and iter_limit > 0:
+            iter_limit -= 1
+
+            sin_l = numpy.sin(l[todo])
+            cos_l = numpy.cos(l[todo])
+            su1, cu1, su2, cu2 = sin_U1[todo], cos_U1[todo], sin_U2[todo], cos_U2[todo]
+
+            t_sin_s = numpy.sqrt((cu2 * sin_l) ** 2 + (cu1 * su2 - su1 * cu2 * cos_l) ** 2)
+            t_cos_s = su1 * su2 + cu1 * cu2 * cos_l
+            t_s = numpy.arctan2(t_sin_s, t_cos_s)
+            sin_alpha = cu1 * cu2 * sin_l / t_sin_s
+            t_cos_sq_alpha = 1 - sin_alpha * sin_alpha
+            t_cos2_sm = numpy.where(t_cos_sq_alpha != 0, t_cos_s - 2 * su1 * su2 / t_cos_sq_alpha, 0)
+
+            C = f / 16 * t_cos_sq_alpha * (4 + f * (4 - 3 * t_cos_sq_alpha))
+            new_l = L[todo] + (1 - C) * f * sin_alpha * (t_s + C * t_sin_s * (t_cos2_sm + C * t_cos_s * (-1 + 2 * t_cos2_sm * t_cos2_sm)))
+
+            sin_s[todo] = t_sin_s
+            cos_s[todo] = t_cos_s
+            s[todo] = t_s
+            cos_sq_alpha[todo] = t_cos_sq_alpha
+            cos2_sm[todo] = t_cos2_sm
+
+            # coincident points have sin_s == 0 and are done right away
+            done = (t_sin_s == 0) | (numpy.abs(new_l - l[todo]) <= 1e-12)
+            l[todo] = new_l
+            todo = todo[~done]
+
+    if len(todo):
+        raise Exception("Failed to compute distance for %s point pairs." % len(todo))
+
+    u_sq = cos_sq_alpha * (a * a - b * b) / (b * b)
+    A = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    B = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_s = B * sin_s * (cos2_sm + B / 4 * (cos_s * (-1 + 2 * cos2_sm * cos2_sm) - B / 6 * cos2_sm * (-3 + 4 * sin_s * sin_s) * (-3 + 4 * cos2_sm * cos2_sm)))
+
+    d = numpy.where(sin_s == 0, 0, b * A * (s - delta_s))
+    return d.reshape(lat1.shape)
+
+EARTH_RADIUS = 6371008.8 # mean radius, metres
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lat2 = numpy.radians(lat1), numpy.radians(lat2)
+    h = numpy.sin((lat2 - lat1) / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(numpy.radians(numpy.subtract(lon2, lon1)) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1)))
+
+def equirectangular(lat1, lon1, lat2, lon2):
+    lat1, lat2 = numpy.radians(lat1), numpy.radians(lat2)
+    d_lon = (numpy.radians(numpy.subtract(lon2, lon1)) + math.pi) % (2 * math.pi) - math.pi
+    x = d_lon * numpy.cos((lat1 + lat2) / 2)
+    return EARTH_RADIUS * numpy.hypot(x, lat2 - lat1)
+
+# Error relative to Vincenty on the WGS84 ellipsoid:
+# - vincenty: reference, accurate to well under a millimetre.
+# - haversine: spherical earth, between 0.45% too short and 0.57% too long depending on latitude and bearing.
+# - equirectangular: haversine plus a flat-earth error that grows with segment length and latitude;
+#   up to 70 degrees of latitude it is under 0.0001% extra below 10km (0.0003% at 80 degrees), and
+#   under 0.005% at 100km up to 60 degrees, so it is as good as haversine for GPS logs.
+DISTANCE_MODELS = {'vincenty': vincenty, 'haversine': haversine, 'equirectangular': equirectangular}
+
+distance_model = 'vincenty'
+
+def distances_between(lat1, lon1, lat2, lon2, model=None):
+    """Distances in metres between two sets of points, pairwise (with numpy broadcasting)."""
+
+    return DISTANCE_MODELS[model or distance_model](lat1, lon1, lat2, lon2)
+
+def distances(lat, lon, model=None):
+    """Distances in metres between consecutive points, one shorter than the input."""
+
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    if len(lat) < 2:
+        return numpy.zeros(0)
+    return distances_between(lat[:-1], lon[:-1], lat[1:], lon[1:], model)
+
+def distances_to(lat, lon, lat0, lon0, model=None):
+    """Distances in metres from every point to the single point (lat0, lon0)."""
+
+    return distances_between(numpy.asarray(lat, dtype=numpy.float64), numpy.asarray(lon, dtype=numpy.float64), lat0, lon0, model)
+
+# Straight-line distance between earth_xyz() coordinates is at most this many times the
+# distance given by any of the models above (Vincenty is up to 0.57% longer than the chord on the sphere).
+CHORD_RATIO = 1.02
+
+def earth_xyz(lat, lon):
+    """Earth-centred cartesian coordinates in metres, on the mean-radius sphere."""
+
+    lat = numpy.radians(lat)
+    lon = numpy.radians(lon)
+    return numpy.column_stack([EARTH_RADIUS * numpy.cos(lat) * numpy.cos(lon),
+                               EARTH_RADIUS * numpy.cos(lat) * numpy.sin(lon),
+                               EARTH_RADIUS * numpy.sin(lat)])
+
+class PointGrid(object):
+    """Buckets point ids into cubic cells of earth-centred coordinates.
+    With cells of <radius> metres, every point within <radius> of a point is in the
+    27 cells around it, so neighbours are found without scanning all points."""
+
+    def __init__(self, radius):
+        self.cell_size = max(radius, 1) * CHORD_RATIO
+        self.cells = defaultdict(list)
+
+    def keys(self, lat, lon):
+        return [tuple(k) for k in numpy.floor(earth_xyz(lat, lon) / self.cell_size).astype(numpy.int64).tolist()]
+
+    def add(self, key, i):
+        self.cells[key].append(i)
+
+    def around(self, key, k=1):
+        """Ids in all cells at most <k> cells away from <key>.
+        Points in other cells are more than k * cell_size / CHORD_RATIO metres away."""
+
+        x, y, z = key
+        ids = []
+        for i in xrange(x - k, x + k + 1):
+            for j in xrange(y - k, y + k + 1):
+                for l in xrange(z - k, z + k + 1):
+                    cell = self.cells.get((i, j, l))
+                    if cell:
+                        ids.extend(cell)
+        return ids
+
+# a KeyCounter keeps up to this many keys (16 bytes each with their counts) in memory before spilling them to disk
+COUNTER_KEYS = SPOOL_SIZE // 16
+
+def write_run(first, second):
+    """Write two int64 columns, already sorted, to a temporary file."""
+
+    run = tempfile.TemporaryFile()
+    numpy.column_stack([first, second]).astype(numpy.int64).tofile(run)
+    return run
+
+def read_run(run):
+    """Yield the rows of a file written by write_run as (first, second) tuples."""
+
+    run.seek(0)
+    while True:
+        rows = numpy.fromfile(run, dtype=numpy.int64, count=2 * COUNTER_KEYS).reshape(-1, 2)
+        if not len(rows):
+            break
+        for row in izip(rows[:, 0].tolist(), rows[:, 1].tolist()):
+            yield row
+    run.close()
+
+def merge_runs(runs):
+    """Merge the rows of sorted runs, yielding them as (first, second) arrays of up to COUNTER_KEYS rows."""
+
+    first, second = [], []
+    for a, b in heapq.merge(*[read_run(run) for run in runs]):
+        first.append(a)
+        second.append(b)
+        if len(first) >= COUNTER_KEYS:
+            yield numpy.array(first, dtype=numpy.int64), numpy.array(second, dtype=numpy.int64)
+            first, second = [], []
+    if first:
+        yield numpy.array(first, dtype=numpy.int64), numpy.array(second, dtype=numpy.int64)
+
+def sorted_by_count(keys, counts):
+    # (counts, keys) of lists of arrays, ordered by count and then by key
+    keys = numpy.concatenate(keys)
+    counts = numpy.concatenate(counts)
+    order = numpy.lexsort((keys, counts))
+    return counts[order], keys[order]
+
+class KeyCounter(object):
+    """Counts int64 keys, kept as a sorted array of keys and an array of their counts.
+    Once there are more than <max_keys> different keys, they are written to a temporary file
+    as a sorted run and counting starts over; runs are merged when the counts are read."""
+
+    def __init__(self, max_keys=COUNTER_KEYS):
+        self.max_keys = max_keys
+        self.keys = numpy.zeros(0, dtype=numpy.int64)
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.runs = []
+
+    def add(self, keys):
+        keys, counts = numpy.unique(keys, return_counts=True)
+        pos = numpy.searchsorted(self.keys, keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == keys[found]
+        self.counts[pos[found]] += counts[found]
+        new = ~found
+        self.keys = numpy.insert(self.keys, pos[new], keys[new])
+        self.counts = numpy.insert(self.counts, pos[new], counts[new])
+        if len(self.keys) > self.max_keys:
+            self.spill()
+
+    def spill(self):
+        if len(self.keys):
+            self.runs.append(write_run(self.keys, self.counts))
+        self.keys = numpy.zeros(0, dtype=numpy.int64)
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+
+    def items(self):
+        """Yield (keys, counts) arrays in key order, every key being in only one of them."""
+
+        if not self.runs:
+            if len(self.keys):
+                yield self.keys, self.counts
+            return
+
+        self.spill()
+        runs, self.runs = self.runs, []
+        keys, counts = [], []
+        last = None
+        for run_keys, run_counts in merge_runs(runs):
+            # the same key can be in several runs, but they are next to each other now
+            for key, count in izip(run_keys.tolist(), run_counts.tolist()):
+                if key == last:
+                    counts[-1] += count
+                    continue
+                if len(keys) >= self.max_keys:
+                    yield numpy.array(keys, dtype=numpy.int64), numpy.array(counts, dtype=numpy.int64)
+                    keys, counts = [], []
+                keys.append(key)
+                counts.append(count)
+                last = key
+        if keys:
+            yield numpy.array(keys, dtype=numpy.int64), numpy.array(counts, dtype=numpy.int64)
+
+    def by_count(self):
+        """Return the smallest and the largest count (None if there are no keys) and an iterator
+        of (keys, counts) arrays going through the keys from the smallest to the largest count."""
+
+        min_count = max_count = None
+        keys, counts = [], []
+        size = 0
+        runs = []
+        for item_keys, item_counts in self.items():
+            if min_count is None:
+                min_count, max_count = int(item_counts.min()), int(item_counts.max())
+            else:
+                min_count = min(min_count, int(item_counts.min()))
+                max_count = max(max_count, int(item_counts.max()))
+            keys.append(item_keys)
+            counts.append(item_counts)
+            size += len(item_keys)
+            if size > self.max_keys:
+                runs.append(write_run(*sorted_by_count(keys, counts)))
+                keys, counts = [], []
+                size = 0
+
+        if not runs:
+            if not keys:
+                return None, None, iter([])
+            counts, keys = sorted_by_count(keys, counts)
+            return min_count, max_count, iter([(keys, counts)])
+
+        if keys:
+            runs.append(write_run(*sorted_by_count(keys, counts)))
+        return min_count, max_count, ((keys, counts) for counts, keys in merge_runs(runs))
+
 def osm_get_tile_xy(lat, lon, zoom):
     lat = radians(lat)
     n = 2.0 ** zoom
@@ -69,36 +410,95 @@ def osm_get_tile_xy(lat, lon, zoom):
     tile_y = int((1.0 - log(tan(lat) + (1 / cos(lat))) / math.pi) / 2.0 * n)
     return (tile_x, tile_y)
 
+def osm_get_tiles_xy(lat, lon, zoom):
+    """osm_get_tile_xy for arrays of points."""
+
+    lat = numpy.radians(lat)
+    n = 2.0 ** zoom
+    tile_x = ((lon + 180.0) / 360.0 * n).astype(numpy.int64)
+    tile_y = ((1.0 - numpy.log(numpy.tan(lat) + (1 / numpy.cos(lat))) / math.pi) / 2.0 * n).astype(numpy.int64)
+    return tile_x, tile_y
+
 ORIGIN_SHIFT = 2 * math.pi * 6378137 / 2.0
 def latlng_to_xy(lat, lon):
-  x = lon * ORIGIN_SHIFT / 180.0
-  y = math.log(math.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
+  x = numpy.multiply(lon, ORIGIN_SHIFT / 180.0)
+  y = numpy.log(numpy.tan(numpy.add(90, lat) * math.pi / 360.0 )) / (math.pi / 180.0)
   y = y * ORIGIN_SHIFT / 180.0
   return x, y
 
-def perpendicular_distance(p, p1, p2):
-    if p1['x'] == p2['x']:
-        return abs(p['x'] - p1['x'])
-    else:
-        slope = (p2['y'] - p1['y']) / (p2['x'] - p1['x'])
-        intercept = p1['y'] - (slope * p1['x'])
-        return abs(slope * p['x'] - p['y'] + intercept) / math.sqrt((slope ** 2) + 1)
-
-def simplify(path, epsilon):
-    # Ramer-Douglas-Peucker algorithm
-    if len(path) < 3:
-        return path
-    max_d = 0
-    index = None
-    for i in range(1, len(path)):
-        d = perpendicular_distance(path[i], path[0], path[-1])
-        if d > max_d:
-            max_d = d
-            index = i
-    if max_d > epsilon:
-        return simplify(path[:index + 1], epsilon)[:-1] + simplify(path[index:], epsilon)
-    else:
-        return [path[0], path[-1]]
+def perpendicular_distances(x, y, x1, y1, x2, y2):
+    # distance from each (x, y) to the line through (x1, y1) and (x2, y2), or to the point if they coincide
+    dx = x2 - x1
+    dy = y2 - y1
+    length = math.hypot(dx, dy)
+    if length == 0:
+        return numpy.hypot(x - x1, y - y1)
+    return numpy.abs(dy * (x - x1) - dx * (y - y1)) / length
+
+def simplify_rdp(x, y, epsilon):
+    """Ramer-Douglas-Peucker algorithm. Returns the indices of the points to keep.
+    Uses an explicit stack, so long and nearly straight paths can't exhaust the recursion limit."""
+
+    n = len(x)
+    if n < 3:
+        return numpy.arange(n)
+    keep = numpy.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        d = perpendicular_distances(x[first + 1:last], y[first + 1:last], x[first], y[first], x[last], y[last])
+        index = numpy.argmax(d)
+        if d[index] > epsilon:
+            index += first + 1
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return numpy.flatnonzero(keep)
+
+def triangle_area(x1, y1, x2, y2, x3, y3):
+    return abs((x2 - x1) * (y3 - y1) - (x3 - x1) * (y2 - y1)) / 2
+
+def simplify_vw(x, y, epsilon):
+    """Visvalingam-Whyatt algorithm. Returns the indices of the points to keep.
+    Repeatedly drops the point forming the smallest triangle with its neighbours until
+    every remaining triangle has an area of at least epsilon ** 2."""
+
+    n = len(x)
+    if n < 3:
+        return numpy.arange(n)
+    threshold = epsilon ** 2
+    x = x.tolist()
+    y = y.tolist()
+    prev = range(-1, n - 1)
+    next = range(1, n + 1)
+    areas = [None] + [triangle_area(x[i - 1], y[i - 1], x[i], y[i], x[i + 1], y[i + 1]) for i in xrange(1, n - 1)] + [None]
+    heap = [(areas[i], i) for i in xrange(1, n - 1)]
+    heapq.heapify(heap)
+    keep = numpy.ones(n, dtype=bool)
+    while heap:
+        area, i = heapq.heappop(heap)
+        if not keep[i] or area != areas[i]:
+            continue # stale entry, the point was removed or its area changed since
+        if area >= threshold:
+            break
+        keep[i] = False
+        p, q = prev[i], next[i]
+        next[p] = q
+        prev[q] = p
+        for j in (p, q):
+            if 0 < j < n - 1:
+                # a neighbour never gets a smaller area than the point just removed, so the order stays meaningful
+                areas[j] = max(area, triangle_area(x[prev[j]], y[prev[j]], x[j], y[j], x[next[j]], y[next[j]]))
+                heapq.heappush(heap, (areas[j], j))
+    return numpy.flatnonzero(keep)
+
+SIMPLIFY_METHODS = {'rdp': simplify_rdp, 'vw': simplify_vw}
+
+def simplify(x, y, epsilon, method='rdp'):
+    return SIMPLIFY_METHODS[method](numpy.asarray(x, dtype=numpy.float64), numpy.asarray(y, dtype=numpy.float64), epsilon)
 
 LATLON_RE = re.compile(r"^([0-9]+\.[0-9]+)([NSEW])$")
 